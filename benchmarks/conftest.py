@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import synthetic
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Keep markmeld's on-disk caches out of the user's cache folder
+    monkeypatch.setenv("MM_CACHE_DIR", str(tmp_path / "cache"))
+
+
+@pytest.fixture(scope="session")
+def projects(tmp_path_factory):
+    """
+    Paths to the _markmeld.yaml of each synthetic project, generated once
+    per session.
+    """
+    root = tmp_path_factory.mktemp("projects")
+    paths = {
+        "import_chain": synthetic.import_chain_project(str(root / "import_chain")),
+        "glob_factory": synthetic.glob_factory_project(str(root / "glob_factory")),
+        "bibliography": synthetic.bibliography_project(str(root / "bibliography")),
+        "loop": synthetic.loop_project(str(root / "loop")),
+        "inheritance": synthetic.inheritance_project(str(root / "inheritance")),
+    }
+    # Files and folders changed in the last moments aren't cached (they could
+    # change again in the same timestamp tick), so date the projects back
+    for folder, _, files in os.walk(root, topdown=False):
+        for name in files:
+            os.utime(os.path.join(folder, name), (1, 1))
+        os.utime(folder, (1, 1))
+    return paths
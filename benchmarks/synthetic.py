@@ -0,0 +1,175 @@
+"""
+Generators for synthetic markmeld projects, used by the benchmarks.
+
+Each function writes a project into a folder and returns the path to its
+_markmeld.yaml. The projects are deterministic, so timings are comparable
+between runs.
+"""
+
+import os
+
+import yaml
+
+# A no-op command, that still reads the rendered output from stdin
+NOOP_COMMAND = "cat > /dev/null"
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+    return str(path)
+
+
+def write_yaml(path, data):
+    return write(path, yaml.safe_dump(data, sort_keys=False))
+
+
+def import_chain_project(folder, depth=50, targets_per_file=20):
+    """
+    A config that imports a chain of `depth` config files, each importing
+    the next one and defining its own targets.
+    """
+    for level in range(depth):
+        cfg = {
+            "targets": {
+                f"level{level}_target{i}": {
+                    "jinja_template": "../tpl.jinja",
+                    "command": NOOP_COMMAND,
+                    "description": f"Target {i} of level {level}",
+                }
+                for i in range(targets_per_file)
+            }
+        }
+        if level + 1 < depth:
+            cfg["imports"] = [f"level{level + 1}.yaml"]
+        write_yaml(os.path.join(folder, "imports", f"level{level}.yaml"), cfg)
+    write(os.path.join(folder, "tpl.jinja"), "{{ description }}\n")
+    return write_yaml(
+        os.path.join(folder, "_markmeld.yaml"),
+        {"version": 1, "imports": ["imports/level0.yaml"]},
+    )
+
+
+def glob_factory_project(folder, n_files=2000):
+    """
+    A config whose glob factory makes a target for each of `n_files`
+    markdown files.
+    """
+    for i in range(n_files):
+        write(
+            os.path.join(folder, "posts", f"post{i:05d}.md"),
+            f"---\ntitle: Post {i}\n---\n\n# Post {i}\n\nSome text.\n",
+        )
+    return write_yaml(
+        os.path.join(folder, "_markmeld.yaml"),
+        {"version": 1, "target_factories": [{"glob": {"path": "posts/*.md"}}]},
+    )
+
+
+def bibliography_project(folder, n_entries=5000):
+    """
+    A target that reads a large yaml bibliography, and a markdown file; and
+    a target with the same data whose template only uses the markdown file.
+    """
+    entries = [
+        {
+            "id": f"ref{i}",
+            "title": f"A study of topic number {i}",
+            "authors": [f"Author {i % 97}", f"Author {i % 89}", f"Author {i % 83}"],
+            "journal": f"Journal {i % 50}",
+            "year": 1950 + i % 70,
+            "volume": i % 300,
+            "pages": f"{i}-{i + 12}",
+        }
+        for i in range(n_entries)
+    ]
+    write_yaml(os.path.join(folder, "refs.yaml"), {"references": entries})
+    write(
+        os.path.join(folder, "intro.md"), "---\ntitle: Intro\n---\n\n" + "Text. " * 500
+    )
+    write(
+        os.path.join(folder, "refs.jinja"),
+        "{{ intro.content }}\n{% for ref in refs.references %}"
+        "- {{ ref.authors | join(', ') }}. {{ ref.title }}. *{{ ref.journal }}* ({{ ref.year }})\n"
+        "{% endfor %}",
+    )
+    write(os.path.join(folder, "intro.jinja"), "{{ intro }}\n")
+    return write_yaml(
+        os.path.join(folder, "_markmeld.yaml"),
+        {
+            "version": 1,
+            "targets": {
+                "bibliography": {
+                    "jinja_template": "refs.jinja",
+                    "recursive_render": False,
+                    "command": NOOP_COMMAND,
+                    "data": {
+                        "md_files": {"intro": "intro.md"},
+                        "yaml_files": {"refs": "refs.yaml"},
+                    },
+                },
+                "intro_only": {
+                    "inherit_from": "bibliography",
+                    "jinja_template": "intro.jinja",
+                },
+            },
+        },
+    )
+
+
+def loop_project(folder, iterations=1000):
+    """
+    A multi-output target with `iterations` iterations.
+    """
+    write(os.path.join(folder, "letter.jinja"), "Dear {{ person.name }},\n\nHello.\n")
+    return write_yaml(
+        os.path.join(folder, "_markmeld.yaml"),
+        {
+            "version": 1,
+            "targets": {
+                "letters": {
+                    "jinja_template": "letter.jinja",
+                    "recursive_render": False,
+                    "command": NOOP_COMMAND,
+                    "loop": {"loop_data": "people", "assign_to": "person"},
+                    "data": {
+                        "variables": {
+                            "people": [
+                                {"name": f"Person {i}"} for i in range(iterations)
+                            ]
+                        }
+                    },
+                }
+            },
+        },
+    )
+
+
+def inheritance_project(folder, depth=50, width=200):
+    """
+    A chain of targets `depth` deep, each inheriting from the previous one,
+    and `width` targets inheriting from the end of the chain.
+    """
+    targets = {
+        "base": {
+            "abstract": True,
+            "jinja_template": "tpl.jinja",
+            "command": NOOP_COMMAND,
+            "data": {"variables": {"level": 0}},
+        }
+    }
+    parent = "base"
+    for level in range(1, depth):
+        targets[f"level{level}"] = {
+            "inherit_from": parent,
+            f"var{level}": level,
+            "data": {"variables": {f"level{level}": level}},
+        }
+        parent = f"level{level}"
+    for i in range(width):
+        targets[f"leaf{i}"] = {"inherit_from": parent, "leaf": i}
+    write(os.path.join(folder, "tpl.jinja"), "{{ leaf }}\n")
+    return write_yaml(
+        os.path.join(folder, "_markmeld.yaml"), {"version": 1, "targets": targets}
+    )
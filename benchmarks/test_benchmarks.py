@@ -0,0 +1,109 @@
+"""
+Benchmarks of markmeld's hot paths, on synthetic projects (see synthetic.py).
+
+Requires pytest-benchmark (pip install -r requirements/requirements-benchmark.txt);
+these are skipped without it. Run them with:
+
+    pytest benchmarks --benchmark-autosave
+
+and compare against an earlier run with --benchmark-compare.
+"""
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from markmeld import MarkdownMelder, load_config_wrapper
+from markmeld.melder import Target
+from markmeld.utilities import clear_parse_cache
+
+
+def test_load_config_import_chain(benchmark, projects):
+    cfg = benchmark(load_config_wrapper, projects["import_chain"])
+    assert len(cfg["targets"]) == 50 * 20
+
+
+def test_load_config_glob_factory(benchmark, projects):
+    cfg = benchmark(load_config_wrapper, projects["glob_factory"])
+    assert len(cfg["targets"]) == 2000
+
+
+def test_target_deep_inheritance(benchmark, projects):
+    cfg = load_config_wrapper(projects["inheritance"])
+
+    def construct_leaves():
+        # As in a build: the targets share the melder's inheritance resolver
+        mm = MarkdownMelder(cfg)
+        return [Target(cfg, f"leaf{i}", inheritance=mm.inheritance) for i in range(200)]
+
+    targets = benchmark(construct_leaves)
+    assert targets[-1].meta["var49"] == 49
+
+
+def test_meld_inputs_bibliography(benchmark, projects):
+    cfg = load_config_wrapper(projects["bibliography"])
+    mm = MarkdownMelder(cfg)
+    tgt = Target(cfg, "bibliography")
+
+    def meld_cold():
+        clear_parse_cache()
+        return mm.meld_inputs(tgt)
+
+    melded = benchmark(meld_cold)
+    assert len(melded["refs"]["references"]) == 5000
+
+
+def test_meld_inputs_bibliography_cached(benchmark, projects):
+    cfg = load_config_wrapper(projects["bibliography"])
+    mm = MarkdownMelder(cfg)
+    tgt = Target(cfg, "bibliography")
+    mm.meld_inputs(tgt)
+    melded = benchmark(mm.meld_inputs, tgt)
+    assert len(melded["refs"]["references"]) == 5000
+
+
+def test_meld_inputs_unused_bibliography(benchmark, projects):
+    cfg = load_config_wrapper(projects["bibliography"])
+    mm = MarkdownMelder(cfg)
+    tgt = Target(cfg, "intro_only")
+
+    def meld_cold():
+        clear_parse_cache()
+        return mm.meld_inputs(tgt)
+
+    # The template doesn't use the bibliography, so it isn't loaded
+    melded = benchmark(meld_cold)
+    assert "refs" not in melded
+
+
+def test_render_bibliography(benchmark, projects):
+    cfg = load_config_wrapper(projects["bibliography"])
+    mm = MarkdownMelder(cfg)
+    tgt = Target(cfg, "bibliography")
+    melded = mm.meld_inputs(tgt)
+    output = benchmark(mm.render_template, melded, tgt)
+    assert output.count("\n- ") == 5000
+
+
+def test_build_bibliography(benchmark, projects):
+    cfg = load_config_wrapper(projects["bibliography"])
+    mm = MarkdownMelder(cfg)
+    result = benchmark(mm.build_target, "bibliography")
+    assert result.returncode == 0
+
+
+def test_loop_throughput(benchmark, projects):
+    cfg = load_config_wrapper(projects["loop"])
+    mm = MarkdownMelder(cfg, jobs=4)
+    result = benchmark.pedantic(mm.build_target, args=("letters",), rounds=3)
+    assert len(result) == 1000
+    assert all(tgt.returncode == 0 for tgt in result.values())
+
+
+def test_loop_render_throughput(benchmark, projects):
+    cfg = load_config_wrapper(projects["loop"])
+    mm = MarkdownMelder(cfg)
+    result = benchmark.pedantic(
+        mm.build_target, args=("letters",), kwargs={"print_only": True}, rounds=3
+    )
+    assert result[999].melded_output.startswith("Dear Person 999,")
@@ -1,10 +1,33 @@
-from .melder import MarkdownMelder
-from .cli import main
-from .utilities import load_config_file, load_config_wrapper
+import importlib
+import sys
 
 __all__ = ["MarkdownMelder", "load_config_file", "load_config_wrapper"]
 
+# Attributes are imported on first use, so that light code paths (like the
+# CLI's --autocomplete) don't pay for importing jinja2, frontmatter, etc.
+_LAZY_ATTRIBUTES = {
+    "MarkdownMelder": ".melder",
+    "main": ".cli",
+    "load_config_file": ".utilities",
+    "load_config_wrapper": ".utilities",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(_LAZY_ATTRIBUTES[name], __name__)
+        return getattr(module, name)
+    try:
+        return importlib.import_module(f".{name}", __name__)
+    except ModuleNotFoundError as e:
+        if e.name != f"{__name__}.{name}":
+            raise
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == "__main__":
+    from .cli import main
+
     try:
         sys.exit(main())
     except KeyboardInterrupt:
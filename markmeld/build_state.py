@@ -0,0 +1,206 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from logging import getLogger
+
+from ubiquerg import is_url
+
+from .const import PKG_NAME, STATE_DIR, BUILD_STATE_FILE
+from .utilities import (
+    atomic_write,
+    get_template_path,
+    keyed_data_files,
+    make_abspath,
+    thaw,
+)
+
+_LOGGER = getLogger(PKG_NAME)
+
+# Variables set to the build date and time
+TIME_KEYS = ["_now", "_today", "now", "today"]
+
+
+def hash_file(path, hasher):
+    """
+    Feed the contents of a file (or a marker, if it doesn't exist) into a hasher.
+    """
+    hasher.update(path.encode())
+    if not os.path.isfile(path):
+        hasher.update(b"\0missing")
+        return
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+
+
+def hash_input(path, hasher):
+    if is_url(path):
+        hasher.update(path.encode())
+    else:
+        hash_file(path, hasher)
+
+
+def input_digest(tgt, loop_key=None):
+    """
+    Hash everything a target reads that is not part of its metadata:
+    the files in its data block, its jinja template, and any file named
+    directly by a metadata variable (like a latex_template or bibliography),
+    other than the output file itself.
+
+    Remote (URL) inputs are hashed by address only.
+
+    @param str loop_key Data key of a loop target's loop data; the files
+        loaded under it are hashed separately, so iterations can be hashed
+        by their own loop value instead (see build_digest)
+    @return tuple (digest of the inputs, digest of the loop data files)
+    """
+    hasher = hashlib.sha256()
+    loop_hasher = hashlib.sha256()
+    workpath = tgt.meta["_workpath"]
+    files = sorted(set(keyed_data_files(tgt.meta.get("data"), workpath)), key=str)
+    for key, path in files:
+        if loop_key is not None and key == loop_key:
+            hash_input(path, loop_hasher)
+        else:
+            hash_input(path, hasher)
+
+    tpl_path = get_template_path(tgt.meta)
+    if tpl_path:
+        hash_input(tpl_path, hasher)
+
+    for k in sorted(tgt.meta):
+        v = tgt.meta[k]
+        if k.startswith("_") or k in ["command", "output_file"]:
+            continue
+        if not isinstance(v, str) or not v:
+            continue
+        if "\n" in v or is_url(v):
+            continue
+        path = make_abspath(v, workpath)
+        if os.path.isfile(path):
+            hash_file(path, hasher)
+    return hasher.hexdigest(), loop_hasher.hexdigest()
+
+
+def build_digest(tgt, cmd_fmt):
+    """
+    Hash the full build recipe for a target (or loop iteration):
+    its resolved metadata, its input digest, and its formatted command.
+
+    The build date and time are left out unless the target uses them, so an
+    unchanged target stays up to date on later days. Iterations of a loop
+    target whose output depends on its loop data only through the loop
+    value (its `loop_key` is set) are hashed without the rest of the loop
+    data, so changing one element rebuilds only that element's output.
+    """
+    meta = thaw(tgt.meta)
+    if not tgt.uses_time:
+        for k in TIME_KEYS:
+            meta.pop(k, None)
+    if tgt.loop_key is not None and isinstance(meta.get("data"), dict):
+        variables = meta["data"].get("variables")
+        if isinstance(variables, dict) and tgt.loop_key in variables:
+            variables = {k: v for k, v in variables.items() if k != tgt.loop_key}
+            meta["data"] = dict(meta["data"], variables=variables)
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(meta, sort_keys=True, default=str).encode())
+    hasher.update(tgt.input_digest.encode())
+    if tgt.loop_key is None:
+        hasher.update(tgt.loop_data_digest.encode())
+    hasher.update(cmd_fmt.encode())
+    return hasher.hexdigest()
+
+
+class BuildState(object):
+    """
+    Content hashes of previously built outputs, stored in
+    `.markmeld/state` next to the root config file.
+
+    Used for incremental builds: a target is skipped if its build digest
+    matches the one recorded when its output file was last built.
+
+    Several runs (like the shards of a build) can share a state file: each
+    saves only the entries it recorded, merged into the file's current
+    entries while holding a lock on it.
+    """
+
+    def __init__(self, cfg_file_path):
+        self.path = os.path.join(
+            os.path.dirname(cfg_file_path), STATE_DIR, BUILD_STATE_FILE
+        )
+        self.lock = threading.Lock()
+        self.entries = self.read()
+        self.recorded = {}  # Entries recorded in this run, not yet saved
+
+    def read(self):
+        """
+        @return dict The entries in the state file
+        """
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except ValueError as e:
+            _LOGGER.warning(f"MM | Ignoring unreadable build state {self.path}: {e}")
+            return {}
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        """
+        Hold an exclusive lock on the state file, shared by every process
+        (where the platform supports it).
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.lock", "a") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def output_key(tgt):
+        return f"{tgt.target_name}:{tgt.meta['output_file']}"
+
+    def is_current(self, tgt, digest):
+        """
+        Is the output of this target up to date with the given build digest?
+        """
+        output_file = tgt.meta.get("output_file")
+        if not output_file:
+            return False
+        output_path = make_abspath(output_file, tgt.meta["_workpath"])
+        if not os.path.exists(output_path):
+            return False
+        with self.lock:
+            return self.entries.get(self.output_key(tgt)) == digest
+
+    def record(self, tgt, digest):
+        if not tgt.meta.get("output_file"):
+            return
+        with self.lock:
+            self.entries[self.output_key(tgt)] = digest
+            self.recorded[self.output_key(tgt)] = digest
+
+    def save(self):
+        with self.lock:
+            if not self.recorded:
+                return
+            with self.file_lock():
+                entries = self.read()
+                entries.update(self.recorded)
+                with atomic_write(self.path) as f:
+                    json.dump(entries, f, indent=2, sort_keys=True)
+            self.entries.update(entries)
+            self.recorded = {}
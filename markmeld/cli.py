@@ -1,16 +1,20 @@
 import argparse
-import logmuse
+import json
 import os
 import subprocess
 import sys
+import time
 
 from ubiquerg import VersionInHelpParser
 
+from .const import DAEMON_SOCKET_ENV
 from .exceptions import *
-from .melder import MarkdownMelder
-from .utilities import load_config_wrapper, get_file_open_cmd
+from .profiling import PROFILER, profile_phase
 from ._version import __version__
 
+# Logging, the caches and yaml are imported when needed, so that the thin
+# client (--client) can forward a command to the daemon without them
+
 tpl = """imports: null
 version: 1
 targets:
@@ -64,6 +68,14 @@ def build_argparser():
     # position 1
     parser.add_argument(dest="target", metavar="T", help="Target", nargs="?")
 
+    parser.add_argument(
+        "-a",
+        "--all",
+        action="store_true",
+        default=False,
+        help="Build all targets (or, with a target pattern like 'papers/*', all matching targets).",
+    )
+
     parser.add_argument(
         "-l",
         "--list",
@@ -108,6 +120,138 @@ def build_argparser():
         help="Show the template that will be used for this recipe.",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of parallel workers: for the iterations of multi-output (loop) targets, independent side targets, and the targets of multi-target builds (-a or patterns). Default: 1 (loop targets: their loop.parallel)",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="Skip building outputs whose inputs, template and command are unchanged.",
+    )
+
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        default=False,
+        help="Use only cached copies of remote (URL) templates and data.",
+    )
+
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl",
+        type=int,
+        default=None,
+        metavar="S",
+        help="Seconds to reuse cached remote files before checking for updates. Default: 0 (check on every run)",
+    )
+
+    parser.add_argument(
+        "--cache-data",
+        dest="cache_data",
+        action="store_true",
+        default=False,
+        help="Cache parsed yaml and markdown data on disk, to reuse between runs.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        default=False,
+        help="Rebuild the target whenever the files it depends on change.",
+    )
+
+    parser.add_argument(
+        "--no-server",
+        dest="server",
+        action="store_false",
+        default=True,
+        help="Run each target's command in a new process, even if it has a server.",
+    )
+
+    parser.add_argument(
+        "--server-timeout",
+        dest="server_timeout",
+        type=float,
+        default=None,
+        metavar="S",
+        help="Seconds to wait for a server to build a target, before running its command instead. Default: 300",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Report the time and memory used by each phase of the build.",
+    )
+
+    parser.add_argument(
+        "--profile-file",
+        dest="profile_file",
+        default="mm_profile.json",
+        metavar="F",
+        help="File to write the --profile trace to (Chrome trace format). Default: mm_profile.json",
+    )
+
+    parser.add_argument(
+        "--no-config-cache",
+        dest="config_cache",
+        action="store_false",
+        default=True,
+        help="Reload the config and its imports instead of using the cached config.",
+    )
+
+    parser.add_argument(
+        "--shard",
+        metavar="K/N",
+        default=None,
+        help="Build only the K-th of N shards of the loop iterations and targets (like 2/8).",
+    )
+
+    parser.add_argument(
+        "--shard-manifest",
+        dest="shard_manifest",
+        default=None,
+        metavar="F",
+        help="File to write the results of this --shard to. Default: .markmeld/shards/shard-K-of-N.json",
+    )
+
+    parser.add_argument(
+        "--merge-shards",
+        dest="merge_shards",
+        nargs="*",
+        default=None,
+        metavar="M",
+        help="Summarize the results of the shards of a build, from their manifests (files or folders).",
+    )
+
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        default=False,
+        help="Run a markmeld daemon, which keeps configs, templates and data loaded between builds.",
+    )
+
+    parser.add_argument(
+        "--client",
+        action="store_true",
+        default=False,
+        help="Send this command to the markmeld daemon, if one is running.",
+    )
+
+    parser.add_argument(
+        "--socket",
+        default=None,
+        metavar="S",
+        help=f"Unix socket of the markmeld daemon. Default: ${DAEMON_SOCKET_ENV}, or one in a private folder in $XDG_RUNTIME_DIR or the temp folder",
+    )
+
     parser.add_argument(
         "-v",
         "--vars",
@@ -119,17 +263,195 @@ def build_argparser():
     return parser
 
 
+def report_summary(results, elapsed):
+    """
+    Print a table of return codes and timings for a multi-target build.
+
+    @param dict results Output of MarkdownMelder.build_targets
+    @param float elapsed Wall-clock seconds for the whole build
+    @return int Exit code: 0 if every target succeeded, 1 otherwise
+    """
+    from .melder import result_returncode
+
+    width = max([len("Target")] + [len(t) for t in results])
+    _LOGGER.info(f"{'Target'.ljust(width)}  Return code  Seconds")
+    failed = 0
+    for target_name, (result, seconds) in results.items():
+        returncode = result_returncode(result)
+        if returncode != 0:
+            failed += 1
+        if isinstance(result, dict):
+            note = f"  ({len(result)} outputs)"
+        elif result is None:
+            note = "  (error)"
+        else:
+            note = ""
+        _LOGGER.info(
+            f"{target_name.ljust(width)}  {str(returncode).rjust(11)}  {seconds:7.2f}{note}"
+        )
+    _LOGGER.info(f"Built {len(results)} targets ({failed} failed) in {elapsed:.2f}s")
+    return 1 if failed else 0
+
+
+def melded_output(result):
+    """
+    @param Target|dict|None result A built target, a dict of them (loop
+        targets), or None if the build raised an error
+    @return The rendered output (or dumped variables) of the target, a list
+        of them for a loop target, or None
+    """
+    if result is None:
+        return None
+    if isinstance(result, dict):
+        return [tgt.melded_output for tgt in result.values()]
+    return result.melded_output
+
+
+def print_output(output):
+    """
+    Print a rendered output (see melded_output), one per line for loops.
+    """
+    if output is None:
+        return
+    for text in output if isinstance(output, list) else [output]:
+        print(text)
+
+
+def dump_json(data):
+    from .utilities import json_default
+
+    print(json.dumps(data, sort_keys=True, indent=2, default=json_default))
+
+
+def report_shards(summary):
+    """
+    Print the merged results of a sharded build.
+
+    @param dict summary Output of merge_shard_manifests
+    @return int Exit code: 0 if every shard ran and every output succeeded
+    """
+    for row in summary["results"]:
+        if row["returncode"] != 0:
+            iteration = "" if row["iteration"] is None else f" [{row['iteration']}]"
+            _LOGGER.error(
+                f"Failed: {row['target']}{iteration} (return code {row['returncode']})"
+            )
+    if summary["missing"]:
+        _LOGGER.error(f"Missing shards: {summary['missing']}")
+    _LOGGER.info(
+        f"Shards: {len(summary['found'])} of {summary['shards']}. Outputs: {summary['succeeded']} succeeded, {summary['failed']} failed."
+    )
+    print(json.dumps(summary, indent=2, default=str))
+    return 1 if summary["failed"] or summary["missing"] else 0
+
+
+def client_options(argv):
+    """
+    Find --client and --socket in the command line, without parsing it, so
+    the thin client can forward a command to the daemon before importing
+    anything a build needs.
+
+    @param list[str] argv Command-line arguments, as given to mm
+    @return (bool, str) Whether --client was given, and the --socket, if any
+    """
+    client, socket_path = False, None
+    for i, arg in enumerate(argv):
+        if arg == "--":
+            break
+        if arg == "--client":
+            client = True
+        elif arg == "--socket" and i + 1 < len(argv):
+            socket_path = argv[i + 1]
+        elif arg.startswith("--socket="):
+            socket_path = arg.split("=", 1)[1]
+    return client, socket_path
+
+
 def main(test_args=None):
     """
     Main command-line interface function
     """
+    client, socket_path = client_options(sys.argv[1:])
+    if client:
+        from .daemon import forward
+
+        returncode = forward(sys.argv[1:], socket_path)
+        if returncode is not None:
+            sys.exit(returncode)
+
+    import logmuse
+
     parser = logmuse.add_logging_options(build_argparser())
     args, _ = parser.parse_known_args()
     if test_args:
         args.__dict__.update(test_args)
+    setup_logging(args)
+
+    if args.daemon:
+        from .daemon import serve
+
+        return serve(args)
+    if args.client and not client:
+        # Given as an abbreviation (like --cli), or by test_args
+        from .daemon import forward
+
+        returncode = forward(sys.argv[1:], args.socket)
+        if returncode is not None:
+            sys.exit(returncode)
+    if args.client:
+        _LOGGER.info("MM | No markmeld daemon is running; running locally")
+    return run(args)
+
+
+def setup_logging(args, stream=None):
+    """
+    Configure logging from the command-line arguments.
+
+    @param stream File-like object to log to, instead of stderr
+    """
+    import logmuse
+
     global _LOGGER
-    _LOGGER = logmuse.logger_via_cli(args, make_root=True)
+    _LOGGER = logmuse.logger_via_cli(args, make_root=True, stream=stream)
+    return _LOGGER
+
+
+def run(args):
+    """
+    Run the command given on the command line, profiling it if asked to.
+
+    @param argparse.Namespace args Parsed command-line arguments
+    """
+    if not args.profile:
+        return meld(args)
+    PROFILER.start()
+    try:
+        return meld(args)
+    finally:
+        PROFILER.stop()
+        report_profile(args.profile_file)
+
 
+def report_profile(path):
+    """
+    Print the time and memory used by each phase of the build, and write
+    the details to a trace file.
+
+    @param str path File to write the trace to
+    """
+    sys.stderr.write(PROFILER.format_table() + "\n")
+    try:
+        PROFILER.write_trace(path)
+    except OSError as e:
+        _LOGGER.error(f"MM | Couldn't write profile to {path}: {e}")
+
+
+def meld(args):
+    """
+    Run the command given on the command line.
+
+    @param argparse.Namespace args Parsed command-line arguments
+    """
     if args.init:
         _LOGGER.info(f"Initializing config file at: {args.init}")
         if os.path.exists(args.init):
@@ -140,6 +462,27 @@ def main(test_args=None):
         _LOGGER.info(f"File initialized to:\n{tpl}")
         sys.exit(0)
 
+    from .config_cache import load_config_cached
+    from .http_cache import HTTP_CACHE_SETTINGS
+    from .servers import SERVER_SETTINGS
+    from .sharding import (
+        default_manifest_path,
+        manifest_dir,
+        merge_shard_manifests,
+        parse_shard,
+        write_shard_manifest,
+    )
+    from .utilities import get_file_open_cmd, load_config_wrapper, PARSE_CACHE_SETTINGS
+
+    if args.merge_shards is not None:
+        paths = args.merge_shards or [manifest_dir(args.config or "_markmeld.yaml")]
+        try:
+            summary = merge_shard_manifests(paths)
+        except (OSError, ValueError, KeyError) as e:
+            _LOGGER.error(f"Couldn't merge shard manifests: {e}")
+            sys.exit(1)
+        sys.exit(report_shards(summary))
+
     if not args.config:
         if os.path.exists("_markmeld.yaml"):
             args.config = "_markmeld.yaml"
@@ -148,7 +491,31 @@ def main(test_args=None):
             _LOGGER.error(msg)
             raise ConfigError(msg)
 
-    cfg = load_config_wrapper(args.config, None, args.autocomplete)
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        _LOGGER.error(str(e))
+        sys.exit(1)
+    shard_manifest = None
+    if shard:
+        shard_manifest = args.shard_manifest or default_manifest_path(
+            args.config, shard
+        )
+
+    PARSE_CACHE_SETTINGS["disk"] = args.cache_data
+    HTTP_CACHE_SETTINGS["offline"] = args.offline
+    HTTP_CACHE_SETTINGS["run_started"] = time.time()
+    SERVER_SETTINGS["enabled"] = args.server
+    if args.server_timeout is not None:
+        SERVER_SETTINGS["build_timeout"] = args.server_timeout
+    if args.cache_ttl is not None:
+        HTTP_CACHE_SETTINGS["ttl"] = args.cache_ttl
+
+    with profile_phase("load_config"):
+        if args.config_cache:
+            cfg = load_config_cached(args.config, None, args.autocomplete)
+        else:
+            cfg = load_config_wrapper(args.config, None, args.autocomplete)
 
     if args.autocomplete:
         if "targets" not in cfg:
@@ -159,7 +526,7 @@ def main(test_args=None):
             sys.stdout.write(t + " ")
         sys.exit(0)
 
-    if not args.target and not args.list:
+    if not args.target and not args.list and not args.all:
         if "targets" not in cfg:
             raise TargetError(f"No targets specified in config.")
         tarlist = [x for x, k in cfg["targets"].items()]
@@ -180,8 +547,43 @@ def main(test_args=None):
             _LOGGER.error(f"  {k}: {v}")
         sys.exit(0)
 
+    # Heavy imports (jinja2, frontmatter) are only needed from here on
+    from .melder import MarkdownMelder
+
     _LOGGER.debug("Melding...")  # Meld it!
-    mm = MarkdownMelder(cfg)
+    mm = MarkdownMelder(cfg, jobs=args.jobs, incremental=args.incremental, shard=shard)
+
+    if args.all or (args.target and any(c in args.target for c in "*?[")):
+        for option in ["explain", "template", "watch"]:
+            if getattr(args, option):
+                _LOGGER.error(f"--{option} needs a single target, not a pattern")
+                sys.exit(1)
+        target_names = mm.match_targets(args.target or "*")
+        if not target_names:
+            _LOGGER.error(f"No targets match: {args.target}")
+            sys.exit(1)
+        if shard:
+            target_names = mm.shard_targets(target_names)
+            _LOGGER.info(f"Shard {shard[0]}/{shard[1]}: {len(target_names)} targets")
+        start = time.time()
+        results = mm.build_targets(
+            target_names, print_only=args.print, vardump=args.dump
+        )
+        elapsed = time.time() - start
+        if args.dump:
+            _LOGGER.info("Dumping JSON output passed to jinja templates...")
+            dump_json({t: melded_output(r) for t, (r, _) in results.items()})
+        elif args.print:
+            for result, _ in results.values():
+                print_output(melded_output(result))
+        if shard:
+            write_shard_manifest(
+                shard_manifest,
+                shard,
+                {t: result for t, (result, seconds) in results.items()},
+                elapsed,
+            )
+        sys.exit(report_summary(results, elapsed))
 
     if args.explain:
         explained_target = mm.describe_target(args.target)
@@ -190,28 +592,47 @@ def main(test_args=None):
     if args.template:
         from .melder import Target, load_template
 
-        tgt = Target(mm.cfg, args.target)
+        tgt = Target(mm.cfg, args.target, inheritance=mm.inheritance)
         tpl = load_template(tgt.meta)
         _LOGGER.info("Template content:")
         _LOGGER.info(tpl.source)
         sys.exit(0)
 
+    if args.watch:
+        from .watch import TargetWatcher
+
+        watcher = TargetWatcher(
+            args.config,
+            args.target,
+            melder_kwargs={"jobs": args.jobs, "incremental": args.incremental},
+            build_kwargs={"print_only": args.print, "vardump": args.dump},
+            cfg=cfg,
+        )
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            _LOGGER.info("Stopped watching.")
+        sys.exit(0)
+
+    if shard and not mm.shard_targets([args.target]):
+        _LOGGER.info(f"Target '{args.target}' isn't in shard {shard[0]}/{shard[1]}")
+        write_shard_manifest(shard_manifest, shard, {}, 0)
+        sys.exit(0)
+
+    start = time.time()
     built_target = mm.build_target(
         args.target, print_only=args.print, vardump=args.dump
     )
+    if shard:
+        write_shard_manifest(
+            shard_manifest, shard, {args.target: built_target}, time.time() - start
+        )
 
     if args.dump:
-        import json
-
         _LOGGER.info("Dumping JSON output passed to jinja template...")
-        print(
-            json.dumps(
-                built_target.melded_output, sort_keys=True, indent=2, default=str
-            )
-        )
-
-    if args.print:
-        print(built_target.melded_output)
+        dump_json(melded_output(built_target))
+    elif args.print:
+        print_output(melded_output(built_target))
 
     def report_result(built_target):
         """
@@ -258,8 +679,11 @@ def main(test_args=None):
     if type(built_target) == dict:
         # Mult-output target
         for i, tgt in built_target.items():
+            for item in tgt.messages:
+                if item["status"] == "fail":
+                    _LOGGER.error(item["message"])
             _LOGGER.info(
-                f"Output {i}: Return code: {tgt.returncode}. Output: {tgt.meta['output_file']}"
+                f"Output {i}: Return code: {tgt.returncode}. Output: {tgt.meta.get('output_file')}"
             )
     else:
         report_result(built_target)
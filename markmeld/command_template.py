@@ -0,0 +1,88 @@
+import string
+
+from functools import lru_cache
+
+from ubiquerg import expandpath
+
+from .exceptions import TargetError
+
+_FORMATTER = string.Formatter()
+
+
+@lru_cache(maxsize=1024)
+def compile_template(template):
+    """
+    Parse a command template (in str.format syntax) once.
+
+    @param str template Template, with user and environment variables
+        already expanded
+    @return tuple Pieces of (literal text, field name, format spec,
+        conversion), as from string.Formatter.parse; the field name is None
+        for trailing text
+    """
+    return tuple(_FORMATTER.parse(template))
+
+
+class CommandFormatter(object):
+    """
+    Formats command templates, like 'pandoc -o {output_file}', with a
+    target's variables.
+
+    Variables can refer to other variables (like `output_file:
+    "{today}_{name}.pdf"`). These references form a dependency graph: each
+    variable is expanded at most once per formatter (and its template parsed
+    once per process), and circular references raise a TargetError.
+
+    Formatting doesn't modify the variables, so a formatter can be used
+    for each loop iteration, concurrently.
+    """
+
+    def __init__(self, variables):
+        """
+        @param Mapping variables Variables available to the templates, like
+            a target's meta
+        """
+        self.variables = variables
+        self.expanded = {}  # field -> value, with its references expanded
+        self.expanding = []  # fields being expanded, to detect cycles
+
+    def format(self, template):
+        """
+        @param str template Template, like 'pandoc -o {output_file}'
+        @return str The template, with user and environment variables and
+            all variable references expanded
+        """
+        if "$" in template or template.startswith("~"):
+            template = expandpath(template)
+        pieces = []
+        for literal, field, spec, conversion in compile_template(template):
+            pieces.append(literal)
+            if field is None:
+                continue
+            value = self.value(field)
+            if conversion:
+                value = _FORMATTER.convert_field(value, conversion)
+            if spec and "{" in spec:
+                spec = self.format(spec)
+            pieces.append(format(value, spec or ""))
+        return "".join(pieces)
+
+    def value(self, field):
+        """
+        Look up a field (like 'name', 'recipient[name]' or 'a.b'), expanding
+        the references in it if it's a string.
+        """
+        if field in self.expanded:
+            return self.expanded[field]
+        if field in self.expanding:
+            cycle = self.expanding[self.expanding.index(field) :] + [field]
+            raise TargetError(f"Circular variable reference: {' -> '.join(cycle)}")
+        value, _ = _FORMATTER.get_field(field, (), self.variables)
+        if isinstance(value, str):
+            self.expanding.append(field)
+            try:
+                value = self.format(value)
+            finally:
+                self.expanding.pop()
+        self.expanded[field] = value
+        return value
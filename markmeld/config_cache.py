@@ -0,0 +1,156 @@
+import hashlib
+import os
+import pickle
+import re
+
+from logging import getLogger
+
+from ._version import __version__
+from .const import PKG_NAME
+from .glob_factory import make_abspath as factory_abspath
+from .glob_index import GLOB_INDEX, expand_glob
+from .utilities import atomic_write, get_cache_dir, load_config_wrapper
+
+_LOGGER = getLogger(PKG_NAME)
+
+# Target factories whose inputs the cache knows how to check
+CACHEABLE_FACTORIES = ["glob"]
+
+# Settings for the config cache.
+# memory: keep loaded configs in memory, and return the same (unchanged)
+#   config object while it's fresh. Used by the daemon.
+CONFIG_CACHE_SETTINGS = {"memory": False}
+
+# Cache entries kept in memory, by cache path
+_LOADED = {}
+
+# Environment variable references, like $HOME or ${MMDIR}
+ENV_VAR_REGEX = re.compile(r"\$\{?([A-Za-z_][A-Za-z0-9_]*)")
+
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+    except OSError:
+        return None
+
+
+def referenced_env_vars(paths):
+    """
+    Find the environment variables that config files refer to (and HOME,
+    for ~), since imports can depend on them.
+
+    @param Iterable[str] paths Config files
+    @return dict Current values of the variables, keyed by name
+    """
+    names = {"HOME"}
+    for path in paths:
+        try:
+            with open(path, "r") as f:
+                names.update(ENV_VAR_REGEX.findall(f.read()))
+        except OSError:
+            pass
+    return {name: os.environ.get(name) for name in sorted(names)}
+
+
+def factory_globs(load_record):
+    """
+    @return list[str]|None The glob patterns of the factories run while
+        loading a config, or None if a factory can't be checked by the cache
+    """
+    patterns = []
+    for fac_name, fac_vals, fac_cfg in load_record.get("factories", []):
+        if fac_name not in CACHEABLE_FACTORIES:
+            return None
+        patterns.append(factory_abspath(fac_vals["path"], fac_cfg))
+    return patterns
+
+
+def match_globs(patterns, visited=None):
+    return {pattern: expand_glob(pattern, visited) for pattern in patterns}
+
+
+def cache_path(cfg_path, workpath):
+    key = hashlib.sha256(f"{cfg_path}\0{workpath}".encode()).hexdigest()
+    return os.path.join(get_cache_dir("config"), f"{key}.pickle")
+
+
+def is_fresh(entry):
+    """
+    Is a cached config still valid? It is if none of the config files in its
+    import tree, the environment variables they refer to, or the files
+    matched by its glob factories have changed.
+
+    Glob results are checked by the signatures of the folders they were
+    read from; only if a folder changed are the globs matched again.
+    """
+    if entry.get("version") != __version__:
+        return False
+    for path, signature in entry["files"].items():
+        if file_signature(path) != signature:
+            return False
+    for name, value in entry["env"].items():
+        if os.environ.get(name) != value:
+            return False
+    if GLOB_INDEX.is_fresh(entry["glob_folders"]):
+        return True
+    GLOB_INDEX.load(entry["glob_listings"])
+    return match_globs(entry["globs"]) == entry["globs"]
+
+
+def load_config_cached(cfg_path, workpath=None, autocomplete=True):
+    """
+    Load a config file like load_config_wrapper, through an on-disk cache of
+    the fully resolved config (with imports and factory targets).
+
+    @param str cfg_path Path to the config file
+    @param str workpath The working path that the target's relative paths are relative to
+    @param bool autocomplete Suppress informational messages while loading
+    @return dict Loaded config
+    """
+    cfg_path = os.path.abspath(cfg_path)
+    path = cache_path(cfg_path, workpath)
+    entry = _LOADED.get(path) if CONFIG_CACHE_SETTINGS["memory"] else None
+    if entry is not None and is_fresh(entry):
+        _LOGGER.debug(f"MM | Using config loaded in this process for: {cfg_path}")
+        return entry["cfg"]
+    try:
+        with open(path, "rb") as f:
+            entry = pickle.load(f)
+        if is_fresh(entry):
+            _LOGGER.debug(f"MM | Using cached config for: {cfg_path}")
+            # Later globs (like data blocks) can reuse the folder listings
+            GLOB_INDEX.load(entry["glob_listings"])
+            if CONFIG_CACHE_SETTINGS["memory"]:
+                _LOADED[path] = entry
+            return entry["cfg"]
+    except (OSError, pickle.PickleError, EOFError, ValueError, KeyError):
+        pass
+
+    load_record = {}
+    cfg = load_config_wrapper(cfg_path, workpath, autocomplete, load_record)
+    patterns = factory_globs(load_record)
+    if not cfg or patterns is None:
+        return cfg
+
+    files = [cfg_path] + cfg["_imported_files"]
+    glob_folders = {}
+    entry = {
+        "version": __version__,
+        "files": {f: file_signature(f) for f in files},
+        "env": referenced_env_vars(files),
+        "globs": match_globs(patterns, glob_folders),
+        "glob_folders": glob_folders,
+        "glob_listings": GLOB_INDEX.export(glob_folders),
+        "cfg": cfg,
+    }
+    if CONFIG_CACHE_SETTINGS["memory"]:
+        _LOADED[path] = entry
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except (OSError, pickle.PickleError) as e:
+        _LOGGER.debug(f"MM | Couldn't cache config {cfg_path}: {e}")
+    return cfg
@@ -4,3 +4,19 @@ PKG_NAME = "markmeld"
 
 # https://stackoverflow.com/a/1857/13175187
 FILE_OPENER_MAP = {"Linux": "xdg-open", "Darwin": "open", "Windows": "start"}
+
+# Folder (next to the root _markmeld.yaml) holding markmeld build state
+STATE_DIR = ".markmeld"
+BUILD_STATE_FILE = "state"
+# Subfolder of STATE_DIR holding the result manifests of sharded builds
+SHARDS_DIR = "shards"
+
+# Environment variable to override the location of markmeld's cache folder,
+# which otherwise defaults to $XDG_CACHE_HOME/markmeld (or ~/.cache/markmeld)
+CACHE_DIR_ENV = "MM_CACHE_DIR"
+
+# Environment variable to set the Unix socket of the markmeld daemon
+DAEMON_SOCKET_ENV = "MM_DAEMON_SOCKET"
+# Environment variable listing more environment variables for a client to
+# send to the daemon
+DAEMON_ENV_ENV = "MM_DAEMON_ENV"
@@ -0,0 +1,375 @@
+import contextlib
+import fnmatch
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+
+from logging import getLogger
+
+from .const import DAEMON_ENV_ENV, DAEMON_SOCKET_ENV, PKG_NAME
+
+_LOGGER = getLogger(PKG_NAME)
+
+# Options that can't be sent to the daemon
+LOCAL_ONLY_OPTIONS = ["daemon", "watch"]
+
+# Environment variables a client sends to the daemon (as fnmatch patterns);
+# more can be added with $MM_DAEMON_ENV
+FORWARDED_ENV = [
+    "PATH",
+    "HOME",
+    "USER",
+    "LOGNAME",
+    "SHELL",
+    "LANG",
+    "LANGUAGE",
+    "LC_*",
+    "TZ",
+    "TMPDIR",
+    "TERM",
+    "XDG_*",
+    "MM_*",
+]
+
+
+def get_uid():
+    """
+    @return int|None This process's user id, or None where there are none
+    """
+    return os.getuid() if hasattr(os, "getuid") else None
+
+
+def is_private(path, kind):
+    """
+    Check that a path is of the expected kind, belongs to this user, and
+    can't be used by other users.
+
+    @param str path The daemon's socket or its folder
+    @param int kind Expected file type, like stat.S_IFSOCK
+    @return bool Whether the path can be trusted
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if stat.S_IFMT(st.st_mode) != kind:
+        _LOGGER.warning(
+            f"MM | Not a {'socket' if kind == stat.S_IFSOCK else 'folder'}: {path}"
+        )
+        return False
+    uid = get_uid()
+    if uid is not None and (st.st_uid != uid or st.st_mode & 0o077):
+        _LOGGER.warning(f"MM | Not owned by you, or open to other users: {path}")
+        return False
+    return True
+
+
+def peer_uid(sock):
+    """
+    @param socket.socket sock A connected Unix socket
+    @return int|None User id of the process at the other end, or None if the
+        platform can't tell
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    return struct.unpack("3i", creds)[1]
+
+
+def default_socket_path():
+    """
+    @return str The daemon's socket: $MM_DAEMON_SOCKET, or one in a folder
+        private to this user: $XDG_RUNTIME_DIR/markmeld (or markmeld-<uid>
+        in the temp folder), created if needed
+    """
+    if os.environ.get(DAEMON_SOCKET_ENV):
+        return os.environ[DAEMON_SOCKET_ENV]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        folder = os.path.join(runtime_dir, PKG_NAME)
+    else:
+        folder = os.path.join(tempfile.gettempdir(), f"{PKG_NAME}-{get_uid()}")
+    with contextlib.suppress(FileExistsError):
+        os.mkdir(folder, 0o700)
+    return os.path.join(folder, "daemon.sock")
+
+
+def client_environment(environ=None):
+    """
+    Select the environment variables a client sends to the daemon: those in
+    FORWARDED_ENV, and those named in $MM_DAEMON_ENV (comma or space
+    separated, and possibly patterns, like 'PANDOC_*'). Other variables,
+    like credentials, aren't sent.
+
+    @param Mapping environ Environment to select from; default: os.environ
+    @return dict Selected variables
+    """
+    environ = os.environ if environ is None else environ
+    extra = environ.get(DAEMON_ENV_ENV, "").replace(",", " ").split()
+    patterns = FORWARDED_ENV + extra
+    return {
+        name: value
+        for name, value in environ.items()
+        if any(fnmatch.fnmatchcase(name, p) for p in patterns)
+    }
+
+
+class Channel(object):
+    """
+    Sends messages to a client as lines of json. Writes from several threads
+    (like parallel builds) don't interleave; if the client goes away, the
+    command still runs to the end, and its messages are dropped.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, message):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.wfile.write(json.dumps(message).encode() + b"\n")
+                self.wfile.flush()
+            except OSError:
+                self.closed = True
+
+
+class ChannelStream(object):
+    """
+    A file-like object that sends what's written to it to the client, as
+    its stdout or stderr.
+    """
+
+    def __init__(self, channel, name):
+        self.channel = channel
+        self.name = name
+
+    def write(self, text):
+        if text:
+            self.channel.send({self.name: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def command_settings():
+    """
+    @return list[dict] Settings that the CLI changes for each command, to be
+        restored after each one
+    """
+    from .http_cache import HTTP_CACHE_SETTINGS
+    from .servers import SERVER_SETTINGS
+    from .utilities import PARSE_CACHE_SETTINGS
+
+    return [PARSE_CACHE_SETTINGS, HTTP_CACHE_SETTINGS, SERVER_SETTINGS]
+
+
+@contextlib.contextmanager
+def client_context(request, channel):
+    """
+    Run a command as if it had been started by the client: in its folder,
+    with the environment variables it sent (over the daemon's own), and with
+    output sent back to it.
+    """
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    settings = [dict(s) for s in command_settings()]
+    try:
+        os.chdir(request["cwd"])
+        os.environ.update(request["env"])
+        with contextlib.redirect_stdout(
+            ChannelStream(channel, "stdout")
+        ), contextlib.redirect_stderr(ChannelStream(channel, "stderr")):
+            yield
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        for current, saved in zip(command_settings(), settings):
+            current.clear()
+            current.update(saved)
+
+
+def run_command(request, channel):
+    """
+    Run a command sent by a client.
+
+    @param dict request The client's 'argv', 'cwd' and 'env'
+    @param Channel channel Where to send the command's logs and output
+    @return int Return code of the command
+    """
+    import logmuse
+
+    from . import cli
+
+    with client_context(request, channel):
+        parser = logmuse.add_logging_options(cli.build_argparser())
+        try:
+            args, _ = parser.parse_known_args(request["argv"])
+        except SystemExit as e:
+            return e.code
+        cli.setup_logging(args, stream=sys.stderr)
+        for option in LOCAL_ONLY_OPTIONS:
+            if getattr(args, option):
+                _LOGGER.error(f"--{option} can't be run by the daemon")
+                return 1
+        try:
+            cli.run(args)
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception as e:
+            _LOGGER.error(f"MM | {type(e).__name__}: {e}")
+            _LOGGER.debug(e, exc_info=True)
+            return 1
+    return 0
+
+
+def stop_daemon(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(args):
+    """
+    Run the markmeld daemon until interrupted: a server on a Unix socket
+    that runs the commands forwarded by clients (see forward).
+
+    Everything markmeld caches in memory stays loaded between commands:
+    resolved configs, compiled templates, parsed data, folder listings and
+    persistent servers, each revalidated against file changes as usual.
+    Commands are run one at a time, in the client's folder and environment.
+    The socket is only usable by this user, and connections from other
+    users are refused.
+
+    @param argparse.Namespace args The daemon's command-line arguments:
+        its `socket` (see default_socket_path) and logging options
+    """
+    import socketserver
+
+    from . import cli
+    from .config_cache import CONFIG_CACHE_SETTINGS
+
+    socket_path = args.socket or default_socket_path()
+    if not args.socket and not is_private(os.path.dirname(socket_path), stat.S_IFDIR):
+        _LOGGER.error(
+            f"MM | Refusing to run the daemon in: {os.path.dirname(socket_path)}"
+        )
+        return 1
+    CONFIG_CACHE_SETTINGS["memory"] = True
+    if os.path.lexists(socket_path):
+        if forward_request(socket_path, None) is not None:
+            _LOGGER.error(f"A markmeld daemon is already running at: {socket_path}")
+            return 1
+        os.remove(socket_path)  # Left behind by a daemon that didn't stop cleanly
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            uid = peer_uid(self.connection)
+            if uid is not None and uid != get_uid():
+                _LOGGER.warning(f"MM | Refused a connection from user {uid}")
+                return
+            request = json.loads(self.rfile.readline() or "null")
+            channel = Channel(self.wfile)
+            if not request:
+                # A ping, from a client checking that the daemon is running
+                channel.send({"returncode": 0})
+                return
+            _LOGGER.info(f"MM | Running: mm {' '.join(request['argv'])}")
+            try:
+                returncode = run_command(request, channel)
+            finally:
+                # Log to the daemon's own output again
+                cli.setup_logging(args)
+            channel.send({"returncode": returncode})
+
+    if threading.current_thread() is threading.main_thread():
+        # Stop cleanly (removing the socket) on SIGTERM, as on Ctrl+C
+        signal.signal(signal.SIGTERM, stop_daemon)
+    # Create the socket readable only by this user, with no window in which
+    # others could connect
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, Handler)
+    finally:
+        os.umask(umask)
+    _LOGGER.info(f"MM | Daemon listening on: {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        _LOGGER.info("MM | Stopping daemon")
+    finally:
+        server.server_close()
+        with contextlib.suppress(OSError):
+            os.remove(socket_path)
+    return 0
+
+
+def forward_request(socket_path, request):
+    """
+    Send a request to the daemon, and relay its output to this process.
+
+    The request is only sent to a daemon run by this user: the socket (and,
+    where the platform can tell, the process listening on it) must belong
+    to this user.
+
+    @param dict|None request The command to run (None just pings the daemon)
+    @return int|None The command's return code, or None if no (trusted)
+        daemon answered
+    """
+    if not hasattr(socket, "AF_UNIX") or not os.path.lexists(socket_path):
+        return None
+    if not is_private(socket_path, stat.S_IFSOCK):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    uid = peer_uid(sock)
+    if uid is not None and uid != get_uid():
+        _LOGGER.warning(f"MM | The daemon at {socket_path} is run by user {uid}")
+        sock.close()
+        return None
+    with sock, sock.makefile("rb") as rfile:
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        for line in rfile:
+            message = json.loads(line)
+            if "stdout" in message:
+                sys.stdout.write(message["stdout"])
+                sys.stdout.flush()
+            elif "stderr" in message:
+                sys.stderr.write(message["stderr"])
+                sys.stderr.flush()
+            elif "returncode" in message:
+                return message["returncode"]
+    _LOGGER.error("MM | The daemon stopped before finishing the command")
+    return 1
+
+
+def forward(argv, socket_path=None):
+    """
+    Run a command on the markmeld daemon, as its thin client.
+
+    @param list[str] argv Command-line arguments, as given to mm
+    @param str socket_path The daemon's socket; see default_socket_path
+    @return int|None Return code of the command, or None if no daemon is
+        running, so the command should be run in this process instead
+    """
+    socket_path = socket_path or default_socket_path()
+    request = {"argv": argv, "cwd": os.getcwd(), "env": client_environment()}
+    return forward_request(socket_path, request)
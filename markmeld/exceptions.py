@@ -12,3 +12,19 @@ class ConfigError(Exception):
     """
 
     pass
+
+
+class RemoteFileError(Exception):
+    """
+    There was a problem fetching a remote (URL) file
+    """
+
+    pass
+
+
+class ServerError(Exception):
+    """
+    A persistent server could not build a target
+    """
+
+    pass
@@ -16,13 +16,13 @@ def make_abspath(relpath, cfg, root=None):
 #  TODO: if it's a folder-style naming, shouldn't we put the output file
 #  in that folder?
 def glob_factory(vars, cfg):
-    import glob
+    from .glob_index import expand_glob
 
     path = make_abspath(vars["path"], cfg)
     name_levels = 0
     if "name_levels" in vars:
         name_levels = vars["name_levels"]
-    globs = glob.glob(path)
+    globs = expand_glob(path)
     _LOGGER.debug(f"Globs: {globs}")
     _LOGGER.debug(f"Path: {path}")
     # Populate a targets array to return
@@ -0,0 +1,214 @@
+import fnmatch
+import os
+import re
+import threading
+import time
+
+MAGIC_CHARS = re.compile(r"[*?[]")
+
+# A listing taken within this long of the folder's last change may miss a
+# change made in the same timestamp tick, so it isn't reused (like git's
+# "racy" index entries). Two seconds covers file systems with coarse times.
+RACY_NS = 2 * 10**9
+
+# Recorded for folders whose listing can't be trusted later (see RACY_NS)
+RACY_SIGNATURE = ("racy",)
+
+
+def has_magic(part):
+    return MAGIC_CHARS.search(part) is not None
+
+
+def dir_signature(path):
+    """
+    Identify the state of a folder's listing. A folder's modification time
+    changes whenever an entry is added to, removed from, or renamed in it.
+
+    @return tuple|None Modification time and inode, or None if it's missing
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_ino)
+
+
+def join(base, name):
+    return os.path.join(base, name) if base else name
+
+
+class GlobIndex(object):
+    """
+    Expands glob patterns from cached directory listings.
+
+    Each folder is read once (with os.scandir) and shared by every pattern
+    that looks into it, whether from target factories, data blocks, or the
+    config cache. A cached listing is reused for as long as the folder's
+    signature (see dir_signature) is unchanged, so the index stays correct
+    in long-running processes.
+
+    Matching follows glob.glob with recursive=True: `**` matches any number
+    of folders, and wildcards don't match names starting with a dot unless
+    the pattern does. Unlike glob, results are sorted, symlinks that loop
+    back to a parent folder aren't followed, and a final `**` doesn't match
+    the folder itself.
+    """
+
+    def __init__(self):
+        self.listings = {}  # absolute folder -> (signature, [(name, is_dir, is_link)])
+        self.lock = threading.Lock()
+
+    def listdir(self, folder, visited=None):
+        """
+        List a folder, from the cache if it hasn't changed.
+
+        @param str folder Folder to list ('' for the working folder)
+        @param dict visited If given, the folder's signature is added to it
+        @return list[tuple] (name, is_dir, is_link) for each entry, sorted
+        """
+        key = os.path.abspath(folder or os.curdir)
+        signature = dir_signature(key)
+        racy = signature is not None and time.time_ns() - signature[0] < RACY_NS
+        if visited is not None:
+            visited[key] = RACY_SIGNATURE if racy else signature
+        if signature is None:
+            return []
+        with self.lock:
+            hit = self.listings.get(key)
+        if hit and hit[0] == signature:
+            return hit[1]
+        entries = []
+        try:
+            with os.scandir(key) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                        is_link = entry.is_symlink()
+                    except OSError:
+                        is_dir, is_link = False, False
+                    entries.append((entry.name, is_dir, is_link))
+        except OSError:
+            pass
+        entries.sort()
+        if not racy:
+            with self.lock:
+                self.listings[key] = (signature, entries)
+        return entries
+
+    def subdirs(self, base, visited=None, parents=()):
+        """
+        @param tuple parents Real paths of the folders above, to avoid
+            looping through symlinks
+        @return list[str] base, and every folder below it (for `**`)
+        """
+        parents = parents + (os.path.realpath(base or os.curdir),)
+        found = [base]
+        for name, is_dir, is_link in self.listdir(base, visited):
+            if not is_dir or name.startswith("."):
+                continue
+            path = join(base, name)
+            if is_link and os.path.realpath(path) in parents:
+                continue
+            found.extend(self.subdirs(path, visited, parents))
+        return found
+
+    def match_part(self, base, part, last, visited):
+        """
+        Match one component of a pattern inside a folder.
+
+        @return list[str] Matching paths
+        """
+        if part in [os.curdir, os.pardir]:
+            return [join(base, part)] if os.path.isdir(base or os.curdir) else []
+        if part == "**":
+            folders = self.subdirs(base, visited)
+            if not last:
+                return folders
+            # A final ** matches everything below the folder
+            return [
+                join(folder, name)
+                for folder in folders
+                for name, is_dir, is_link in self.listdir(folder, visited)
+                if not name.startswith(".")
+            ]
+        entries = self.listdir(base, visited)
+        if has_magic(part):
+            names = [name for name, is_dir, is_link in entries if last or is_dir]
+            if not part.startswith("."):
+                names = [name for name in names if not name.startswith(".")]
+            return [join(base, name) for name in fnmatch.filter(names, part)]
+        for name, is_dir, is_link in entries:
+            if name == part and (last or is_dir):
+                return [join(base, name)]
+        return []
+
+    def glob(self, pattern, visited=None):
+        """
+        Find the paths matching a glob pattern.
+
+        @param str pattern Glob pattern, like 'posts/**/*.md'
+        @param dict visited If given, the signatures of all the folders the
+            result depends on are added to it (see `is_fresh`)
+        @return list[str] Matching paths, sorted
+        """
+        parts = pattern.split(os.sep)
+        first_magic = next((i for i, p in enumerate(parts) if has_magic(p)), None)
+        if first_magic is None:
+            # No wildcards: just check that the path exists
+            self.listdir(os.path.dirname(pattern), visited)
+            return [pattern] if os.path.lexists(pattern) else []
+        prefix = os.sep.join(parts[:first_magic])
+        if not prefix and pattern.startswith(os.sep):
+            prefix = os.sep
+        parts = [p for p in parts[first_magic:] if p]
+        paths = [prefix]
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            paths = [
+                path
+                for base in paths
+                for path in self.match_part(base, part, last, visited)
+            ]
+        return sorted(set(paths))
+
+    @staticmethod
+    def is_fresh(visited):
+        """
+        Would globs give the same results as when these folders were visited?
+
+        @param dict visited Folder signatures, collected by `glob`
+        """
+        return all(dir_signature(path) == sig for path, sig in visited.items())
+
+    def export(self, folders):
+        """
+        @param Iterable[str] folders Absolute paths of folders
+        @return dict Cached listings of these folders, to persist
+        """
+        with self.lock:
+            return {f: self.listings[f] for f in folders if f in self.listings}
+
+    def load(self, listings):
+        """
+        Add persisted listings (from `export`) to the index. Listings of
+        folders that have changed since are ignored when used.
+        """
+        with self.lock:
+            for folder, listing in listings.items():
+                self.listings.setdefault(folder, listing)
+
+
+# Shared by everything that expands globs in this process
+GLOB_INDEX = GlobIndex()
+
+
+def expand_glob(pattern, visited=None):
+    """
+    Find the paths matching a glob pattern, using the shared GlobIndex.
+
+    @param str pattern Glob pattern, like 'posts/**/*.md'
+    @param dict visited If given, collects the signatures of the folders the
+        result depends on
+    @return list[str] Matching paths, sorted
+    """
+    return GLOB_INDEX.glob(pattern, visited)
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from logging import getLogger
+
+from .const import PKG_NAME
+from .exceptions import RemoteFileError
+from .utilities import atomic_write, get_cache_dir
+
+_LOGGER = getLogger(PKG_NAME)
+
+# Settings for fetching remote files. The CLI updates these from its arguments.
+# ttl: seconds a cached copy is used without checking back with the server
+#   (by default, every run checks, with a conditional request)
+# offline: serve only from the cache, never touch the network
+# timeout: seconds to wait for the server
+# run_started: when the current command started; remote files fetched since
+#   are reused for the rest of the command (see is_fresh)
+HTTP_CACHE_SETTINGS = {"ttl": 0, "offline": False, "timeout": 30, "run_started": 0}
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def get_session():
+    """
+    Get a requests Session shared by all fetches, so connections are pooled.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            import requests
+
+            _SESSION = requests.Session()
+    return _SESSION
+
+
+def is_fresh(fetched):
+    """
+    @param float fetched When a remote file was fetched (or revalidated)
+    @return bool Whether a copy of it kept in memory can be reused without
+        checking back with the server: during the same command, or within
+        the TTL
+    """
+    if fetched >= HTTP_CACHE_SETTINGS["run_started"]:
+        return True
+    return time.time() - fetched < HTTP_CACHE_SETTINGS["ttl"]
+
+
+def cache_paths(url):
+    """
+    Paths to the cached body and metadata for a URL.
+    """
+    key = hashlib.sha256(url.encode()).hexdigest()
+    cache_dir = get_cache_dir("http")
+    return os.path.join(cache_dir, key), os.path.join(cache_dir, f"{key}.json")
+
+
+def read_cached(url):
+    """
+    @return (str, dict) | (None, None) The cached body and its metadata, if any
+    """
+    body_path, meta_path = cache_paths(url)
+    if not os.path.isfile(body_path) or not os.path.isfile(meta_path):
+        return None, None
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        with open(body_path, "r", encoding="utf-8") as f:
+            body = f.read()
+    except (OSError, ValueError) as e:
+        _LOGGER.debug(f"MM | Ignoring unreadable cache entry for {url}: {e}")
+        return None, None
+    return body, meta
+
+
+def write_cached(url, body, meta):
+    body_path, meta_path = cache_paths(url)
+    try:
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        if body is not None:
+            with atomic_write(body_path, "w", encoding="utf-8") as f:
+                f.write(body)
+        with atomic_write(meta_path) as f:
+            json.dump(meta, f)
+    except OSError as e:
+        _LOGGER.warning(f"MM | Couldn't cache remote file {url}: {e}")
+
+
+def fetch_url(url):
+    """
+    Fetch the text of a remote file, through markmeld's on-disk HTTP cache.
+
+    A cached copy younger than the TTL (by default, 0) is used as-is. Older
+    copies are revalidated with a conditional request (ETag / Last-Modified).
+    If the server can't be reached, a stale cached copy is used with a
+    warning. In offline mode, only the cache is used.
+
+    @param str url URL to fetch
+    @return str Text of the remote file
+    """
+    body, meta = read_cached(url)
+    if HTTP_CACHE_SETTINGS["offline"]:
+        if body is None:
+            raise RemoteFileError(f"Offline, and no cached copy of: {url}")
+        _LOGGER.info(f"MM | Offline; using cached copy of: {url}")
+        return body
+
+    if body is not None and time.time() - meta["fetched"] < HTTP_CACHE_SETTINGS["ttl"]:
+        _LOGGER.debug(f"MM | Using cached copy of: {url}")
+        return body
+
+    import requests
+
+    headers = {}
+    if body is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    _LOGGER.info(f"MM | Fetching: {url}")
+    try:
+        response = get_session().get(
+            url, headers=headers, timeout=HTTP_CACHE_SETTINGS["timeout"]
+        )
+    except requests.RequestException as e:
+        if body is not None:
+            _LOGGER.warning(f"MM | Couldn't fetch {url} ({e}); using cached copy")
+            return body
+        raise RemoteFileError(f"Couldn't fetch {url}: {e}")
+
+    if response.status_code == 304 and body is not None:
+        meta["fetched"] = time.time()
+        write_cached(url, None, meta)
+        return body
+    if not response.ok:
+        if body is not None:
+            _LOGGER.warning(
+                f"MM | Couldn't fetch {url} (HTTP {response.status_code}); using cached copy"
+            )
+            return body
+        raise RemoteFileError(f"Couldn't fetch {url}: HTTP {response.status_code}")
+
+    meta = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "fetched": time.time(),
+    }
+    write_cached(url, response.text, meta)
+    return response.text
@@ -1,15 +1,24 @@
 import datetime
+import fnmatch
 import frontmatter
 import jinja2
+import json
 import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import yaml
 
-from copy import deepcopy
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from collections import ChainMap
+from copy import copy, deepcopy
 
 from datetime import date
+from functools import partial
+from itertools import chain
 from jinja2 import Template
 from jinja2.filters import FILTERS, pass_environment
 from logging import getLogger
@@ -17,8 +26,15 @@ from logging import getLogger
 from ubiquerg import expandpath
 from ubiquerg import is_url
 
+from .build_state import TIME_KEYS, BuildState, build_digest, input_digest
+from .command_template import CommandFormatter
 from .const import PKG_NAME
 from .exceptions import *
+from .http_cache import fetch_url, is_fresh
+from .profiling import profile_phase
+from .servers import run_on_server, uses_server
+from .sharding import in_shard
+from .template_analysis import JINJA_SYNTAX, command_keys, source_keys, string_keys
 from .utilities import *
 
 MD_FILES_KEY = "md_files"
@@ -81,23 +97,27 @@ def get_frontmatter_formats(frontmatter):
 
     @param dict frontmatter A dict representing some yaml frontmatter for a md file
     """
-    if len(frontmatter) == 0:
-        frontmatter_raw = ""
-        frontmatter_fenced = ""
-    else:
-        frontmatter_raw = yaml.dump(frontmatter)
-        frontmatter_fenced = f"---\n{frontmatter_raw}---\n"
+    formats = LazyDict(raw="", fenced="", dict=frontmatter)
+    if len(frontmatter) > 0:
+        # The yaml versions are only dumped if a template uses them
+        formats.set_lazy("raw", lambda: yaml.dump(frontmatter, Dumper=YAML_DUMPER))
+        formats.set_lazy("fenced", lambda: f"---\n{formats['raw']}---\n")
+    return formats
 
-    return {
-        "raw": frontmatter_raw,
-        "fenced": frontmatter_fenced,
-        "dict": frontmatter,
-    }
 
+def process_data(data_block, filepath, keys=None):
+    """
+    Load the input files of a data block, and build the template variables.
 
-def process_data(data_block, filepath):
+    @param dict data_block The target's `data`
+    @param str filepath Path the input files are relative to
+    @param Container keys If given, only keyed files with these keys are
+        loaded (unkeyed yaml files are always loaded)
+    @return dict Template variables
+    """
     _LOGGER.info(f"MM | Processing data block...")
-    data = {"_raw": {}, "_md": {}, "_yaml": {}}  # Initialize return value
+    # Initialize return value. The _raw views are computed only if used.
+    data = {"_raw": LazyDict(), "_md": {}, "_yaml": {}}
     frontmatter_temp = {}
     local_frontmatter_temp = {}
     vars_temp = {}
@@ -122,51 +142,54 @@ def process_data(data_block, filepath):
     if YAML_FILES_KEY in data_block and data_block[YAML_FILES_KEY]:
         yaml_files.update(data_block[YAML_FILES_KEY])
 
-    for k, v in yaml_files.items():
-        _LOGGER.info(f"MM | Processing yaml file {k}: {v}")
-        vabs = make_abspath(v, filepath)
-        if not os.path.exists(vabs):
-            _LOGGER.error(f"File not found: {vabs}")
+    if keys is not None:
+        skipped = {
+            k
+            for k in chain(md_files, yaml_files)
+            if k not in keys and k not in unkeyed_yaml_files
+        }
+        if skipped:
+            _LOGGER.info(f"MM | Not loading unreferenced data: {sorted(skipped)}")
+        md_files = {k: v for k, v in md_files.items() if k not in skipped}
+        yaml_files = {k: v for k, v in yaml_files.items() if k not in skipped}
+
+    # Read and parse all input files concurrently; then merge them in order
+    # below, so the merge order is the same as a serial load.
+    loaders = [partial(load_yaml_input, k, v, filepath) for k, v in yaml_files.items()]
+    loaders += [partial(load_md_input, k, v, filepath) for k, v in md_files.items()]
+    loaded = parallel_map(lambda load: load(), loaders)
+    yaml_loaded = loaded[: len(yaml_files)]
+    md_loaded = loaded[len(yaml_files) :]
+
+    for (k, v), yaml_dict in zip(yaml_files.items(), yaml_loaded):
+        if yaml_dict is MISSING:
+            continue
+        _LOGGER.debug(yaml_dict)
+        # data[k] = yaml_dict
+        if k in unkeyed_yaml_files:
+            data.update(yaml_dict)
+            data["_yaml"].update(yaml_dict)
         else:
-            with open(vabs, "r") as f:
-                yaml_dict = yaml.load(f, Loader=yaml.SafeLoader)
-                _LOGGER.debug(yaml_dict)
-                # data[k] = yaml_dict
-                if k in unkeyed_yaml_files:
-                    data.update(yaml_dict)
-                    data["_yaml"].update(yaml_dict)
-                else:
-                    data[k] = yaml_dict
-                    # data["_yaml"][k] = yaml_dict
-                    data["_yaml"][k] = {
-                        "content": yaml_dict,
-                        "path": os.path.relpath(v, os.path.dirname(filepath)),
-                        "ext": get_file_extension(v),
-                    }
-                    vars_temp[k] = yaml_dict
-                data["_raw"][k] = yaml.dump(yaml_dict)
-                if k[:11] == "frontmatter":
-                    frontmatter_temp.update(yaml_dict)
-
-    for k, v in md_files.items():
-        _LOGGER.info(f"MM | Processing md file {k}:{v}")
+            data[k] = yaml_dict
+            # data["_yaml"][k] = yaml_dict
+            data["_yaml"][k] = {
+                "content": yaml_dict,
+                "path": os.path.relpath(v, os.path.dirname(filepath)),
+                "ext": get_file_extension(v),
+            }
+            vars_temp[k] = yaml_dict
+        data["_raw"].set_lazy(k, partial(yaml.dump, yaml_dict, Dumper=YAML_DUMPER))
+        if k[:11] == "frontmatter":
+            frontmatter_temp.update(yaml_dict)
+
+    for (k, v), p in zip(md_files.items(), md_loaded):
         if not v:
             data[k] = v
             continue
-        if is_url(v):  # Do url stuff
-            import requests
-
-            response = requests.get(v)
-            p = frontmatter.loads(response.text)
-        else:
-            vabs = make_abspath(v, filepath)
-            if os.path.exists(vabs):
-                p = frontmatter.load(vabs)
-            else:
-                _LOGGER.warning(f"Skipping file that does not exist: {vabs}")
-                data[k] = ""  # Populate with empty values
-                data["_raw"][k] = {}
-                continue
+        if p is MISSING:
+            data[k] = ""  # Populate with empty values
+            data["_raw"][k] = {}
+            continue
         data[k] = p.content
         # data["_md"][k] = p.content
 
@@ -178,7 +201,7 @@ def process_data(data_block, filepath):
         }
         frontmatter_temp.update(p.metadata)
         local_frontmatter_temp[k] = p.metadata
-        data["_raw"][k] = frontmatter.dumps(p)
+        data["_raw"].set_lazy(k, partial(frontmatter.dumps, p))
         # data["md_dict"][k] = p.__dict__
         # data[k]["all"] = frontmatter.dumps(p)
         # _LOGGER.debug(data["md"][k])
@@ -214,6 +237,42 @@ def process_data(data_block, filepath):
     return data
 
 
+# Marks an input file that doesn't exist
+MISSING = object()
+
+
+def load_yaml_input(k, v, filepath):
+    """
+    Read and parse one yaml input file of a data block.
+
+    @return dict|MISSING The parsed yaml data
+    """
+    _LOGGER.info(f"MM | Processing yaml file {k}: {v}")
+    vabs = make_abspath(v, filepath)
+    if not os.path.exists(vabs):
+        _LOGGER.error(f"File not found: {vabs}")
+        return MISSING
+    return load_yaml_file(vabs)
+
+
+def load_md_input(k, v, filepath):
+    """
+    Read and parse one markdown input file (local or URL) of a data block.
+
+    @return frontmatter.Post|MISSING|None The parsed file; None if no path was given
+    """
+    _LOGGER.info(f"MM | Processing md file {k}:{v}")
+    if not v:
+        return None
+    if is_url(v):  # Do url stuff
+        return frontmatter.loads(fetch_url(v))
+    vabs = make_abspath(v, filepath)
+    if not os.path.exists(vabs):
+        _LOGGER.warning(f"Skipping file that does not exist: {vabs}")
+        return MISSING
+    return cached_parse(vabs, frontmatter.load, "md")
+
+
 def get_file_extension(path):
     basename = os.path.basename(path)
     splitext = os.path.splitext(basename)
@@ -221,41 +280,158 @@ def get_file_extension(path):
     return ext
 
 
+class TemplateLoader(jinja2.BaseLoader):
+    """
+    Loads jinja templates by absolute path or URL, as resolved from a
+    target's `jinja_template` (and `mm_templates`).
+
+    Local templates are considered up to date as long as their modification
+    time doesn't change; remote templates, for the rest of the command, or
+    as long as the HTTP cache reuses them without checking (its `ttl`).
+    """
+
+    def __init__(self):
+        self.sources = {}
+
+    def get_source(self, environment, template):
+        if is_url(template):
+            contents = fetch_url(template)
+            self.sources[template] = contents
+            fetched = time.time()
+            return contents, None, lambda: is_fresh(fetched)
+
+        if not os.path.isfile(template):
+            raise jinja2.TemplateNotFound(template)
+        mtime = os.path.getmtime(template)
+        with open(template, "r") as f:
+            contents = f.read()
+        self.sources[template] = contents
+
+        def uptodate():
+            try:
+                return os.path.getmtime(template) == mtime
+            except OSError:
+                return False
+
+        return contents, template, uptodate
+
+
+_TEMPLATE_ENV = None
+_TEMPLATE_ENV_LOCK = threading.Lock()
+
+
+def get_template_env():
+    """
+    Get the jinja Environment shared by all markmeld renders.
+
+    Compiled templates are cached in memory by the environment, and their
+    bytecode is cached on disk (in the markmeld cache folder), so repeated
+    renders and repeated runs compile each template only once.
+    """
+    global _TEMPLATE_ENV
+    with _TEMPLATE_ENV_LOCK:
+        if _TEMPLATE_ENV is None:
+            bytecode_cache = None
+            bytecode_dir = get_cache_dir("jinja")
+            try:
+                os.makedirs(bytecode_dir, exist_ok=True)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dir)
+            except OSError as e:
+                _LOGGER.debug(f"MM | Not caching template bytecode: {e}")
+            _TEMPLATE_ENV = jinja2.Environment(
+                loader=TemplateLoader(),
+                bytecode_cache=bytecode_cache,
+                auto_reload=True,
+            )
+    return _TEMPLATE_ENV
+
+
 def load_template(cfg):
     if "jinja_template" not in cfg or not cfg["jinja_template"]:
         return None
 
-    jinja_tpl = None
-    root = cfg["mm_templates"] if "mm_templates" in cfg else None
-    jinja_tpl = make_abspath(cfg["jinja_template"], cfg["_cfg_file_path"], root)
+    jinja_tpl = get_template_path(cfg)
     _LOGGER.info(f"MM | jinja template: {jinja_tpl}")
-    # # if os.path.isfile(cfg["md_template"]):
-    # #     jinja_tpl = cfg["md_template"]
-    # if "mm_templates" in cfg:
-    #     jinja_tpl = os.path.join(cfg["mm_templates"], cfg["md_template"])
-    # else:
-    #     jinja_tpl = os.path.join(, cfg["md_template"])
 
-    try:
-        if is_url(jinja_tpl):
-            import requests
+    if not is_url(jinja_tpl) and not os.path.isfile(jinja_tpl):
+        _LOGGER.debug(cfg)
+        raise Exception(f"jinja_template file not found: {jinja_tpl}")
 
-            response = requests.get(jinja_tpl)
-            jinja_tpl_contents = response.text
-        else:
-            if not os.path.isfile(jinja_tpl):
-                _LOGGER.debug(cfg)
-                raise Exception(f"jinja_template file not found: {jinja_tpl}")
-
-            with open(jinja_tpl, "r") as f:
-                jinja_tpl_contents = f.read()
-        t = Template(jinja_tpl_contents)
-        t.source = jinja_tpl_contents
-    except TypeError:
-        _LOGGER.error(f"Unable to open jinja_template. Path:{jinja_tpl}")
+    env = get_template_env()
+    t = env.get_template(jinja_tpl)
+    t.source = env.loader.sources[jinja_tpl]
+    return t
+
+
+def load_generic_template():
+    env = get_template_env()
+    t = env.from_string(tpl_generic)
+    t.source = tpl_generic
     return t
 
 
+def find_template_strings(data):
+    """
+    Find the strings in (nested) template variables that contain jinja
+    syntax, and compile each of them once.
+
+    Lazily computed values (like `_raw`) are not searched.
+
+    @param Mapping data Template variables
+    @return dict A tree following the structure of the data: for each key
+        (or list index) holding a jinja string, the compiled template; for
+        each key holding a container with jinja strings, a subtree.
+    """
+    env = get_template_env()
+
+    def walk(value):
+        if isinstance(value, str):
+            if not JINJA_SYNTAX.search(value):
+                return None
+            try:
+                return env.from_string(value)
+            except jinja2.TemplateSyntaxError as e:
+                _LOGGER.debug("MM | Not rendering variable with invalid jinja: %s", e)
+                return None
+        if isinstance(value, LazyDict):
+            return None
+        if isinstance(value, (dict, ChainMap)):
+            items = value.items()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            return None
+        tree = {}
+        for key, item in items:
+            subtree = walk(item)
+            if subtree is not None:
+                tree[key] = subtree
+        return tree or None
+
+    return walk(data) or {}
+
+
+def prerender_strings(data, tree, context):
+    """
+    Render the jinja strings found by find_template_strings.
+
+    The data is not modified: containers holding rendered strings are
+    shallow-copied.
+
+    @param dict|list data The (nested) template variables
+    @param dict tree Jinja strings in the data, from find_template_strings
+    @param Mapping context Variables to render the strings with
+    @return dict|list Copy of the data, with the strings rendered
+    """
+    rendered = list(data) if isinstance(data, list) else dict(data)
+    for key, subtree in tree.items():
+        if isinstance(subtree, dict):
+            rendered[key] = prerender_strings(data[key], subtree, context)
+        else:
+            rendered[key] = subtree.render(context)
+    return rendered
+
+
 class Target(object):
     """
     Holds 2 dicts: Original cfg data, and specific metadata for a target.
@@ -267,21 +443,33 @@ class Target(object):
     Therefore, I should merge these into one concept.
     """
 
-    def __init__(self, root_cfg={}, target_name=None, vardata=None):
+    def __init__(self, root_cfg={}, target_name=None, vardata=None, inheritance=None):
+        """
+        @param dict root_cfg Loaded markmeld configuration
+        @param str target_name Name of the target
+        @param list[str] vardata Variables from the command line, as 'key=value'
+        @param InheritanceResolver inheritance Resolver to share between the
+            targets of a run, so shared bases are resolved only once
+        """
         self.root_cfg = root_cfg
         self.target_name = target_name
+        self.inheritance = inheritance or InheritanceResolver(root_cfg)
 
         # Initialize some local variables
         self.messages = []  # A list of messages
         self.returncode = None
+        self.template_strings = None  # Variables with jinja, for selective rendering
+        self.uses_time = True  # Output depends on the build date; see build_digest
+        self.loop_key = None  # Iterations hashed by their loop value; see build_digest
 
         meta = {}
         # Old way would update based on root config:
         # meta.update(self.root_cfg)
-        meta["_now"] = date.today().strftime("%s")
-        meta["_today"] = date.today().strftime("%Y-%m-%d")
-        meta["today"] = meta["_today"]  # TODO: Remove this
-        meta["now"] = meta["_now"]  # TODO: Remove this
+        defaults = {}
+        defaults["_now"] = date.today().strftime("%s")
+        defaults["_today"] = date.today().strftime("%Y-%m-%d")
+        defaults["today"] = defaults["_today"]  # TODO: Remove this
+        defaults["now"] = defaults["_now"]  # TODO: Remove this
 
         # Since a target has available to it all the variables in the _markmeld.yaml
         # config file, we start from there, then make a few changes:
@@ -300,8 +488,14 @@ class Target(object):
                 error_msg = f"Target {target_name} not found"
                 _LOGGER.error(error_msg)
                 raise TargetError(error_msg)
-            meta = deep_update(meta, self.resolve_target_inheritance(target_name))
+            with profile_phase("inheritance", target=target_name):
+                inherited = self.resolve_target_inheritance(target_name)
+            # Copy-on-write: the resolved config is shared by every Target
+            # built from it, and only what this one changes is copied
+            meta = LayeredDict(inherited)
             _LOGGER.debug(f'Config for this target: {root_cfg["targets"][target_name]}')
+        for k, v in defaults.items():
+            meta.setdefault(k, v)
 
         # del meta["targets"]
         meta["_cfg_file_path"] = root_cfg["_cfg_file_path"]
@@ -332,46 +526,129 @@ class Target(object):
             _LOGGER.info(f"MM | Output file: {self.meta['output_file']}")
 
     def __repr__(self):
-        return yaml.dump(self.__dict__["meta"], default_flow_style=False)
+        return yaml.dump(
+            thaw(self.__dict__["meta"]), Dumper=YAML_DUMPER, default_flow_style=False
+        )
         # import json
         # return json.dumps(self.__dict__, sort_keys=True, indent=4)
 
+    def overlay(self, variables):
+        """
+        Create a lightweight copy of this target with some variables added,
+        as used for each iteration of a loop target.
+
+        The copy shares the (read-only) config, metadata and melded input of
+        this target; its own `meta` and `melded_input` are overlays that hold
+        only the added variables and anything set on the copy later.
+
+        @param dict variables Variables to add to the meta and melded input
+        @return Target The overlaid copy
+        """
+        tgt = copy(self)
+        tgt.meta = ChainMap(dict(variables), self.meta)
+        if hasattr(self, "melded_input"):
+            tgt.melded_input = ChainMap(dict(variables), self.melded_input)
+        tgt.messages = []
+        tgt.returncode = None
+        return tgt
+
     def add_message(self, message, status="success"):
         if status == "fail":
             _LOGGER.warning(message)
         self.messages.append({"status": status, "message": message})
 
     def resolve_target_inheritance(self, target_name):
+        return self.inheritance.resolve(target_name)
+
+
+class InheritanceResolver(object):
+    """
+    Resolves `inherit_from` for the targets of a config, remembering each
+    resolved target, so that bases shared by many targets (or reached more
+    than once through diamond inheritance) are resolved only once.
+
+    Resolved targets are handed out frozen (see `freeze`), so callers can't
+    change the remembered results. Wrap them in a `LayeredDict` for a
+    modifiable view that copies only what's changed, or `thaw` them for a
+    full copy.
+    """
+
+    def __init__(self, root_cfg):
+        self.root_cfg = root_cfg
+        self.merged = {}  # Never handed out, so they can share lists
+        self.frozen = {}
+        self.lock = threading.RLock()
+
+    def resolve(self, target_name):
+        """
+        @param str target_name Name of the target to resolve
+        @return Mapping The target's variables, merged over those of its
+            bases (in order), read-only
+        """
+        with self.lock:
+            if target_name not in self.frozen:
+                self.frozen[target_name] = freeze(self.merge(target_name))
+            return self.frozen[target_name]
+
+    def merge(self, target_name, path=()):
+        """
+        Merge a target over its bases, recursively.
+
+        @param str target_name Name of the target to resolve
+        @param tuple path Targets whose inheritance led here, to detect cycles
+        @return dict The target's variables, merged over those of its bases
+        """
         root_cfg = self.root_cfg
         if "targets" not in root_cfg:
             error_msg = f"No targets specified in config."
             _LOGGER.debug(error_msg)
             return {}
-        if target_name not in list(root_cfg["targets"].keys()):
+        if target_name not in root_cfg["targets"]:
             error_msg = f"Target inherits from target '{target_name}', which was not found. Did you forget an import?"
             _LOGGER.error(error_msg)
             raise TargetError(error_msg)
-            # return {}
-        # _LOGGER.debug(f"Root cft targets: {root_cfg['targets']}")
+        if target_name in path:
+            cycle = path[path.index(target_name) :] + (target_name,)
+            error_msg = f"Circular inheritance: {' -> '.join(cycle)}"
+            _LOGGER.error(error_msg)
+            raise TargetError(error_msg)
 
-        if "inherit_from" not in root_cfg["targets"][target_name]:
-            ## base case
-            return root_cfg["targets"][target_name]
-        else:
-            ## recurse
-            accumulated = {}
-            # root_cfg["targets"][target_name]
-            inherit_from = root_cfg["targets"][target_name]["inherit_from"]
-            # del accumulated["inherit_from"]
-            if type(inherit_from) is not list:
-                inherit_from = [inherit_from]
-            for base_target in inherit_from:
-                _LOGGER.info(f"Loading from base target: {base_target}")
-                base_target_data = self.resolve_target_inheritance(base_target)
-                accumulated = deep_update(accumulated, base_target_data)
-
-            accumulated = deep_update(accumulated, root_cfg["targets"][target_name])
-            return accumulated
+        with self.lock:
+            if target_name in self.merged:
+                return self.merged[target_name]
+            target_cfg = root_cfg["targets"][target_name]
+            if "inherit_from" not in target_cfg:
+                ## base case
+                merged = target_cfg
+            else:
+                merged = {}
+                inherit_from = target_cfg["inherit_from"]
+                if type(inherit_from) is not list:
+                    inherit_from = [inherit_from]
+                for base_target in inherit_from:
+                    _LOGGER.info(f"Loading from base target: {base_target}")
+                    base_target_data = self.merge(base_target, path + (target_name,))
+                    merged = deep_update(merged, base_target_data)
+                merged = deep_update(merged, target_cfg)
+            self.merged[target_name] = merged
+            return merged
+
+
+def result_returncode(result):
+    """
+    Summarize the result of a build as one return code.
+
+    @param Target|dict|None result A built target, a dict of them (loop
+        targets), or None if the build raised an error
+    @return int 0 if everything succeeded, otherwise the first failing code
+    """
+    if result is None:
+        return 1
+    results = result.values() if isinstance(result, dict) else [result]
+    for tgt in results:
+        if tgt.returncode:
+            return tgt.returncode
+    return 0
 
 
 class MarkdownMelder(object):
@@ -379,16 +656,36 @@ class MarkdownMelder(object):
     Workhorse class, capable of building targets
     """
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, jobs=None, incremental=False, shard=None):
         """
         Instantiate a MarkdownMelder object
+
+        @param dict cfg Loaded markmeld configuration
+        @param int jobs Number of parallel workers, for loop iterations (overriding
+            `loop.parallel` in targets), independent side targets, and the
+            targets of build_targets
+        @param bool incremental Skip commands whose outputs are up to date
+        @param tuple shard (K, N) to build only the K-th of N shards of the
+            loop iterations and target lists (see shard_targets)
         """
         _LOGGER.info("Initializing MarkdownMelder...")
         self.cfg = cfg
+        self.jobs = jobs
+        self.incremental = incremental
+        self.shard = shard
+        self.build_state = None
         self.target_objects = {}
+        # Targets resolved in this melder, shared by every Target it makes
+        self.inheritance = InheritanceResolver(cfg)
+        # Results of targets built in the current run, used to build each
+        # side target at most once per run
+        self.run_results = None
+        self.run_lock = threading.Lock()
+        if incremental:
+            self.build_state = BuildState(cfg["_cfg_file_path"])
 
     def open_target(self, target_name):
-        tgt = Target(self.cfg, target_name)
+        tgt = Target(self.cfg, target_name, inheritance=self.inheritance)
 
         if tgt.meta["output_file"] and not "stopopen" in tgt.meta:
             return tgt.meta["output_file"]
@@ -396,79 +693,322 @@ class MarkdownMelder(object):
             return False
 
     def describe_target(self, target_name):
-        tgt = Target(self.cfg, target_name)
+        tgt = Target(self.cfg, target_name, inheritance=self.inheritance)
         _LOGGER.info(f"MM | Describing target: {tgt.target_name}")
         _LOGGER.info(tgt)
         return True
 
     def build_target(self, target_name, print_only=False, vardump=False):
         """
-        @return [False|tgt] if the
+        Build a target, along with its prebuild and postbuild side targets.
+
+        The side targets are resolved up front into a dependency graph, and
+        every target in the graph is built at most once per run. Targets
+        that don't depend on each other are built in parallel if the melder
+        was given more than one job.
+
+        @param str target_name Name of the target to build
+        @param bool print_only Render the main target, but don't run its command
+        @param bool vardump Return the melded input of the main target instead of rendering it
+        @return Target|dict The built target, or a dict of targets for a loop target
+        """
+        with profile_phase("build_target", target=target_name):
+            tgt = Target(self.cfg, target_name, inheritance=self.inheritance)
+            _LOGGER.info(
+                f"MM | Building target: {tgt.target_name} from file {tgt.meta['_cfg_file_path']}"
+            )
+
+            with profile_phase("side_targets", target=target_name):
+                side_targets = self.resolve_side_targets(tgt)
+            if not side_targets:
+                _LOGGER.debug("Failed resolving side targets")
+                return tgt
+
+            owns_run = self.start_run()
+            try:
+                results = self.build_target_graph(
+                    tgt, side_targets, print_only, vardump
+                )
+            finally:
+                if owns_run:
+                    self.end_run()
+            if self.incremental:
+                self.build_state.save()
+            return results[tgt.target_name]
+
+    def match_targets(self, pattern="*"):
+        """
+        List the buildable (non-abstract) targets whose names match a glob pattern.
+
+        @param str pattern Shell-style pattern, like 'papers/*'
+        @return list[str] Matching target names, sorted
         """
-        tgt = Target(self.cfg, target_name)
-        _LOGGER.info(
-            f"MM | Building target: {tgt.target_name} from file {tgt.meta['_cfg_file_path']}"
+        if "targets" not in self.cfg:
+            raise TargetError(f"No targets specified in config.")
+        return sorted(
+            [
+                t
+                for t, v in self.cfg["targets"].items()
+                if "abstract" not in v and fnmatch.fnmatchcase(t, pattern)
+            ]
         )
 
-        # First, run any pre-builds
-        prebuild_results = self.build_side_targets(tgt, "prebuild")
-        if not prebuild_results:
-            _LOGGER.debug("Failed building prebuild side targets")
-            return tgt
+    def shard_targets(self, target_names):
+        """
+        Select the targets this melder's shard builds. Loop targets are kept
+        in every shard, since their iterations are split between shards;
+        other targets are assigned to a shard by a stable hash of their name.
 
-        # Next, meld the inputs. This can be time-consuming, it reads data to populate variables
-        tgt.melded_input = self.meld_inputs(tgt)
-        _LOGGER.debug(f"Melded input: {tgt.melded_input}")
-        if "loop" in tgt.meta:
-            return self.build_target_in_loop(tgt, print_only, vardump)
+        @param Iterable[str] target_names Names of targets
+        @return list[str] The targets to build in this shard
+        """
+        return [
+            t
+            for t in target_names
+            if in_shard(t, self.shard)
+            or "loop" in Target(self.cfg, t, inheritance=self.inheritance).meta
+        ]
+
+    def build_targets(self, target_names, print_only=False, vardump=False):
+        """
+        Build several targets in a single run, up to `jobs` at a time.
 
-        # Run command...
-        result = self.run_command_for_target(tgt, print_only, vardump)
+        Side targets shared by several of the targets are built only once.
+        A target that raises an error is reported as failed, without
+        stopping the others.
 
-        # Finally, run any postbuilds
-        postbuild_results = self.build_side_targets(tgt, "postbuild")
-        if not postbuild_results:
-            _LOGGER.debug("Failed building postbuild side targets")
-            return tgt
+        @param Iterable[str] target_names Names of targets to build
+        @return dict Maps each target name to a tuple of its build result
+            (None if it raised an error) and the seconds it took
+        """
+        target_names = list(target_names)
+        jobs = max(1, int(self.jobs)) if self.jobs else 1
+        _LOGGER.info(f"MM | Building {len(target_names)} targets. Workers: {jobs}")
+
+        def timed_build(target_name):
+            start = time.time()
+            try:
+                result = self.build_target(target_name, print_only, vardump)
+            except Exception as e:
+                _LOGGER.error(f"MM | Building target '{target_name}' failed: {e}")
+                _LOGGER.debug(e, exc_info=True)
+                result = None
+            return result, time.time() - start
+
+        owns_run = self.start_run()
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = {t: executor.submit(timed_build, t) for t in target_names}
+                results = {t: futures[t].result() for t in target_names}
+        finally:
+            if owns_run:
+                self.end_run()
+        return results
+
+    def start_run(self):
+        """
+        Start tracking which targets have been built, unless a run is already
+        in progress. Returns True if this call started the run.
+        """
+        with self.run_lock:
+            if self.run_results is not None:
+                return False
+            self.run_results = {}
+            return True
 
-        return result
+    def end_run(self):
+        with self.run_lock:
+            self.run_results = None
 
-    def build_side_targets(self, tgt, side_list_key="prebuild"):
+    def resolve_side_targets(self, tgt):
         """
-        Builds side targets for a target, which are prebuilds or postbuilds.
+        Resolve the graph of prebuild and postbuild side targets of a target.
 
         Side targets accompany a target, are built either before (prebuild)
-        or after (postbuild) a main target.
+        or after (postbuild) a main target. Side targets can have their own
+        side targets, so this follows them recursively.
 
-        @param tgt Target The main target to build
-        @param side_list_key Iterable[str] The key of the target that contains a list of side targets. e.g. "prebuild" or "postbuild"
+        @param Target tgt The main target to build
+        @return [False|(dict, dict)] False if a side target doesn't exist;
+            otherwise a dict of all targets in the graph (keyed by name), and
+            a dict mapping each target name to the names it must be built after.
         """
-        if side_list_key in tgt.meta:
-            _LOGGER.info(f"MM | Run {side_list_key} for target: {tgt.target_name}")
-            for side_tgt in tgt.meta[side_list_key]:
-                _LOGGER.info(f"MM | {side_list_key} target: {side_tgt}")
-                if side_tgt in self.cfg["targets"]:
-                    self.build_target(side_tgt)
-                    tgt.add_message(
-                        f"MM | Built {side_list_key} target '{side_tgt}' requested by target '{tgt.target_name}' from file '{tgt.meta['_cfg_file_path']}'",
-                        "success",
-                    )
-                else:
-                    tgt.add_message(
-                        f"MM | No target called '{side_tgt}', requested prebuild by target '{tgt.target_name}' from file '{tgt.meta['_cfg_file_path']}'",
-                        "fail",
-                    )
-                    return False
-        return True
+        nodes = {tgt.target_name: tgt}
+        deps = {tgt.target_name: []}
+        queue = [tgt]
+        while queue:
+            node = queue.pop(0)
+            for side_list_key in ["prebuild", "postbuild"]:
+                if side_list_key not in node.meta or not node.meta[side_list_key]:
+                    continue
+                _LOGGER.info(
+                    f"MM | Resolve {side_list_key} for target: {node.target_name}"
+                )
+                for side_name in node.meta[side_list_key]:
+                    _LOGGER.info(f"MM | {side_list_key} target: {side_name}")
+                    if side_name not in self.cfg["targets"]:
+                        tgt.add_message(
+                            f"MM | No target called '{side_name}', requested {side_list_key} by target '{node.target_name}' from file '{node.meta['_cfg_file_path']}'",
+                            "fail",
+                        )
+                        return False
+                    if side_name not in nodes:
+                        side_tgt = Target(
+                            self.cfg, side_name, inheritance=self.inheritance
+                        )
+                        side_tgt.requested_by = (node, side_list_key)
+                        nodes[side_name] = side_tgt
+                        deps[side_name] = []
+                        queue.append(side_tgt)
+                    if side_list_key == "prebuild":
+                        deps[node.target_name].append(side_name)
+                    else:
+                        deps[side_name].append(node.target_name)
+        return nodes, deps
+
+    @staticmethod
+    def order_target_graph(deps):
+        """
+        Order a target graph so each target comes after its dependencies.
+
+        Dependencies are visited depth-first in the order they are listed, so
+        a serial build follows the order of the `prebuild` lists.
+
+        @param dict deps Maps each target name to the names it must be built after
+        @return list[str] Target names in build order
+        """
+        order = []
+        state = {}  # 1 = visiting, 2 = done
+
+        def visit(name, path):
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                cycle = path[path.index(name) :] + [name]
+                msg = f"Circular side targets: {' -> '.join(cycle)}"
+                _LOGGER.error(msg)
+                raise TargetError(msg)
+            state[name] = 1
+            for dep in deps[name]:
+                visit(dep, path + [name])
+            state[name] = 2
+            order.append(name)
+
+        for name in deps:
+            visit(name, [])
+        return order
+
+    def build_target_graph(self, tgt, side_targets, print_only=False, vardump=False):
+        """
+        Build every target in a side-target graph, in dependency order.
+
+        @param Target tgt The main target
+        @param tuple side_targets Output of resolve_side_targets
+        @return dict Build results, keyed by target name
+        """
+        nodes, deps = side_targets
+        order = self.order_target_graph(deps)
+        jobs = max(1, int(self.jobs)) if self.jobs else 1
+        results = {}
+        pending = list(order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending or running:
+                ready = [n for n in pending if all(d in results for d in deps[n])]
+                for name in ready:
+                    pending.remove(name)
+                    if name == tgt.target_name:
+                        args = (nodes[name], print_only, vardump)
+                    else:
+                        args = (nodes[name],)
+                    running[executor.submit(self.build_graph_node, *args)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    if name != tgt.target_name:
+                        self.report_side_target(tgt, nodes[name], results[name])
+        return results
+
+    def build_graph_node(self, tgt, print_only=False, vardump=False):
+        """
+        Build a single target of a target graph, unless it was already built
+        (or is being built) in the current run.
+        """
+        with self.run_lock:
+            if self.run_results is not None and tgt.target_name in self.run_results:
+                future = self.run_results[tgt.target_name]
+                owner = False
+            else:
+                future = Future()
+                owner = True
+                if self.run_results is not None:
+                    self.run_results[tgt.target_name] = future
+        if not owner:
+            _LOGGER.info(f"MM | Already built in this run: {tgt.target_name}")
+            return future.result()
+        try:
+            future.set_result(self.build_single_target(tgt, print_only, vardump))
+        except Exception as e:
+            future.set_exception(e)
+        return future.result()
+
+    def report_side_target(self, tgt, side_tgt, result):
+        """
+        Add a message to the main target about a side target that was built.
+        """
+        requester, side_list_key = side_tgt.requested_by
+        results = result.values() if isinstance(result, dict) else [result]
+        failed = any(r.returncode not in [None, 0] for r in results)
+        verb = "Failed building" if failed else "Built"
+        tgt.add_message(
+            f"MM | {verb} {side_list_key} target '{side_tgt.target_name}' requested by target '{requester.target_name}' from file '{requester.meta['_cfg_file_path']}'",
+            "fail" if failed else "success",
+        )
+
+    def build_single_target(self, tgt, print_only=False, vardump=False):
+        """
+        Build a target without its side targets.
+
+        @return Target|dict The built target, or a dict of targets for a loop target
+        """
+        loop_key = None
+        if "loop" in tgt.meta:
+            loop_key = tgt.meta["loop"]["loop_data"].split(".")[0]
+        if self.incremental:
+            # Hash the input files once; loop iterations share the digest
+            tgt.input_digest, tgt.loop_data_digest = input_digest(tgt, loop_key)
+
+        # Meld the inputs. This can be time-consuming, it reads data to populate variables
+        with profile_phase("meld_inputs", target=tgt.target_name):
+            # A variable dump shows all the data, used or not
+            tgt.melded_input = self.meld_inputs(tgt, lazy=not vardump)
+        _LOGGER.debug("Melded input: %s", tgt.melded_input)
+        if self.incremental:
+            keys = self.get_output_keys(tgt)
+            tgt.uses_time = keys is None or any(k in keys for k in TIME_KEYS)
+            if loop_key is not None and keys is not None and loop_key not in keys:
+                # The output reads the loop data only through the loop value
+                tgt.loop_key = loop_key
+        if self.get_render_mode(tgt) == "selective":
+            # Find variables with jinja once; loop iterations share them
+            tgt.template_strings = find_template_strings(tgt.melded_input)
+        if "loop" in tgt.meta:
+            return self.build_target_in_loop(tgt, print_only, vardump)
+
+        # Run command...
+        return self.run_command_for_target(tgt, print_only, vardump)
 
     def run_command_for_target(self, tgt, print_only, vardump=False):
         _LOGGER.info(f"Defined path for this target: {tgt.meta['_defpath']}")
         _LOGGER.info(f"Working path for this target: {tgt.meta['_workpath']}")
         if "type" in tgt.meta and tgt.meta["type"] == "raw":
             # Raw = No subprocess stdin printing. (so, it doesn't render anything)
+            format_output_file(tgt)
             cmd_fmt = format_command(tgt)
             tgt.melded_output = None
-            tgt.returncode = run_cmd(cmd_fmt, None, tgt.meta["_workpath"])
+            with profile_phase("run_cmd", target=tgt.target_name):
+                tgt.returncode = run_cmd(cmd_fmt, None, tgt.meta["_workpath"])
         elif "type" in tgt.meta and tgt.meta["type"] == "meta":
             # Meta = No command, it's a meta-target used for prebuilds or something else
             tgt.melded_output = None
@@ -479,55 +1019,273 @@ class MarkdownMelder(object):
             tgt.melded_output = self.render_template(tgt.melded_input, tgt)
             tgt.returncode = 0
         elif vardump:
-            tgt.melded_output = tgt.melded_input
+            tgt.melded_output = dict(tgt.melded_input)
             tgt.returncode = 0
         elif tgt.meta["command"]:
+            format_output_file(tgt)
             cmd_fmt = format_command(tgt)
             _LOGGER.debug(cmd_fmt)
+            if self.incremental:
+                digest = build_digest(tgt, cmd_fmt)
+                if self.build_state.is_current(tgt, digest):
+                    tgt.melded_output = None
+                    tgt.returncode = 0
+                    tgt.add_message(
+                        f"MM | Target '{tgt.target_name}' is up to date: {tgt.meta['output_file']}",
+                        "success",
+                    )
+                    return tgt
+            if self.get_render_mode(tgt) != "double" and not uses_server(tgt):
+                # Stream the output into the command, never holding all of it
+                tgt.melded_output = None
+                chunks = self.stream_template(tgt.melded_input, tgt)
+                first = next((chunk for chunk in chunks if chunk), None)
+                if first is None:
+                    _LOGGER.error("No input detected. Check variable names")
+                    tgt.returncode = 2
+                else:
+                    # Rendering happens while the command runs, so the
+                    # command phase includes the render time
+                    with profile_phase(
+                        "run_cmd", target=tgt.target_name, streamed=True
+                    ):
+                        tgt.returncode = stream_cmd(
+                            cmd_fmt, chain([first], chunks), tgt.meta["_workpath"]
+                        )
+                if self.incremental and tgt.returncode == 0:
+                    self.build_state.record(tgt, digest)
+                return tgt
             tgt.melded_output = self.render_template(tgt.melded_input, tgt)
             _LOGGER.debug(f"melded_output: '{tgt.melded_output}'")
             if tgt.melded_output == "" or tgt.melded_output == None:
                 _LOGGER.error("No input detected. Check variable names")
                 tgt.returncode = 2
             else:
-                tgt.returncode = run_cmd(
-                    cmd_fmt, tgt.melded_output.encode(), tgt.meta["_workpath"]
-                )
+                stdin = tgt.melded_output.encode()
+                with profile_phase("run_cmd", target=tgt.target_name):
+                    tgt.returncode = run_on_server(tgt, cmd_fmt, stdin)
+                    if tgt.returncode is None:
+                        tgt.returncode = run_cmd(cmd_fmt, stdin, tgt.meta["_workpath"])
+            if self.incremental and tgt.returncode == 0:
+                self.build_state.record(tgt, digest)
         return tgt
 
+    def get_loop_jobs(self, tgt):
+        """
+        Number of workers to use for the iterations of a loop target.
+
+        A `--jobs` value given to the melder takes priority over the
+        `loop.parallel` setting of the target. Defaults to 1 (serial).
+        """
+        if self.jobs:
+            return max(1, int(self.jobs))
+        if "parallel" in tgt.meta["loop"] and tgt.meta["loop"]["parallel"]:
+            return max(1, int(tgt.meta["loop"]["parallel"]))
+        return 1
+
+    def build_loop_iteration(
+        self, tgt, i, loop_var_value, print_only=False, vardump=False
+    ):
+        """
+        Build a single iteration of a loop target.
+
+        Errors are recorded on the returned target (as a failed message with a
+        non-zero return code) instead of raised, so one bad iteration does not
+        abort the rest of the loop.
+        """
+        var = tgt.meta["loop"]["assign_to"]
+        _LOGGER.info(f"{var}: {loop_var_value}")
+        tgt_copy = tgt.overlay({var: loop_var_value})
+        try:
+            with profile_phase("loop_iteration", target=tgt.target_name, iteration=i):
+                return self.run_command_for_target(tgt_copy, print_only, vardump)
+        except Exception as e:
+            _LOGGER.exception(e)
+            tgt_copy.returncode = 1
+            tgt_copy.add_message(
+                f"MM | Loop iteration {i} ({var}: {loop_var_value}) of target '{tgt.target_name}' failed: {e}",
+                "fail",
+            )
+            return tgt_copy
+
     def build_target_in_loop(self, tgt, print_only=False, vardump=False):
         #  Process each iteration of the loop
         melded_input = tgt.melded_input
         loop_data_var = tgt.meta["loop"]["loop_data"].split(".")
         _LOGGER.debug(f"Retrieve loop data variable named {loop_data_var}")
         loop_dat = recursive_get(melded_input, loop_data_var)
-        _LOGGER.debug(f"Loop dat: {loop_dat}")
-        _LOGGER.debug(f"Target melded_input: {tgt.melded_input}")
+        _LOGGER.debug("Loop dat: %s", loop_dat)
+        _LOGGER.debug("Target melded_input: %s", tgt.melded_input)
         n = len(loop_dat)
-        _LOGGER.info(f"Loop found: {n} elements.")
+        # Iterations are keyed by their original index, also when sharded
+        indices = [i for i in range(n) if in_shard(loop_dat[i], self.shard)]
+        if self.shard:
+            _LOGGER.info(
+                f"Shard {self.shard[0]}/{self.shard[1]}: {len(indices)} of {n} loop elements"
+            )
+        if tgt.meta["loop"].get("batch") and tgt.meta.get("command"):
+            if not print_only and not vardump:
+                return self.build_loop_batch(tgt, {i: loop_dat[i] for i in indices})
+        jobs = self.get_loop_jobs(tgt)
+        _LOGGER.info(f"Loop found: {n} elements. Workers: {jobs}")
         _LOGGER.debug(loop_dat)
 
-        return_target_objects = {}
-        for i in range(len(loop_dat)):
-            loop_var_value = loop_dat[i]
-            melded_input_copy = deepcopy(melded_input)
-            tgt_copy = deepcopy(tgt)
-            var = tgt_copy.meta["loop"]["assign_to"]
-            _LOGGER.info(f"{var}: {loop_var_value}")
-            tgt_copy.melded_input.update({var: loop_var_value})
-            tgt_copy.meta.update({var: loop_var_value})
-            _LOGGER.debug(tgt_copy.meta)
-            # _LOGGER.debug(cmd_data)
-            rendered_in = self.render_template(
-                tgt_copy.melded_input, tgt_copy, double=False
-            ).encode()
-            return_target_objects[i] = self.run_command_for_target(
-                tgt_copy, print_only, vardump
-            )
+        if jobs == 1:
+            return {
+                i: self.build_loop_iteration(tgt, i, loop_dat[i], print_only, vardump)
+                for i in indices
+            }
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                i: executor.submit(
+                    self.build_loop_iteration,
+                    tgt,
+                    i,
+                    loop_dat[i],
+                    print_only,
+                    vardump,
+                )
+                for i in indices
+            }
+            # Collect in original loop order, regardless of completion order
+            return_target_objects = {i: futures[i].result() for i in indices}
 
         return return_target_objects
 
-    def meld_inputs(self, tgt):
+    def build_loop_batch(self, tgt, loop_items):
+        """
+        Build all the iterations of a loop target with a single run of its
+        command (`loop.batch`), instead of one run per iteration.
+
+        Each iteration is rendered into its own file, and listed in a json
+        manifest, whose path is given to the command as `{manifest}`:
+
+            {"target": ..., "results": ...,
+             "items": [{"index": 0, "input": ..., "output_file": ...,
+                        <assign_to>: <loop value>}, ...]}
+
+        The command can write the return code of each item to the `results`
+        file, as a json object keyed by index. Otherwise, each item gets the
+        return code of the command, and fails if its output file is missing.
+
+        @param dict loop_items Loop value of each iteration, keyed by index
+        @return dict Built target of each iteration, keyed by index
+        """
+        var = tgt.meta["loop"]["assign_to"]
+        workpath = tgt.meta["_workpath"]
+        _LOGGER.info(f"Loop found: {len(loop_items)} elements. Building in one batch.")
+        batch_dir = tempfile.mkdtemp(prefix="markmeld-batch-")
+        results = {}
+        items = []
+        digests = {}
+        try:
+            for i, value in loop_items.items():
+                tgt_copy = tgt.overlay({var: value})
+                results[i] = tgt_copy
+                tgt_copy.melded_output = None
+                try:
+                    format_output_file(tgt_copy)
+                    if self.incremental:
+                        digest = build_digest(tgt_copy, tgt.meta["command"])
+                        if self.build_state.is_current(tgt_copy, digest):
+                            tgt_copy.returncode = 0
+                            tgt_copy.add_message(
+                                f"MM | Target '{tgt.target_name}' is up to date: {tgt_copy.meta['output_file']}",
+                                "success",
+                            )
+                            continue
+                    with profile_phase(
+                        "loop_iteration", target=tgt.target_name, iteration=i
+                    ):
+                        rendered = self.render_template(tgt_copy.melded_input, tgt_copy)
+                except Exception as e:
+                    _LOGGER.exception(e)
+                    tgt_copy.returncode = 1
+                    tgt_copy.add_message(
+                        f"MM | Loop iteration {i} ({var}: {value}) of target '{tgt.target_name}' failed: {e}",
+                        "fail",
+                    )
+                    continue
+                if not rendered:
+                    _LOGGER.error("No input detected. Check variable names")
+                    tgt_copy.returncode = 2
+                    continue
+                input_path = os.path.join(batch_dir, f"{i:06d}.md")
+                with open(input_path, "w") as f:
+                    f.write(rendered)
+                item = {var: value}
+                item.update(
+                    index=i,
+                    input=input_path,
+                    output_file=tgt_copy.meta["output_file"],
+                )
+                items.append(item)
+                if self.incremental:
+                    digests[i] = digest
+
+            if items:
+                self.run_batch_command(tgt, items, results, batch_dir)
+                for i, digest in digests.items():
+                    if results[i].returncode == 0:
+                        self.build_state.record(results[i], digest)
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        return results
+
+    def run_batch_command(self, tgt, items, results, batch_dir):
+        """
+        Run the command of a batched loop target, and record the return code
+        of each item of its manifest on the iteration's target.
+        """
+        manifest_path = os.path.join(batch_dir, "manifest.json")
+        results_path = os.path.join(batch_dir, "results.json")
+        manifest = {"target": tgt.target_name, "results": results_path, "items": items}
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=1, default=str)
+        # Per-iteration variables, like output_file, aren't defined for the
+        # one command of the batch
+        variables = {k: v for k, v in tgt.meta.items() if k != "output_file"}
+        variables.update(manifest=manifest_path, batch_dir=batch_dir)
+        try:
+            cmd_fmt = CommandFormatter(variables).format(tgt.meta["command"])
+        except KeyError as e:
+            raise TargetError(
+                f"Batch command of target '{tgt.target_name}' uses the undefined variable {e}. Per-iteration values are in the {{manifest}}."
+            )
+        with profile_phase("run_cmd", target=tgt.target_name, batch=len(items)):
+            returncode = run_cmd(cmd_fmt, None, tgt.meta["_workpath"])
+
+        item_codes = {}
+        if os.path.isfile(results_path):
+            try:
+                with open(results_path, "r") as f:
+                    item_codes = {int(k): int(v) for k, v in json.load(f).items()}
+            except (ValueError, AttributeError) as e:
+                _LOGGER.warning(f"MM | Ignoring invalid batch results file: {e}")
+        for item in items:
+            tgt_copy = results[item["index"]]
+            tgt_copy.returncode = item_codes.get(item["index"], returncode)
+            output_file = item["output_file"]
+            if item["index"] not in item_codes and returncode == 0 and output_file:
+                if not os.path.exists(
+                    os.path.join(os.path.dirname(tgt.meta["_workpath"]), output_file)
+                ):
+                    tgt_copy.returncode = 1
+                    tgt_copy.add_message(
+                        f"MM | Batch command didn't produce output for iteration {item['index']}: {output_file}",
+                        "fail",
+                    )
+
+    def meld_inputs(self, tgt, lazy=True):
+        """
+        Load a target's data, and combine it with the target's settings into
+        the template variables.
+
+        @param bool lazy Load only the data keys the target refers to (see
+            get_data_keys), instead of all of them
+        @return dict Template variables
+        """
         # data_copy = deepcopy(tgt.root_cfg)
         # data_copy.update(tgt.meta)
         data_copy = deepcopy(tgt.meta)
@@ -536,12 +1294,19 @@ class MarkdownMelder(object):
             _LOGGER.error("Can't process this config version.")
 
         _LOGGER.info("MM | Processing config version 1...")
-        if "data" in tgt.meta:
-            processed_data_block = process_data(tgt.meta["data"], tgt.meta["_workpath"])
-        else:
-            processed_data_block = process_data({}, tgt.meta["_workpath"])
-        _LOGGER.debug("processed_data_block:", processed_data_block)
-        data_copy.update(processed_data_block)
+        data_block = data_copy["data"] if "data" in data_copy else {}
+        keys = self.get_data_keys(tgt) if lazy else None
+        while True:
+            processed_data_block = process_data(data_block, tgt.meta["_workpath"], keys)
+            _LOGGER.debug("processed_data_block: %s", processed_data_block)
+            data_copy.update(processed_data_block)
+            if keys is None or self.get_render_mode(tgt) == "single":
+                break
+            # Variables with jinja are rendered too, and can refer to more data
+            more = string_keys(get_template_env(), data_copy)
+            if more is not None and more <= keys:
+                break
+            keys = None if more is None else keys | more
 
         k = list(data_copy.keys())
         _LOGGER.info(f"MM | Available keys: {k}")
@@ -555,8 +1320,51 @@ class MarkdownMelder(object):
             )
         return data_copy
 
-    def render_template(self, melded_input, target, double=None):
-        # print(melded_input)
+    def get_data_keys(self, tgt):
+        """
+        Find the data keys a target refers to, by analyzing its template and
+        command, so the rest of its data doesn't need to be loaded.
+
+        @return set|None Referenced keys, or None if all the data is needed:
+            if the target sets `lazy_data: false`, uses the generic template,
+            or if its template's references can't be known statically
+        """
+        if not tgt.meta.get("lazy_data", True) or not tgt.meta.get("jinja_template"):
+            return None
+        tpl = load_template(tgt.meta)
+        double = self.get_render_mode(tgt) == "double"
+        keys = source_keys(get_template_env(), tpl.source, double)
+        if keys is None:
+            _LOGGER.info("MM | Template uses dynamic lookups; loading all data")
+            return None
+        keys = set(keys) | command_keys(tgt.meta.get("command"))
+        if "loop" in tgt.meta:
+            keys.add(tgt.meta["loop"]["loop_data"].split(".")[0])
+        return keys
+
+    def get_output_keys(self, tgt):
+        """
+        Find the variables a target's output depends on: those its template,
+        its command, or jinja in its variables refer to.
+
+        @return set|None Referenced variables, or None if they can't be known
+            statically
+        """
+        env = get_template_env()
+        if tgt.meta.get("jinja_template"):
+            source = load_template(tgt.meta).source
+        else:
+            source = tpl_generic
+        double = self.get_render_mode(tgt) == "double"
+        keys = source_keys(env, source, double)
+        if keys is not None and self.get_render_mode(tgt) != "single":
+            more = string_keys(env, tgt.melded_input)
+            keys = None if more is None else keys | more
+        if keys is None:
+            return None
+        return keys | command_keys(tgt.meta.get("command"))
+
+    def get_target_template(self, melded_input, target):
         if "data" not in melded_input:
             melded_input["data"] = {}
         if "md_template" in target.meta:
@@ -565,26 +1373,76 @@ class MarkdownMelder(object):
             )
 
         if "jinja_template" in target.meta and target.meta["jinja_template"]:
-            tpl = load_template(target.meta)
+            return load_template(target.meta)
         else:
-            # cmd_data["jinja_template"] = None
-            tpl = Template(tpl_generic)
-            tpl.source = tpl_generic
             _LOGGER.error(
                 "No jinja_template provided. Using generic markmeld jinja_template."
             )
+            return load_generic_template()
 
-        if double is None:
-            if (
-                "recursive_render" in target.meta
-                and not target.meta["recursive_render"]
-            ):
-                double = False
+    def get_render_mode(self, target):
+        """
+        How a target's template is rendered, set by `recursive_render`:
+
+        - 'double' (true, the default): render the output of the template
+          again, so variables can contain jinja;
+        - 'selective': render variables containing jinja first, then
+          render the template once;
+        - 'single' (false): render the template once.
+        """
+        if "recursive_render" not in target.meta:
+            # Recursive rendering allows your template to include variables
+            return "double"
+        mode = target.meta["recursive_render"]
+        if mode == "selective":
+            return "selective"
+        return "double" if mode else "single"
+
+    def prerender_variables(self, melded_input, target):
+        """
+        Render the variables that contain jinja, for selective rendering.
+
+        @return Mapping The template variables, with jinja variables rendered
+        """
+        if target.template_strings is None:
+            target.template_strings = find_template_strings(melded_input)
+        tree = dict(target.template_strings)
+        if isinstance(melded_input, ChainMap) and len(melded_input.maps) > 1:
+            # Loop variables are added on top of the shared melded input
+            for key, value in melded_input.maps[0].items():
+                tree.pop(key, None)
+                tree.update(find_template_strings({key: value}))
+        if not tree:
+            return melded_input
+        rendered = prerender_strings(
+            {key: melded_input[key] for key in tree}, tree, melded_input
+        )
+        return ChainMap(rendered, melded_input)
+
+    def render_template(self, melded_input, target, double=None):
+        with profile_phase("render_template", target=target.target_name):
+            tpl = self.get_target_template(melded_input, target)
+            if double is None:
+                mode = self.get_render_mode(target)
             else:
-                # Recursive rendering allows your template to include variables
-                double = True
+                mode = "double" if double else "single"
 
-        if double:
-            return Template(tpl.render(melded_input)).render(melded_input)  # two times
-        else:
-            return tpl.render(melded_input)
+            if mode == "double":
+                # two times
+                return Template(tpl.render(melded_input)).render(melded_input)
+            elif mode == "selective":
+                return tpl.render(self.prerender_variables(melded_input, target))
+            else:
+                return tpl.render(melded_input)
+
+    def stream_template(self, melded_input, target):
+        """
+        Render a target's template piece by piece, without building the
+        whole output in memory. Not possible with double rendering.
+
+        @return Iterator[str] The rendered output, in chunks
+        """
+        tpl = self.get_target_template(melded_input, target)
+        if self.get_render_mode(target) == "selective":
+            melded_input = self.prerender_variables(melded_input, target)
+        return tpl.generate(melded_input)
@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+from logging import getLogger
+
+from .const import PKG_NAME
+
+_LOGGER = getLogger(PKG_NAME)
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    """
+    Measures one phase: wall time, CPU time of the running thread, and peak
+    traced memory (above the memory in use when the phase started).
+    """
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.child_peak = 0
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        # Peak memory is tracked per phase by resetting the tracemalloc peak;
+        # an outer phase takes the largest peak of its children into account
+        self.start_memory, peak = tracemalloc.get_traced_memory()
+        if self.parent is not None:
+            self.parent.child_peak = max(self.parent.child_peak, peak)
+        if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+
+            tracemalloc.reset_peak()
+        self.start_cpu = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.start
+        cpu = time.thread_time() - self.start_cpu
+        peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+        self.profiler.stack().pop()
+        if self.parent is not None:
+            self.parent.child_peak = max(self.parent.child_peak, peak)
+        self.profiler.record(
+            {
+                "name": self.name,
+                "args": self.args,
+                "start": self.start - self.profiler.origin,
+                "wall": wall,
+                "cpu": cpu,
+                # Memory above the level at the start of the phase
+                "peak_memory": max(0, peak - self.start_memory),
+                "thread": threading.get_ident(),
+            }
+        )
+        return False
+
+
+class Profiler(object):
+    """
+    Records the wall time, CPU time and peak memory of each phase of a build
+    (loading the config, side targets, melding inputs, rendering, running
+    commands, loop iterations, ...).
+
+    Memory is Python memory traced by tracemalloc, which is process-wide, so
+    phases running in parallel see each other's allocations. Profiling is
+    off until `start` is called; phases cost next to nothing while it's off.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    def start(self):
+        self.enabled = True
+        self.events = []
+        self.origin = time.perf_counter()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def phase(self, name, **args):
+        """
+        Measure a phase of the build:
+
+            with PROFILER.phase("render_template", target=name):
+                ...
+
+        @param str name Name of the phase
+        @param args Details to record with the phase, like the target name
+        """
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name, args)
+
+    def record(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def summary(self):
+        """
+        Summarize the recorded phases, by name, in order of first appearance.
+
+        @return list[dict] For each phase: count, total wall and CPU time,
+            and the largest peak memory
+        """
+        rows = {}
+        for event in sorted(self.events, key=lambda e: e["start"]):
+            row = rows.setdefault(
+                event["name"],
+                {"phase": event["name"], "count": 0, "wall": 0, "cpu": 0},
+            )
+            row["count"] += 1
+            row["wall"] += event["wall"]
+            row["cpu"] += event["cpu"]
+            row["peak_memory"] = max(row.get("peak_memory", 0), event["peak_memory"])
+        return list(rows.values())
+
+    def format_table(self):
+        lines = [
+            f"{'Phase':<20} {'Count':>6} {'Wall (s)':>10} {'CPU (s)':>10} {'Peak +MB':>10}"
+        ]
+        for row in self.summary():
+            lines.append(
+                f"{row['phase']:<20} {row['count']:>6} {row['wall']:>10.3f} {row['cpu']:>10.3f} {row['peak_memory'] / 1e6:>10.1f}"
+            )
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """
+        The recorded phases in Chrome's trace event format, viewable in
+        chrome://tracing or https://ui.perfetto.dev. The phase summary is
+        included under 'markmeldSummary'.
+        """
+        pid = os.getpid()
+        events = [
+            {
+                "name": e["name"],
+                "cat": "markmeld",
+                "ph": "X",
+                "ts": round(e["start"] * 1e6),
+                "dur": round(e["wall"] * 1e6),
+                "pid": pid,
+                "tid": e["thread"],
+                "args": dict(
+                    e["args"], cpu_seconds=e["cpu"], peak_memory=e["peak_memory"]
+                ),
+            }
+            for e in sorted(self.events, key=lambda e: e["start"])
+        ]
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "markmeldSummary": self.summary(),
+        }
+
+    def write_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f, indent=1, default=str)
+        _LOGGER.info(f"MM | Profile written to: {path}")
+
+
+PROFILER = Profiler()
+
+
+def profile_phase(name, **args):
+    """
+    Measure a phase of the build with the shared profiler.
+    """
+    return PROFILER.phase(name, **args)
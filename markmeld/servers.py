@@ -0,0 +1,406 @@
+import atexit
+import base64
+import json
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+from collections.abc import Mapping
+from logging import getLogger
+
+from .const import PKG_NAME
+from .exceptions import ServerError
+
+_LOGGER = getLogger(PKG_NAME)
+
+# Settings for persistent servers. The CLI updates these from its arguments.
+# enabled: route builds to a target's `server`; if False, always run `command`
+# startup_timeout: seconds to wait for a server to start accepting requests
+# build_timeout: seconds to wait for a server to answer a build, before
+#   giving up on it and running the command instead
+SERVER_SETTINGS = {"enabled": True, "startup_timeout": 10, "build_timeout": 300}
+
+# Output formats pandoc infers from the extension of the output file
+PANDOC_FORMATS = {
+    ".docx": "docx",
+    ".epub": "epub",
+    ".htm": "html",
+    ".html": "html",
+    ".md": "markdown",
+    ".odt": "odt",
+    ".pptx": "pptx",
+    ".rst": "rst",
+    ".rtf": "rtf",
+    ".tex": "latex",
+    ".txt": "plain",
+}
+
+# pandoc options that map directly onto pandoc-server request parameters
+PANDOC_VALUE_OPTIONS = {
+    "-f": "from",
+    "-r": "from",
+    "--from": "from",
+    "--read": "from",
+    "-t": "to",
+    "-w": "to",
+    "--to": "to",
+    "--write": "to",
+    "-o": "output",
+    "--output": "output",
+    "--template": "template",
+    "--wrap": "wrap",
+    "--columns": "columns",
+    "--toc-depth": "toc-depth",
+}
+PANDOC_FLAG_OPTIONS = {
+    "-s": "standalone",
+    "--standalone": "standalone",
+    "--toc": "table-of-contents",
+    "--table-of-contents": "table-of-contents",
+    "-N": "number-sections",
+    "--number-sections": "number-sections",
+}
+
+SHELL_OPERATORS = ["|", "||", "&", "&&", ";", ">", ">>", "<", "2>"]
+
+
+def pandoc_request(cmd, cwd):
+    """
+    Translate a pandoc command into a pandoc-server request.
+
+    Only simple commands can be translated: a single pandoc call, with no
+    shell pipes or redirects, using options pandoc-server understands, that
+    writes a text or office format (not pdf) to an output file.
+
+    @param str cmd A formatted command, like 'pandoc -s -o out.html'
+    @param str cwd Folder the command would run in
+    @return tuple|None (request parameters, output file), or None if the
+        command can't be sent to pandoc-server
+    """
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not args or os.path.basename(args[0]) != "pandoc":
+        return None
+    params = {"from": "markdown"}
+    variables = {}
+    i = 1
+    while i < len(args):
+        arg = args[i]
+        name, sep, value = arg.partition("=")
+        if arg in SHELL_OPERATORS:
+            return None
+        elif arg in PANDOC_FLAG_OPTIONS:
+            params[PANDOC_FLAG_OPTIONS[arg]] = True
+        elif name in PANDOC_VALUE_OPTIONS or name in ["-V", "--variable"]:
+            if not sep:
+                i += 1
+                if i == len(args):
+                    return None
+                value = args[i]
+            if name in ["-V", "--variable"]:
+                key, _, val = value.partition("=")
+                variables[key] = val or True
+            else:
+                params[PANDOC_VALUE_OPTIONS[name]] = value
+        elif arg[:2] in ["-V", "-o", "-t", "-f"] and len(arg) > 2:
+            # Short options with attached values, like -ofile.html
+            short = arg[:2]
+            if short == "-V":
+                key, _, val = arg[2:].partition("=")
+                variables[key] = val or True
+            else:
+                params[PANDOC_VALUE_OPTIONS[short]] = arg[2:]
+        else:
+            return None
+        i += 1
+
+    output = params.pop("output", None)
+    if not output or output == "-":
+        return None
+    output = os.path.join(cwd, output)
+    if "to" not in params:
+        params["to"] = PANDOC_FORMATS.get(os.path.splitext(output)[1].lower())
+    if params["to"] not in PANDOC_FORMATS.values():
+        return None
+    if "template" in params:
+        # pandoc-server can't read files; it needs the template text
+        try:
+            with open(os.path.join(cwd, params["template"]), "r") as f:
+                params["template"] = f.read()
+        except OSError:
+            return None
+    for key in ["columns", "toc-depth"]:
+        if key in params:
+            try:
+                params[key] = int(params[key])
+            except ValueError:
+                return None
+    if variables:
+        params["variables"] = variables
+    return params, output
+
+
+class PersistentCommand(object):
+    """
+    A long-lived worker process, started from a user-configured command.
+
+    Markmeld sends each build to the worker's stdin as a single line of JSON
+    (with the formatted `command`, `cwd`, `output_file` and the `size` of the
+    rendered document), followed by exactly `size` bytes of the rendered
+    document. The worker answers with a single line of JSON on stdout, with
+    the `returncode` of the build.
+    """
+
+    def __init__(self, command, cwd):
+        self.command = command
+        self.cwd = cwd
+        _LOGGER.info(f"MM | Starting server: {command}; CWD: {cwd}")
+        self.process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=cwd,
+        )
+
+    def build(self, cmd, stdin, cwd, output_file):
+        header = {
+            "command": cmd,
+            "cwd": cwd,
+            "output_file": output_file,
+            "size": len(stdin),
+        }
+        result = {}
+
+        def exchange():
+            try:
+                self.process.stdin.write(json.dumps(header).encode() + b"\n")
+                self.process.stdin.write(stdin)
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+                result["returncode"] = int(json.loads(line)["returncode"])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                result["error"] = e
+
+        # Talk to the worker in a thread, so a stalled worker can't hang the
+        # build: it's killed, and the build falls back to the command
+        timeout = SERVER_SETTINGS["build_timeout"]
+        thread = threading.Thread(target=exchange, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            self.process.kill()
+            self.process.wait()
+            raise ServerError(
+                f"Server '{self.command}' didn't answer within {timeout} seconds"
+            )
+        if "error" in result:
+            raise ServerError(f"Server '{self.command}' failed: {result['error']}")
+        return result["returncode"]
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+
+
+class PandocServer(object):
+    """
+    A pandoc-server process, listening on a local port.
+
+    Commands are translated into pandoc-server requests by pandoc_request;
+    commands that can't be translated raise a ServerError, so the caller can
+    run them as usual instead.
+    """
+
+    def __init__(self, cwd):
+        if shutil.which("pandoc-server"):
+            executable = ["pandoc-server"]
+        elif shutil.which("pandoc"):
+            executable = ["pandoc", "server"]
+        else:
+            raise ServerError("Neither pandoc-server nor pandoc were found")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/"
+        _LOGGER.info(f"MM | Starting pandoc server on port {port}")
+        self.process = subprocess.Popen(
+            executable + ["--port", str(port)],
+            cwd=cwd,
+            stdout=subprocess.DEVNULL,
+        )
+        deadline = time.time() + SERVER_SETTINGS["startup_timeout"]
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.close()
+                    raise ServerError("pandoc server failed to start")
+                time.sleep(0.05)
+
+    def build(self, cmd, stdin, cwd, output_file):
+        request = pandoc_request(cmd, cwd)
+        if request is None:
+            raise ServerError(f"Command can't be run by pandoc server: {cmd}")
+        params, output = request
+        params["text"] = stdin.decode()
+
+        import requests
+
+        from .http_cache import get_session
+
+        try:
+            response = get_session().post(
+                self.url,
+                json=params,
+                headers={"Accept": "application/json"},
+                timeout=SERVER_SETTINGS["build_timeout"],
+            )
+            response.raise_for_status()
+            result = response.json()
+        except requests.Timeout as e:
+            # A stalled server isn't used again (see run_on_server)
+            self.close()
+            raise ServerError(f"pandoc server didn't answer: {e}")
+        except Exception as e:
+            raise ServerError(f"pandoc server failed: {e}")
+        if result.get("error"):
+            raise ServerError(f"pandoc server failed: {result['error']}")
+        for message in result.get("messages", []):
+            _LOGGER.warning(f"MM | pandoc: {message}")
+        if result.get("base64"):
+            content = base64.b64decode(result["output"])
+        else:
+            content = result["output"].encode()
+        with open(output, "wb") as f:
+            f.write(content)
+        return 0
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class ServerPool(object):
+    """
+    The servers started during this process, reused by every build.
+
+    Each server spec (and working folder) gets its own pool of servers, so
+    parallel builds each use their own server; idle servers are handed to the
+    next build. A spec whose server fails is not used again, and its builds
+    run their command as usual.
+    """
+
+    def __init__(self):
+        self.idle = {}
+        self.all = []
+        self.broken = set()
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        with self.lock:
+            if key in self.broken:
+                return None
+            if self.idle.get(key):
+                return self.idle[key].pop()
+        spec, cwd = key
+        try:
+            server = (
+                PandocServer(cwd) if spec == "pandoc" else PersistentCommand(spec, cwd)
+            )
+        except (OSError, ServerError) as e:
+            self.mark_broken(key, e)
+            return None
+        with self.lock:
+            self.all.append(server)
+        return server
+
+    def release(self, key, server):
+        with self.lock:
+            self.idle.setdefault(key, []).append(server)
+
+    def mark_broken(self, key, error):
+        _LOGGER.warning(f"MM | {error}. Running commands without the server.")
+        with self.lock:
+            self.broken.add(key)
+
+    def close(self):
+        with self.lock:
+            servers, self.all, self.idle = self.all, [], {}
+        for server in servers:
+            server.close()
+
+
+SERVERS = ServerPool()
+atexit.register(SERVERS.close)
+
+
+def server_spec(tgt):
+    """
+    @return str|None The server a target asks for: 'pandoc', or the command
+        of a persistent worker
+    """
+    server = tgt.meta.get("server")
+    if isinstance(server, Mapping):
+        return server.get("command")
+    return server or None
+
+
+def uses_server(tgt):
+    """
+    @return bool Whether builds of the target are sent to a server first
+    """
+    return bool(server_spec(tgt)) and SERVER_SETTINGS["enabled"]
+
+
+def run_on_server(tgt, cmd, stdin):
+    """
+    Build a target on its persistent server, if it has one.
+
+    @param Target tgt Target to build
+    @param str cmd The formatted command for the target
+    @param bytes stdin The rendered document
+    @return int|None Return code, or None if the target should be built by
+        running its command in a new process instead
+    """
+    if not uses_server(tgt):
+        return None
+    spec = server_spec(tgt)
+    cwd = os.path.dirname(tgt.meta["_workpath"])
+    if spec == "pandoc" and pandoc_request(cmd, cwd) is None:
+        _LOGGER.debug(f"MM | Command can't be run by pandoc server: {cmd}")
+        return None
+    key = (spec, cwd)
+    server = SERVERS.acquire(key)
+    if server is None:
+        return None
+    try:
+        returncode = server.build(cmd, stdin, cwd, tgt.meta.get("output_file"))
+    except ServerError as e:
+        if isinstance(server, PandocServer) and server.process.poll() is None:
+            # The server is fine; this command just can't be run on it
+            _LOGGER.debug(f"MM | {e}")
+            SERVERS.release(key, server)
+        else:
+            server.close()
+            SERVERS.mark_broken(key, e)
+        return None
+    SERVERS.release(key, server)
+    _LOGGER.info(f"MM | Built on server: {cmd}")
+    return returncode
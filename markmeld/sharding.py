@@ -0,0 +1,157 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+
+from logging import getLogger
+
+from .const import PKG_NAME, SHARDS_DIR, STATE_DIR
+from .utilities import atomic_write
+
+_LOGGER = getLogger(PKG_NAME)
+
+SHARD_REGEX = re.compile(r"^\s*(\d+)\s*/\s*(\d+)\s*$")
+
+
+def parse_shard(spec):
+    """
+    Parse a shard given as 'K/N': the K-th of N shards, counting from 1.
+
+    @param str spec Like '2/8'
+    @return tuple (K, N)
+    """
+    match = SHARD_REGEX.match(spec)
+    if not match:
+        raise ValueError(f"Shard must look like K/N (like 2/8), not: {spec}")
+    k, n = int(match.group(1)), int(match.group(2))
+    if not 1 <= k <= n:
+        raise ValueError(f"Shard {k}/{n} is out of range: K must be from 1 to {n}")
+    return k, n
+
+
+def shard_key(value):
+    """
+    A stable string for a loop value or target name, the same in every run
+    and on every machine (unlike hash(), which is salted per process).
+    """
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def shard_of(value, n):
+    """
+    @return int The shard (from 1 to n) a loop value or target name belongs to
+    """
+    digest = hashlib.sha256(shard_key(value).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % n + 1
+
+
+def in_shard(value, shard):
+    """
+    @param tuple|None shard (K, N), or None to build everything
+    @return bool Whether this shard builds the loop value or target name
+    """
+    return shard is None or shard_of(value, shard[1]) == shard[0]
+
+
+def manifest_dir(cfg_file_path):
+    """
+    @return str Folder for shard manifests, next to the root config file
+    """
+    return os.path.join(os.path.dirname(cfg_file_path), STATE_DIR, SHARDS_DIR)
+
+
+def default_manifest_path(cfg_file_path, shard):
+    k, n = shard
+    return os.path.join(manifest_dir(cfg_file_path), f"shard-{k}-of-{n}.json")
+
+
+def result_rows(target_name, result):
+    """
+    @param Target|dict|None result A built target, a dict of them (loop
+        targets, keyed by iteration), or None if the build raised an error
+    @return list[dict] One row per output: target, iteration, return code
+        and output file
+    """
+    if result is None:
+        return [
+            {"target": target_name, "iteration": None, "returncode": 1, "error": True}
+        ]
+    items = result.items() if isinstance(result, dict) else [(None, result)]
+    return [
+        {
+            "target": target_name,
+            "iteration": i,
+            "returncode": tgt.returncode,
+            "output_file": tgt.meta.get("output_file"),
+        }
+        for i, tgt in items
+    ]
+
+
+def write_shard_manifest(path, shard, results, elapsed):
+    """
+    Record what a shard built, for merge_shard_manifests.
+
+    @param str path File to write
+    @param tuple shard (K, N)
+    @param dict results Maps each target name to its build result (see
+        result_rows)
+    @param float elapsed Seconds the shard took
+    """
+    manifest = {
+        "shard": list(shard),
+        "finished": time.time(),
+        "seconds": elapsed,
+        "results": [
+            row
+            for target_name, result in results.items()
+            for row in result_rows(target_name, result)
+        ],
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with atomic_write(path) as f:
+        json.dump(manifest, f, indent=1, default=str)
+    _LOGGER.info(f"MM | Shard manifest written to: {path}")
+
+
+def merge_shard_manifests(paths):
+    """
+    Combine the manifests of the shards of a build into one summary.
+
+    @param Iterable[str] paths Shard manifests (or folders of them)
+    @return dict Summary: number of shards, the shards found and missing,
+        counts of succeeded and failed outputs, and every output's row
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "shard-*.json"))))
+        else:
+            files.append(path)
+    manifests = []
+    for path in files:
+        with open(path, "r") as f:
+            manifests.append(json.load(f))
+    counts = {m["shard"][1] for m in manifests}
+    if len(counts) > 1:
+        raise ValueError(f"Manifests are from different shard counts: {sorted(counts)}")
+    n = counts.pop() if counts else 0
+    found = sorted({m["shard"][0] for m in manifests})
+    rows = [row for m in manifests for row in m["results"]]
+    rows.sort(
+        key=lambda r: (r["target"], -1 if r["iteration"] is None else r["iteration"])
+    )
+    failed = sum(1 for row in rows if row["returncode"] != 0)
+    return {
+        "shards": n,
+        "found": found,
+        "missing": [k for k in range(1, n + 1) if k not in found],
+        "succeeded": len(rows) - failed,
+        "failed": failed,
+        "seconds": max([m["seconds"] for m in manifests], default=0),
+        "results": rows,
+    }
@@ -0,0 +1,130 @@
+import re
+import string
+
+from collections.abc import Mapping
+from functools import lru_cache
+
+from jinja2 import TemplateSyntaxError, meta, nodes
+
+from .utilities import LazyDict
+
+# Opening delimiters of jinja expressions, statements and comments
+JINJA_SYNTAX = re.compile(r"\{[{%#]")
+
+# Views of the data that are keyed by data key, like `_md.intro` or
+# `_yaml["refs"]`
+KEYED_VIEWS = {"_md", "_yaml", "_raw", "_local_frontmatter"}
+
+# Views that combine every input file; using them needs all the data
+GLOBAL_VIEWS = {"_global_vars", "_global_frontmatter"}
+
+# `_md.items()` iterates over the view, it doesn't look up a key
+DICT_METHODS = {name for name in dir(dict) if not name.startswith("_")}
+
+
+def referenced_keys(env, ast, double=False):
+    """
+    Find the variables a parsed template refers to, including the keys it
+    looks up in the keyed views (like `_md.intro`).
+
+    The keys can't be known statically if the template includes or imports
+    other templates, uses a global view, or uses a keyed view with a
+    dynamic key (like `_md[chapter]`) or as a whole (like `_md.items()`).
+
+    @param jinja2.Environment env Environment the template was parsed with
+    @param jinja2.nodes.Template ast Parsed template
+    @param bool double The template's output is rendered again, so jinja in
+        its text (like in a raw block) is analyzed too
+    @return set|None Referenced names, or None if they can't be known
+    """
+    if any(True for _ in meta.find_referenced_templates(ast)):
+        return None
+    names = meta.find_undeclared_variables(ast)
+    if names & GLOBAL_VIEWS:
+        return None
+    keys = set(names)
+    views = names & KEYED_VIEWS
+    resolved = set()
+    for node in ast.find_all((nodes.Getattr, nodes.Getitem)):
+        view = node.node
+        if not isinstance(view, nodes.Name) or view.name not in views:
+            continue
+        if isinstance(node, nodes.Getattr):
+            key = node.attr
+        elif isinstance(node.arg, nodes.Const):
+            key = node.arg.value
+        else:
+            continue
+        if key in DICT_METHODS:
+            continue
+        keys.add(key)
+        resolved.add(id(view))
+    for name in ast.find_all(nodes.Name):
+        if name.name in views and name.ctx == "load" and id(name) not in resolved:
+            return None
+    if double:
+        # Text that becomes jinja in the output, like {% raw %}{{ x }}{% endraw %}
+        for node in ast.find_all((nodes.TemplateData, nodes.Const)):
+            text = node.data if isinstance(node, nodes.TemplateData) else node.value
+            if isinstance(text, str) and JINJA_SYNTAX.search(text):
+                found = source_keys(env, text, double)
+                if found is None:
+                    return None
+                keys.update(found)
+    return keys
+
+
+@lru_cache(maxsize=256)
+def source_keys(env, source, double=False):
+    """
+    Analyze a template's source with referenced_keys, once per source.
+
+    Sources with invalid jinja refer to nothing; they fail when rendered.
+
+    @return frozenset|None Referenced names, or None if they can't be known
+    """
+    try:
+        ast = env.parse(source)
+    except TemplateSyntaxError:
+        return frozenset()
+    keys = referenced_keys(env, ast, double)
+    return None if keys is None else frozenset(keys)
+
+
+def command_keys(cmd):
+    """
+    @param str cmd A command from a target, like 'pandoc -o {output_file}'
+    @return set Names of the variables the command uses
+    """
+    try:
+        fields = [f[1] for f in string.Formatter().parse(cmd or "") if f[1]]
+    except ValueError:
+        return set()
+    return {re.split(r"[.\[]", field)[0] for field in fields}
+
+
+def string_keys(env, data):
+    """
+    Find the names referred to by the strings with jinja in (nested) template
+    variables. Lazily computed values (like `_raw`) are not searched.
+
+    @param Mapping data Template variables
+    @return set|None Referenced names, or None if they can't be known
+    """
+    keys = set()
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            if JINJA_SYNTAX.search(value):
+                found = source_keys(env, value)
+                if found is None:
+                    return None
+                keys.update(found)
+        elif isinstance(value, LazyDict):
+            continue
+        elif isinstance(value, Mapping):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return keys
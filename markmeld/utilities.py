@@ -1,18 +1,94 @@
-import glob
+import codecs
+import contextlib
+import hashlib
 import os
-import string
+import pickle
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import yaml
 import platform
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from logging import getLogger
-from collections.abc import Mapping
-from ubiquerg import expandpath
+from types import MappingProxyType
+from collections.abc import Mapping, MutableMapping
+from copy import deepcopy
+from ubiquerg import expandpath, is_url
 
-from .const import PKG_NAME, FILE_OPENER_MAP
+from .command_template import CommandFormatter
+from .const import PKG_NAME, FILE_OPENER_MAP, CACHE_DIR_ENV
+from .glob_index import RACY_NS, expand_glob
+from .profiling import profile_phase
 
 _LOGGER = getLogger(PKG_NAME)
 
+# Use the libyaml-backed (C) loader and dumper when available; they're much faster
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# disk: also keep parsed files on disk (pickled), to reuse between runs
+PARSE_CACHE_SETTINGS = {"disk": False}
+
+_PARSE_CACHE = {}
+_PARSE_CACHE_LOCK = threading.Lock()
+
+
+class LazyDict(MutableMapping):
+    """
+    A dict whose values can be computed lazily, on first access.
+
+    Use `set_lazy(key, func)` to store a value that is computed by calling
+    `func()` the first time it's accessed, and then kept. Otherwise it
+    behaves like a dict, so jinja templates can index and iterate it, and
+    `dict(lazy_dict)` computes all the values.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._data = dict(*args, **kwargs)
+        self._pending = {}
+
+    def set_lazy(self, key, func):
+        self._data[key] = None
+        self._pending[key] = func
+
+    def __getitem__(self, key):
+        func = self._pending.get(key)
+        if func is not None:
+            self._data[key] = func()
+            self._pending.pop(key, None)
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._pending.pop(key, None)
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        self._pending.pop(key, None)
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def json_default(obj):
+    """
+    Fallback serializer for json.dumps, which expands lazy and other
+    non-dict mappings, and stringifies anything else.
+    """
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    return str(obj)
+
 
 # define some useful functions
 def recursive_get(dat, indices):
@@ -26,20 +102,198 @@ def recursive_get(dat, indices):
     return dat
 
 
+def parallel_map(func, items, max_workers=None):
+    """
+    Like map, but calls func on the items in a thread pool. Useful for I/O.
+
+    @param callable func Function to call on each item
+    @param Iterable items Items to process
+    @param int max_workers Size of the thread pool (default: ThreadPoolExecutor's)
+    @return list Results, in the same order as the items
+    """
+    items = list(items)
+    if len(items) < 2:
+        return [func(x) for x in items]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, items))
+
+
+def cached_parse(path, parser, kind="yaml"):
+    """
+    Parse a file, reusing an earlier result if the file hasn't changed.
+
+    Results are cached in memory, keyed by path, size and modification time,
+    and optionally pickled to disk (see PARSE_CACHE_SETTINGS). Cached results
+    are shared between callers, so treat them as read-only. Files modified
+    within RACY_NS of now aren't cached, since a same-size edit in the same
+    timestamp tick wouldn't change their signature.
+
+    @param str path Path to the file
+    @param callable parser Function that parses the file, given its path
+    @param str kind Name of the parser, to keep caches of different parsers apart
+    @return The parsed file
+    """
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    key = (kind, os.path.abspath(path))
+    with _PARSE_CACHE_LOCK:
+        hit = _PARSE_CACHE.get(key)
+    if hit and hit[0] == signature:
+        return hit[1]
+
+    disk_path = None
+    if PARSE_CACHE_SETTINGS["disk"]:
+        disk_name = hashlib.sha256(f"{kind}:{key[1]}".encode()).hexdigest()
+        disk_path = os.path.join(get_cache_dir("parsed"), f"{disk_name}.pickle")
+        try:
+            with open(disk_path, "rb") as f:
+                disk_signature, parsed = pickle.load(f)
+            if disk_signature == signature:
+                with _PARSE_CACHE_LOCK:
+                    _PARSE_CACHE[key] = (signature, parsed)
+                return parsed
+        except (OSError, pickle.PickleError, EOFError, ValueError):
+            pass
+
+    parsed = parser(path)
+    if time.time_ns() - stat.st_mtime_ns < RACY_NS:
+        return parsed
+    with _PARSE_CACHE_LOCK:
+        _PARSE_CACHE[key] = (signature, parsed)
+    if disk_path:
+        try:
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            with atomic_write(disk_path, "wb") as f:
+                pickle.dump((signature, parsed), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except (OSError, pickle.PickleError) as e:
+            _LOGGER.debug(f"MM | Couldn't cache parsed file {path}: {e}")
+    return parsed
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w", **kwargs):
+    """
+    Open a file for writing, so it's replaced all at once: what's written
+    goes to a temporary file with a unique name, renamed over the path when
+    the block ends. Readers never see a partial file, and concurrent writers
+    (threads or processes) don't clobber each other's writes.
+
+    @param str path File to write; its folder must exist
+    @param str mode 'w' or 'wb'
+    """
+    folder, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def clear_parse_cache():
+    """
+    Forget the files parsed by cached_parse in this process.
+    """
+    with _PARSE_CACHE_LOCK:
+        _PARSE_CACHE.clear()
+
+
+def parse_yaml_file(path):
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=YAML_LOADER)
+
+
+def load_yaml_file(path):
+    """
+    Load a yaml file, through the parse cache.
+    """
+    return cached_parse(path, parse_yaml_file, "yaml")
+
+
+def has_fileno(stream):
+    try:
+        stream.fileno()
+        return True
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def relay_output(pipe, stream):
+    """
+    Copy a command's output to a file-like object as it arrives.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with pipe:
+        for data in iter(lambda: pipe.read1(65536), b""):
+            stream.write(decoder.decode(data))
+        stream.write(decoder.decode(b"", final=True))
+        stream.flush()
+
+
+def start_cmd(cmd, workdir, stdin=None):
+    """
+    Start a shell command in the folder of workdir. It writes to this
+    process's stdout and stderr, unless they've been redirected to objects
+    with no file descriptor (as when the daemon runs a client's command);
+    then its output is piped to them. Wait for it with wait_cmd.
+
+    @param str cmd Command to run
+    @param str workdir Path whose folder the command runs in
+    @param stdin The command's stdin, as for subprocess.Popen
+    @return subprocess.Popen The started command
+    """
+    streams = [sys.stdout, sys.stderr]
+    pipes = [None if has_fileno(s) else subprocess.PIPE for s in streams]
+    p = subprocess.Popen(
+        cmd,
+        shell=True,
+        stdin=stdin,
+        stdout=pipes[0],
+        stderr=pipes[1],
+        cwd=os.path.dirname(workdir),
+    )
+    p.relays = []
+    for pipe, stream in zip([p.stdout, p.stderr], streams):
+        if pipe is not None:
+            relay = threading.Thread(target=relay_output, args=(pipe, stream))
+            relay.start()
+            p.relays.append(relay)
+    return p
+
+
+def wait_cmd(p):
+    """
+    Wait for a command started with start_cmd, and for all its output.
+
+    @return int Return code of the command
+    """
+    returncode = p.wait()
+    for relay in p.relays:
+        relay.join()
+    return returncode
+
+
 def run_cmd(cmd, stdin=None, workdir=None):
     """Runs a command from a given workdir"""
     _LOGGER.info(f"MM | Command: {cmd}; CWD: {workdir}")
     if stdin:
         # Call command (default: pandoc), passing the rendered template to stdin
-        p = subprocess.Popen(
-            cmd, shell=True, stdin=subprocess.PIPE, cwd=os.path.dirname(workdir)
-        )
-        p.communicate(input=stdin)
-        return p.returncode
+        p = start_cmd(cmd, workdir, stdin=subprocess.PIPE)
+        try:
+            p.stdin.write(stdin)
+        except BrokenPipeError:
+            pass  # The command stopped reading; its return code tells why
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
     else:
-        p = subprocess.Popen(cmd, shell=True, cwd=os.path.dirname(workdir))
-        p.communicate()
-        return p.returncode
+        p = start_cmd(cmd, workdir)
+    return wait_cmd(p)
 
     # In case I need to make it NOT use the shell in the future
     # here's how:
@@ -50,25 +304,59 @@ def run_cmd(cmd, stdin=None, workdir=None):
     # p.communicate(input=tpl.render(data).encode())
 
 
-def format_command(tgt):
+def stream_cmd(cmd, chunks, workdir=None):
     """
-    Given a command from a user config file, populate variables
-    from the target metadata
+    Runs a command from a given workdir, writing chunks of text to its stdin
+    as they are produced. Writes block while the pipe is full, so the
+    producer never gets far ahead of the command.
+
+    @param str cmd Command to run
+    @param Iterable[str] chunks Text to pass to the command
+    @param str workdir Path whose folder the command runs in
+    @return int Return code of the command
+    """
+    _LOGGER.info(f"MM | Command: {cmd}; CWD: {workdir}")
+    p = start_cmd(cmd, workdir, stdin=subprocess.PIPE)
+    try:
+        for chunk in chunks:
+            p.stdin.write(chunk.encode())
+        p.stdin.close()
+    except BrokenPipeError:
+        # The command stopped reading; its return code tells why
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+    except BaseException:
+        p.kill()
+        wait_cmd(p)
+        raise
+    return wait_cmd(p)
+
+
+def format_output_file(tgt):
+    """
+    Populate the variables in a target's output_file from its metadata.
+
+    @return str|None The formatted output file, also set in the target's meta
     """
-    cmd = tgt.meta["command"]
     if "output_file" in tgt.meta and tgt.meta["output_file"]:
-        tgt.meta["output_file"] = expandpath(tgt.meta["output_file"]).format(**tgt.meta)
+        output_file = CommandFormatter(tgt.meta).format(tgt.meta["output_file"])
     else:
-        tgt.meta["output_file"] = None
-    vars_to_exp = [v[1] for v in string.Formatter().parse(cmd) if v[1] is not None]
-    _LOGGER.debug(f"Vars to expand: {vars_to_exp}")
-    cmd = expandpath(cmd).format(**tgt.meta)
-    while len(vars_to_exp) > 0:
-        # format again in case the command has variables in it
-        # this allows for variables to contain variables
-        cmd = expandpath(cmd).format(**tgt.meta)
-        vars_to_exp = [v[1] for v in string.Formatter().parse(cmd) if v[1] is not None]
-    return cmd
+        output_file = None
+    tgt.meta["output_file"] = output_file
+    return output_file
+
+
+def format_command(tgt):
+    """
+    Given a command from a user config file, populate variables
+    from the target metadata. Variables can contain variables.
+
+    The target isn't modified: callers that need the formatted output file
+    in the target's meta use format_output_file.
+    """
+    return CommandFormatter(tgt.meta).format(tgt.meta["command"])
 
 
 # There are two paths associated with each target:
@@ -77,22 +365,36 @@ def format_command(tgt):
 # These are not the same thing.
 
 
-def load_config_wrapper(cfg_path, workpath=None, autocomplete=True):
+def load_config_wrapper(cfg_path, workpath=None, autocomplete=True, load_record=None):
     """
     Wrapper function that maintains a list of imported files, to prevent duplicate imports.
+
+    The loaded config records every imported file under `_imported_files`.
+
+    @param dict load_record If given, its 'factories' list is extended with
+        the (name, variables, config) of every target factory that was run
     """
     imported_list = {}
-    return load_config_file(cfg_path, workpath, autocomplete, imported_list)
+    cfg = load_config_file(cfg_path, workpath, autocomplete, imported_list, load_record)
+    if cfg:
+        cfg["_imported_files"] = list(imported_list.keys())
+    return cfg
 
 
-def load_config_file(filepath, workpath=None, autocomplete=True, imported_list={}):
+def load_config_file(
+    filepath, workpath=None, autocomplete=True, imported_list=None, load_record=None
+):
     """
     Loads a configuration file.
 
     @param str filepath Path to configuration file to load
     @param str workpath The working path that the target's relative paths are relative to
+    @param dict imported_list Files already imported, which won't be imported again
+    @param dict load_record Record of target factories run (see load_config_wrapper)
     @return dict Loaded yaml data object.
     """
+    if imported_list is None:
+        imported_list = {}
     _LOGGER.debug(f"Loading config file: {filepath}")
     _LOGGER.debug(f"Imported list: {imported_list}")
     if imported_list.get(filepath):
@@ -102,7 +404,12 @@ def load_config_file(filepath, workpath=None, autocomplete=True, imported_list={
         with open(filepath, "r") as f:
             cfg_data = f.read()
         return load_config_data(
-            cfg_data, os.path.abspath(filepath), workpath, autocomplete, imported_list
+            cfg_data,
+            os.path.abspath(filepath),
+            workpath,
+            autocomplete,
+            imported_list,
+            load_record,
         )
     except FileNotFoundError as e:
         _LOGGER.error(f"Couldn't load config file: {filepath} because: {repr(e)}")
@@ -119,12 +426,19 @@ def make_abspath(relpath, filepath, root=None):
 
 
 def load_config_data(
-    cfg_data, filepath=None, workpath=None, autocomplete=True, imported_list={}
+    cfg_data,
+    filepath=None,
+    workpath=None,
+    autocomplete=True,
+    imported_list=None,
+    load_record=None,
 ):
     """
     Recursive loader that parses a yaml string, handles imports, and runs target factories to create targets.
     """
-    higher_cfg = yaml.load(cfg_data, Loader=yaml.SafeLoader)
+    if imported_list is None:
+        imported_list = {}
+    higher_cfg = yaml.load(cfg_data, Loader=YAML_LOADER)
     higher_cfg["_cfg_file_path"] = filepath
     lower_cfg = {}
 
@@ -150,7 +464,13 @@ def load_config_data(
                 _LOGGER.info(f"Specified config file to import: {import_file_abspath}")
             deep_update(
                 lower_cfg,
-                load_config_file(import_file_abspath, expandpath(filepath)),
+                load_config_file(
+                    import_file_abspath,
+                    expandpath(filepath),
+                    True,
+                    imported_list,
+                    load_record,
+                ),
                 warn_override=not autocomplete,
             )
             imported_list[import_file_abspath] = True
@@ -167,7 +487,13 @@ def load_config_data(
                 )
             deep_update(
                 lower_cfg,
-                load_config_file(expandpath(import_file_abspath)),
+                load_config_file(
+                    expandpath(import_file_abspath),
+                    None,
+                    True,
+                    imported_list,
+                    load_record,
+                ),
                 warn_override=not autocomplete,
             )
             imported_list[import_file_abspath] = True
@@ -184,7 +510,12 @@ def load_config_data(
             _LOGGER.debug(f"Processing target factory: {fac_name}")
             # Look up function to call.
             func = plugins[fac_name]
-            factory_targets = func(fac_vals, lower_cfg)
+            if load_record is not None:
+                load_record.setdefault("factories", []).append(
+                    (fac_name, fac_vals, {"_cfg_file_path": filepath})
+                )
+            with profile_phase("target_factory", factory=fac_name):
+                factory_targets = func(fac_vals, lower_cfg)
             for k, v in factory_targets.items():
                 factory_targets[k]["_workpath"] = filepath
                 factory_targets[k]["_defpath"] = filepath
@@ -214,6 +545,106 @@ def warn_overriding_target(old, new):
                 )
 
 
+def freeze(value):
+    """
+    Make a read-only copy of nested dicts and lists.
+
+    @return Dicts become read-only mappings, and lists become tuples
+    """
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """
+    Make a plain, modifiable copy of data made read-only by freeze.
+    """
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    return value
+
+
+class LayeredDict(MutableMapping):
+    """
+    A modifiable view of data made read-only by freeze, which copies only
+    what's used: like a ChainMap, changes go to a local dict layered over the
+    frozen data. Nested dicts are wrapped in layered views too, and nested
+    lists are copied, the first time they're read, so they can be modified
+    in place without changing the frozen data.
+    """
+
+    def __init__(self, base):
+        """
+        @param Mapping base Read-only data, from freeze
+        """
+        self.base = base
+        self.local = {}
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        if key in self.local:
+            return self.local[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        value = self.base[key]
+        if isinstance(value, Mapping):
+            value = LayeredDict(value)
+        elif isinstance(value, tuple):
+            value = thaw(value)
+        else:
+            return value
+        # setdefault: threads reading the same key get the same copy
+        return self.local.setdefault(key, value)
+
+    def __setitem__(self, key, value):
+        self.local[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.local.pop(key, None)
+        if key in self.base:
+            self.deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self.local or (key not in self.deleted and key in self.base)
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.deleted:
+                yield key
+        for key in list(self.local):
+            if key not in self.base:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def peek(self):
+        """
+        @return dict A shallow copy of the view, with the values not yet read
+            as plain copies (thaw), so nothing is added to the local dict
+        """
+        return {
+            k: self.local[k] if k in self.local else thaw(self.base[k]) for k in self
+        }
+
+    def __deepcopy__(self, memo):
+        return {
+            k: deepcopy(self.local[k], memo) if k in self.local else thaw(self.base[k])
+            for k in self
+        }
+
+    def __repr__(self):
+        return repr(self.peek())
+
+
 def deep_update(old, new, warn_override=True):
     """
     Like built-in dict update, but recursive.
@@ -231,14 +662,28 @@ def deep_update(old, new, warn_override=True):
 from .glob_factory import glob_factory
 
 
-def load_plugins():
-    from pkg_resources import iter_entry_points
+@lru_cache(maxsize=None)
+def installed_factory_entry_points():
+    """
+    List the target factory plugins installed by other packages.
 
+    Uses importlib.metadata (much faster to import than pkg_resources), and
+    caches the list for the rest of the process.
+
+    @return tuple Entry points in the 'markmeld.factories' group
+    """
+    from importlib.metadata import entry_points
+
+    eps = entry_points()
+    if hasattr(eps, "select"):  # Python 3.10+
+        return tuple(eps.select(group="markmeld.factories"))
+    return tuple(eps.get("markmeld.factories", []))
+
+
+def load_plugins():
     built_in_plugins = {"glob": glob_factory}
 
-    installed_plugins = {
-        ep.name: ep.load() for ep in iter_entry_points("markmeld.factories")
-    }
+    installed_plugins = {ep.name: ep.load() for ep in installed_factory_entry_points()}
     built_in_plugins.update(installed_plugins)
     return built_in_plugins
 
@@ -257,7 +702,7 @@ def globs_to_dict(globs, cfg_path):
     for item in globs:
         path = os.path.join(os.path.dirname(cfg_path), item)
         _LOGGER.info(f"MM | Glob path: {path}")
-        files = glob.glob(path)
+        files = expand_glob(path)
         for file in files:
             k = os.path.splitext(os.path.basename(file))[0]
             _LOGGER.info(f"MM | [key:value] {k}:{file}")
@@ -265,6 +710,77 @@ def globs_to_dict(globs, cfg_path):
     return return_items
 
 
+def get_template_path(meta):
+    """
+    Resolve the path (or URL) to a target's jinja template.
+
+    @param dict meta Target metadata
+    @return str|None Path to the template, or None if the target has none
+    """
+    if "jinja_template" not in meta or not meta["jinja_template"]:
+        return None
+    root = meta["mm_templates"] if "mm_templates" in meta else None
+    return make_abspath(meta["jinja_template"], meta["_cfg_file_path"], root)
+
+
+DATA_FILE_KEYS = ["md_files", "yaml_files"]
+DATA_GLOB_KEYS = ["md_globs", "yaml_globs", "yaml_globs_unkeyed"]
+
+
+def data_block_globs(data_block, filepath):
+    """
+    List the glob patterns in a data block, as absolute patterns.
+
+    @param dict data_block The 'data' block of a target
+    @param str filepath Path the data block's relative paths are relative to
+    @return list[str] Glob patterns
+    """
+    patterns = []
+    if not data_block:
+        return patterns
+    for key in DATA_GLOB_KEYS:
+        if key in data_block and data_block[key]:
+            patterns.extend(
+                [os.path.join(os.path.dirname(filepath), g) for g in data_block[key]]
+            )
+    return patterns
+
+
+def keyed_data_files(data_block, filepath):
+    """
+    List the input files a data block refers to, with the data key each is
+    loaded under, resolving globs.
+
+    @param dict data_block The 'data' block of a target
+    @param str filepath Path the data block's relative paths are relative to
+    @return list[tuple] (key, absolute path or URL) pairs; the key is None
+        for unkeyed files, whose content is merged into the top level
+    """
+    pairs = []
+    if not data_block:
+        return pairs
+    for key in DATA_GLOB_KEYS:
+        if key in data_block and data_block[key]:
+            unkeyed = key == "yaml_globs_unkeyed"
+            for k, f in globs_to_dict(data_block[key], filepath).items():
+                pairs.append((None if unkeyed else k, f))
+    for key in DATA_FILE_KEYS:
+        if key in data_block and data_block[key]:
+            pairs.extend([(k, v) for k, v in data_block[key].items() if v])
+    return [(k, f if is_url(f) else make_abspath(f, filepath)) for k, f in pairs]
+
+
+def resolve_data_files(data_block, filepath):
+    """
+    List the input files a data block refers to, resolving globs.
+
+    @param dict data_block The 'data' block of a target
+    @param str filepath Path the data block's relative paths are relative to
+    @return list[str] Absolute paths (or URLs), in a stable order
+    """
+    return sorted({f for _, f in keyed_data_files(data_block, filepath)})
+
+
 def get_file_open_cmd() -> str:
     """
     Detect the platform markmeld is running on, and
@@ -274,3 +790,20 @@ def get_file_open_cmd() -> str:
     """
     system = platform.system()
     return FILE_OPENER_MAP.get(system, "xdg-open")
+
+
+def get_cache_dir(*subdirs):
+    """
+    Path to a folder in markmeld's cache. Does not create it.
+
+    The cache lives in $MM_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/markmeld
+    (defaulting to ~/.cache/markmeld).
+
+    @param str subdirs Subfolders within the cache folder
+    @return str Path to the cache folder
+    """
+    root = os.environ.get(CACHE_DIR_ENV)
+    if not root:
+        xdg_cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        root = os.path.join(xdg_cache, PKG_NAME)
+    return os.path.join(root, *subdirs)
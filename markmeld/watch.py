@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+
+from logging import getLogger
+
+from ubiquerg import is_url
+
+from .const import PKG_NAME
+from .glob_index import expand_glob
+from .melder import MarkdownMelder, Target
+from .utilities import (
+    data_block_globs,
+    get_template_path,
+    load_config_wrapper,
+    resolve_data_files,
+)
+
+_LOGGER = getLogger(PKG_NAME)
+
+
+class TargetWatcher(object):
+    """
+    Rebuilds a target whenever one of the files it depends on changes.
+
+    The watched files are the config file and its imports, the files in the
+    data blocks of the target and its side targets (re-resolving globs, so
+    new matching files count as changes), and their jinja templates.
+
+    The parsed config is kept between builds, and only reloaded when a config
+    file changes; parsed data and compiled templates are reused through
+    markmeld's caches, so only changed inputs are processed again.
+
+    Changes are detected with inotify (via the optional `watchdog` package)
+    where available, otherwise by polling.
+    """
+
+    def __init__(
+        self,
+        cfg_path,
+        target_name,
+        melder_kwargs=None,
+        build_kwargs=None,
+        interval=0.5,
+        debounce=0.3,
+        cfg=None,
+    ):
+        """
+        @param str cfg_path Path to the markmeld config file
+        @param str target_name Target to build
+        @param dict melder_kwargs Keyword arguments for the MarkdownMelder
+        @param dict build_kwargs Keyword arguments for MarkdownMelder.build_target
+        @param float interval Seconds between checks for changes
+        @param float debounce Seconds files must stay unchanged before rebuilding
+        @param dict cfg Config already loaded from cfg_path, if any
+        """
+        self.cfg_path = os.path.abspath(cfg_path)
+        self.target_name = target_name
+        self.melder_kwargs = melder_kwargs or {}
+        self.build_kwargs = build_kwargs or {}
+        self.interval = interval
+        self.debounce = debounce
+        self.cfg = cfg
+        self.files = []
+        self.globs = []
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.observer = None
+
+    def load_config(self):
+        _LOGGER.info(f"MM | Loading config: {self.cfg_path}")
+        self.cfg = load_config_wrapper(self.cfg_path, None, True)
+
+    def config_files(self):
+        return [self.cfg_path] + self.cfg.get("_imported_files", [])
+
+    def find_dependencies(self):
+        """
+        Find the files (and glob patterns) the target depends on.
+        """
+        mm = MarkdownMelder(self.cfg)
+        tgt = Target(self.cfg, self.target_name, inheritance=mm.inheritance)
+        side_targets = mm.resolve_side_targets(tgt)
+        nodes = side_targets[0].values() if side_targets else [tgt]
+        files = set()
+        globs = set()
+        for node in nodes:
+            workpath = node.meta["_workpath"]
+            data_block = node.meta.get("data")
+            files.update(
+                [f for f in resolve_data_files(data_block, workpath) if not is_url(f)]
+            )
+            globs.update(data_block_globs(data_block, workpath))
+            tpl_path = get_template_path(node.meta)
+            if tpl_path and not is_url(tpl_path):
+                files.add(tpl_path)
+        self.files = sorted(files)
+        self.globs = sorted(globs)
+        _LOGGER.debug(f"MM | Watching files: {self.files}; globs: {self.globs}")
+        self.watch_folders()
+
+    def snapshot(self):
+        """
+        Capture the state of everything being watched.
+
+        @return tuple Modification times and sizes of the config files and
+            inputs, and the files matching each glob.
+        """
+        stats = {}
+        for path in self.config_files() + self.files:
+            try:
+                st = os.stat(path)
+                stats[path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                stats[path] = None
+        matches = {pattern: expand_glob(pattern) for pattern in self.globs}
+        return stats, matches
+
+    def watch_folders(self):
+        """
+        Use inotify (through watchdog) to wake up early on changes, if available.
+        """
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            return
+
+        watcher = self
+
+        class WakeHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher.wake.set()
+
+        if self.observer is None:
+            self.observer = Observer()
+            self.observer.start()
+        self.observer.unschedule_all()
+        paths = self.config_files() + self.files + self.globs
+        folders = {os.path.dirname(p) for p in paths}
+        for folder in folders:
+            while folder and not os.path.isdir(folder):
+                folder = os.path.dirname(folder)
+            if folder:
+                self.observer.schedule(WakeHandler(), folder, recursive=False)
+
+    def wait_for_change(self, snapshot):
+        """
+        Block until the watched files change, and then stay unchanged for the
+        debounce time, so a burst of saves triggers only one rebuild.
+
+        @return tuple|None The new snapshot, or None if the watcher was stopped
+        """
+        # With inotify, polling is only a fallback
+        timeout = self.interval if self.observer is None else max(self.interval, 5)
+        current = snapshot
+        while current == snapshot:
+            self.wake.wait(timeout)
+            self.wake.clear()
+            if self.stopped.is_set():
+                return None
+            current = self.snapshot()
+        while True:
+            time.sleep(self.debounce)
+            settled = self.snapshot()
+            if settled == current:
+                return settled
+            current = settled
+
+    def build(self):
+        mm = MarkdownMelder(self.cfg, **self.melder_kwargs)
+        start = time.time()
+        result = mm.build_target(self.target_name, **self.build_kwargs)
+        elapsed = time.time() - start
+        results = result.values() if isinstance(result, dict) else [result]
+        for tgt in results:
+            for item in tgt.messages:
+                if item["status"] == "fail":
+                    _LOGGER.error(item["message"])
+        returncodes = [tgt.returncode for tgt in results]
+        _LOGGER.info(
+            f"MM | Built {self.target_name} in {elapsed:.2f}s. Return code: {returncodes if isinstance(result, dict) else returncodes[0]}"
+        )
+        return result
+
+    def run(self, max_builds=None):
+        """
+        Build the target, then rebuild it on every change until stopped.
+
+        @param int max_builds Stop after this many builds (default: never)
+        """
+        if self.cfg is None:
+            self.load_config()
+        self.find_dependencies()
+        snapshot = self.snapshot()
+        builds = 0
+        try:
+            while True:
+                try:
+                    self.build()
+                except Exception as e:
+                    _LOGGER.exception(e)
+                builds += 1
+                if max_builds and builds >= max_builds:
+                    return
+                _LOGGER.info("MM | Watching for changes... (Ctrl+C to stop)")
+                new_snapshot = self.wait_for_change(snapshot)
+                if new_snapshot is None:
+                    return
+                config_stats = {p: snapshot[0].get(p) for p in self.config_files()}
+                if config_stats != {p: new_snapshot[0].get(p) for p in config_stats}:
+                    self.load_config()
+                self.find_dependencies()
+                snapshot = self.snapshot()
+        finally:
+            if self.observer is not None:
+                self.observer.stop()
+                self.observer.join()
+                self.observer = None
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Keep markmeld's on-disk caches out of the user's cache folder
+    monkeypatch.setenv("MM_CACHE_DIR", str(tmp_path / "cache"))
@@ -4,6 +4,8 @@ import markmeld
 import os
 import pytest
 
+import datetime
+import json
 from datetime import date
 
 cfg = {"test": True}
@@ -198,3 +200,1057 @@ def test_meta_target():
     test_path = "tests/test_data/prebuild_test/prebuild_test_file"
     assert os.path.isfile(test_path)
     os.remove(test_path)
+
+
+def test_parallel_loop():
+    cfg = markmeld.load_config_wrapper("tests/test_data/loop_test/_markmeld.yaml")
+    mm = markmeld.MarkdownMelder(cfg)
+    res = mm.build_target("parallel_loop", print_only=True)
+    assert list(res.keys()) == [0, 1, 2, 3, 4, 5]
+    for i, tgt in res.items():
+        assert tgt.melded_output == f"Number: {i + 1}"
+
+    # A failing iteration is reported without aborting the rest of the loop
+    mm = markmeld.MarkdownMelder(cfg, jobs=2)
+    res = mm.build_target("parallel_loop")
+    assert [tgt.returncode for tgt in res.values()] == [0, 0, 1, 0, 0, 0]
+
+
+def test_incremental_build(tmp_path, monkeypatch):
+    (tmp_path / "_markmeld.yaml").write_text("""version: 1
+targets:
+  default:
+    jinja_template: tpl.jinja
+    output_file: out.txt
+    command: cat > {output_file}
+    data:
+      md_files:
+        text: text.md
+  dated:
+    jinja_template: dated.jinja
+    output_file: dated.txt
+    command: cat > {output_file}
+  looped:
+    jinja_template: tpl.jinja
+    output_file: "out_{name}.txt"
+    command: cat > {output_file}
+    loop:
+      loop_data: names
+      assign_to: name
+    data:
+      md_files:
+        text: text.md
+      variables:
+        names: [a, b]
+""")
+    (tmp_path / "tpl.jinja").write_text("{{ text }} {{ name }}")
+    (tmp_path / "dated.jinja").write_text("Built on {{ today }}")
+    (tmp_path / "text.md").write_text("first")
+
+    def is_up_to_date(tgt):
+        return any("up to date" in m["message"] for m in tgt.messages)
+
+    cfg = markmeld.load_config_wrapper(str(tmp_path / "_markmeld.yaml"))
+    res = markmeld.MarkdownMelder(cfg, incremental=True).build_target("default")
+    assert not is_up_to_date(res)
+    assert (tmp_path / ".markmeld" / "state").is_file()
+
+    res = markmeld.MarkdownMelder(cfg, incremental=True).build_target("default")
+    assert is_up_to_date(res)
+
+    # Changing an input forces a rebuild
+    (tmp_path / "text.md").write_text("second")
+    res = markmeld.MarkdownMelder(cfg, incremental=True).build_target("default")
+    assert not is_up_to_date(res)
+    assert (tmp_path / "out.txt").read_text().startswith("second")
+
+    # Loop iterations are tracked individually
+    res = markmeld.MarkdownMelder(cfg, incremental=True).build_target("looped")
+    assert not any(is_up_to_date(t) for t in res.values())
+    os.remove(tmp_path / "out_b.txt")
+    res = markmeld.MarkdownMelder(cfg, incremental=True).build_target("looped")
+    assert is_up_to_date(res[0])
+    assert not is_up_to_date(res[1])
+
+    # A day later, only targets that use the date are rebuilt
+    markmeld.MarkdownMelder(cfg, incremental=True).build_target("dated")
+
+    class Tomorrow(datetime.date):
+        @classmethod
+        def today(cls):
+            return datetime.date.today() + datetime.timedelta(days=1)
+
+    monkeypatch.setattr(markmeld.melder, "date", Tomorrow)
+    res = markmeld.MarkdownMelder(cfg, incremental=True).build_target("default")
+    assert is_up_to_date(res)
+    res = markmeld.MarkdownMelder(cfg, incremental=True).build_target("dated")
+    assert not is_up_to_date(res)
+
+
+def test_incremental_loop_items(tmp_path):
+    config = """version: 1
+targets:
+  people:
+    jinja_template: person.jinja
+    output_file: "person_{person[name]}.txt"
+    command: cat > {output_file}
+    loop:
+      loop_data: people
+      assign_to: person
+    data:
+      yaml_files:
+        people: people.yaml
+  counted:
+    inherit_from: people
+    jinja_template: counted.jinja
+    output_file: "counted_{person[name]}.txt"
+  listed:
+    jinja_template: listed.jinja
+    output_file: "listed_{name}.txt"
+    command: cat > {output_file}
+    loop:
+      loop_data: names
+      assign_to: name
+    data:
+      variables:
+        names: [%s]
+"""
+    (tmp_path / "_markmeld.yaml").write_text(config % "a, b")
+    (tmp_path / "person.jinja").write_text("{{ person.name }}: {{ person.role }}")
+    (tmp_path / "counted.jinja").write_text("{{ person.name }} of {{ people|length }}")
+    (tmp_path / "listed.jinja").write_text("{{ name }}")
+    people = "- {name: ann, role: %s}\n- {name: bob, role: author}\n"
+    (tmp_path / "people.yaml").write_text(people % "editor")
+
+    def rebuilt(target):
+        cfg = markmeld.load_config_wrapper(str(tmp_path / "_markmeld.yaml"))
+        res = markmeld.MarkdownMelder(cfg, incremental=True).build_target(target)
+        return [
+            not any("up to date" in m["message"] for m in t.messages)
+            for t in res.values()
+        ]
+
+    for target in ["people", "counted", "listed"]:
+        assert rebuilt(target) == [True, True]
+
+    # Changing one element of the loop data rebuilds only its output
+    (tmp_path / "people.yaml").write_text(people % "reviewer")
+    assert rebuilt("people") == [True, False]
+    assert (tmp_path / "person_ann.txt").read_text() == "ann: reviewer"
+    # ...unless the template uses the loop data as a whole
+    assert rebuilt("counted") == [True, True]
+    # Loop data in variables works the same way
+    (tmp_path / "_markmeld.yaml").write_text(config % "a, c")
+    assert rebuilt("listed") == [False, True]
+
+
+def test_build_state_merges_concurrent_runs(tmp_path):
+    import json
+    from types import SimpleNamespace
+    from markmeld.build_state import BuildState
+
+    cfg_path = str(tmp_path / "_markmeld.yaml")
+    # Two runs (like two shards) start from the same state...
+    runs = [BuildState(cfg_path), BuildState(cfg_path)]
+    for i, state in enumerate(runs):
+        tgt = SimpleNamespace(target_name=f"t{i}", meta={"output_file": "out"})
+        state.record(tgt, f"digest{i}")
+    for state in runs:
+        state.save()
+    # ...and neither loses the other's entries
+    with open(tmp_path / ".markmeld" / "state") as f:
+        assert json.load(f) == {"t0:out": "digest0", "t1:out": "digest1"}
+    assert not list((tmp_path / ".markmeld").glob("*.tmp"))
+
+
+@pytest.mark.parametrize("jobs", [None, 4])
+def test_side_targets_built_once(jobs):
+    cfg = markmeld.load_config_wrapper("tests/test_data/prebuild_test/_markmeld.yaml")
+    mm = markmeld.MarkdownMelder(cfg, jobs=jobs)
+    res = mm.build_target("uses_both")
+    assert res.returncode == 0
+    count_path = "tests/test_data/prebuild_test/shared_prebuild_count"
+    with open(count_path) as f:
+        assert f.read() == "built\n"
+    os.remove(count_path)
+
+
+def test_side_target_cycle():
+    cfg = markmeld.load_config_wrapper("tests/test_data/prebuild_test/_markmeld.yaml")
+    mm = markmeld.MarkdownMelder(cfg)
+    with pytest.raises(markmeld.exceptions.TargetError, match="Circular"):
+        mm.build_target("cycle_a")
+
+
+def test_loop_memory_is_flat(tmp_path):
+    """
+    Loop iterations share the melded input instead of copying it, so peak
+    memory should not grow with the number of iterations.
+    """
+    import tracemalloc
+
+    def loop_peak(n):
+        cfg = {
+            "_cfg_file_path": str(tmp_path / "_markmeld.yaml"),
+            "targets": {
+                "looped": {
+                    "_defpath": str(tmp_path / "_markmeld.yaml"),
+                    "_workpath": str(tmp_path / "_markmeld.yaml"),
+                    "loop": {"loop_data": "items", "assign_to": "item"},
+                    "data": {
+                        "variables": {
+                            "items": list(range(n)),
+                            "big": [{"key": str(i) * 10} for i in range(5000)],
+                        }
+                    },
+                }
+            },
+        }
+        mm = markmeld.MarkdownMelder(cfg)
+        tracemalloc.start()
+        res = mm.build_target("looped", print_only=True)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert len(res) == n
+        return peak
+
+    peak_small = loop_peak(10)
+    peak_large = loop_peak(60)
+    # Copying the data per iteration would add several MB per iteration
+    assert peak_large < peak_small * 1.5
+
+
+def test_template_cache(tmp_path):
+    from markmeld.melder import load_template
+
+    tpl_path = tmp_path / "tpl.jinja"
+    tpl_path.write_text("Hello {{ name }}")
+    cfg = {"jinja_template": "tpl.jinja", "_cfg_file_path": str(tmp_path / "x.yaml")}
+    tpl = load_template(cfg)
+    assert load_template(cfg) is tpl  # compiled once
+    assert tpl.render(name="you") == "Hello you"
+
+    # Changing the file invalidates the cached template
+    tpl_path.write_text("Bye {{ name }}")
+    os.utime(tpl_path, (1, 1))
+    tpl2 = load_template(cfg)
+    assert tpl2 is not tpl
+    assert tpl2.render(name="you") == "Bye you"
+    assert tpl2.source == "Bye {{ name }}"
+
+
+def test_http_cache(tmp_path, monkeypatch):
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from markmeld.exceptions import RemoteFileError
+    from markmeld.http_cache import HTTP_CACHE_SETTINGS, fetch_url
+
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.headers.get("If-None-Match"))
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = b"remote content"
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/file.md"
+
+    monkeypatch.setenv("MM_CACHE_DIR", str(tmp_path))
+    monkeypatch.setitem(HTTP_CACHE_SETTINGS, "ttl", 300)
+    assert fetch_url(url) == "remote content"
+    assert fetch_url(url) == "remote content"  # within TTL: no request
+    assert requests_seen == [None]
+
+    monkeypatch.setitem(HTTP_CACHE_SETTINGS, "ttl", 0)
+    assert fetch_url(url) == "remote content"  # revalidated: 304
+    assert requests_seen == [None, '"v1"']
+
+    # Concurrent fetches of a URL don't clobber each other's cache writes
+    from markmeld.utilities import parallel_map
+
+    assert parallel_map(fetch_url, [url] * 8) == ["remote content"] * 8
+    assert not list((tmp_path / "http").glob("*.tmp"))
+
+    server.shutdown()
+    server.server_close()
+    monkeypatch.setitem(HTTP_CACHE_SETTINGS, "offline", True)
+    assert fetch_url(url) == "remote content"
+    with pytest.raises(RemoteFileError):
+        fetch_url(url + "?uncached")
+
+
+def test_concurrent_process_data_keeps_merge_order(tmp_path, monkeypatch):
+    import markmeld.melder
+
+    for i in range(20):
+        (tmp_path / f"unkeyed_{i}.yaml").write_text(f"value: {i}\nvalue_{i}: {i}\n")
+        (tmp_path / f"frontmatter_{i}.yaml").write_text(f"shared: {i}\n")
+        (tmp_path / f"text_{i}.md").write_text(f"---\nshared: md{i}\n---\ntext {i}\n")
+    data_block = {
+        "yaml_globs_unkeyed": ["unkeyed_*.yaml"],
+        "yaml_globs": ["frontmatter_*.yaml"],
+        "md_globs": ["text_*.md"],
+    }
+    filepath = str(tmp_path / "_markmeld.yaml")
+    concurrent = markmeld.melder.process_data(data_block, filepath)
+    monkeypatch.setattr(
+        markmeld.melder, "parallel_map", lambda f, items: [f(x) for x in items]
+    )
+    serial = markmeld.melder.process_data(data_block, filepath)
+    assert concurrent == serial
+
+
+def test_parse_cache(tmp_path, monkeypatch):
+    from markmeld import utilities
+
+    path = tmp_path / "data.yaml"
+    path.write_text("a: 1\n")
+    os.utime(path, (1, 1))
+    first = utilities.load_yaml_file(str(path))
+    assert first == {"a": 1}
+    assert utilities.load_yaml_file(str(path)) is first  # not re-parsed
+
+    path.write_text("a: 22\n")
+    assert utilities.load_yaml_file(str(path)) == {"a": 22}
+
+    # A same-size edit in the same timestamp tick (as on file systems with
+    # coarse times) isn't hidden by the cache
+    mtime = path.stat().st_mtime_ns
+    path.write_text("a: 33\n")
+    os.utime(path, ns=(mtime, mtime))
+    assert utilities.load_yaml_file(str(path)) == {"a": 33}
+
+    # The disk cache is reused by a fresh process (simulated by clearing memory)
+    os.utime(path, (1, 1))
+    monkeypatch.setenv("MM_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setitem(utilities.PARSE_CACHE_SETTINGS, "disk", True)
+    calls = []
+
+    def parser(p):
+        calls.append(p)
+        return utilities.parse_yaml_file(p)
+
+    utilities.cached_parse(str(path), parser, "test")
+    utilities._PARSE_CACHE.clear()
+    assert utilities.cached_parse(str(path), parser, "test") == {"a": 33}
+    assert len(calls) == 1
+
+
+def test_lazy_raw_views(tmp_path):
+    import json
+    from markmeld.melder import process_data
+    from markmeld.utilities import json_default
+
+    (tmp_path / "data.yaml").write_text("a: 1\n")
+    (tmp_path / "text.md").write_text("---\nkey: value\n---\nbody\n")
+    data = process_data(
+        {"yaml_files": {"data": "data.yaml"}, "md_files": {"text": "text.md"}},
+        str(tmp_path / "_markmeld.yaml"),
+    )
+    assert set(data["_raw"]._pending) == {"data", "text"}  # not dumped yet
+    assert data["_raw"]["data"] == "a: 1\n"
+    assert set(data["_raw"]._pending) == {"text"}
+    assert data["_global_frontmatter"]["fenced"] == "---\nkey: value\n---\n"
+
+    dumped = json.loads(json.dumps(data, default=json_default))
+    assert dumped["_raw"]["text"] == "---\nkey: value\n---\n\nbody"
+    assert dumped["_local_frontmatter"]["text"]["raw"] == "key: value\n"
+
+
+def test_watch_rebuilds_on_change(tmp_path):
+    import threading
+    import time
+    from markmeld.watch import TargetWatcher
+
+    (tmp_path / "_markmeld.yaml").write_text(
+        "version: 1\ntargets:\n  default:\n    jinja_template: tpl.jinja\n"
+        "    output_file: out.txt\n    command: cat > {output_file}\n"
+        "    data:\n      md_globs:\n        - '*.md'\n"
+    )
+    (tmp_path / "tpl.jinja").write_text("{{ a }}|{{ b }}")
+    (tmp_path / "a.md").write_text("first")
+    out = tmp_path / "out.txt"
+
+    watcher = TargetWatcher(
+        str(tmp_path / "_markmeld.yaml"), "default", interval=0.05, debounce=0.05
+    )
+    thread = threading.Thread(target=watcher.run, kwargs={"max_builds": 3})
+    thread.start()
+
+    def wait_for_output(expected):
+        for _ in range(100):
+            if out.is_file() and out.read_text() == expected:
+                return True
+            time.sleep(0.05)
+        return False
+
+    try:
+        assert wait_for_output("first|")
+        (tmp_path / "a.md").write_text("second")
+        assert wait_for_output("second|")
+        (tmp_path / "b.md").write_text("new")  # new file matching the glob
+        assert wait_for_output("second|new")
+    finally:
+        watcher.stop()
+        thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_build_targets_by_pattern():
+    cfg = markmeld.load_config_wrapper("demo_factory/_markmeld.yaml")
+    mm = markmeld.MarkdownMelder(cfg, jobs=2)
+    assert mm.match_targets("target*") == ["target1", "target2", "target3"]
+    results = mm.build_targets(mm.match_targets(), print_only=True)
+    assert set(results) == set(cfg["targets"])
+    for result, seconds in results.values():
+        assert result.returncode == 0
+        assert seconds >= 0
+
+
+def test_cli_build_pattern(capsys):
+    from markmeld.cli import main
+
+    with pytest.raises(SystemExit) as e:
+        main(
+            test_args={
+                "config": "demo_factory/_markmeld.yaml",
+                "target": "target*",
+                "print": True,
+            }
+        )
+    assert e.value.code == 0
+    out = capsys.readouterr().out
+    assert "Target1" in out and "my second target" in out
+
+    with pytest.raises(SystemExit) as e:
+        main(
+            test_args={
+                "config": "demo_factory/_markmeld.yaml",
+                "target": "target*",
+                "dump": True,
+            }
+        )
+    assert e.value.code == 0
+    assert sorted(json.loads(capsys.readouterr().out)) == [
+        "target1",
+        "target2",
+        "target3",
+    ]
+
+    with pytest.raises(SystemExit) as e:
+        main(
+            test_args={
+                "config": "demo_factory/_markmeld.yaml",
+                "target": "target*",
+                "explain": True,
+            }
+        )
+    assert e.value.code == 1
+
+
+def test_config_cache(tmp_path, monkeypatch):
+    from markmeld.config_cache import load_config_cached
+
+    monkeypatch.setenv("MM_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("MM_TEST_IMPORT", "imported.yaml")
+    (tmp_path / "_markmeld.yaml").write_text(
+        "imports:\n  - $MM_TEST_IMPORT\ntarget_factories:\n- glob:\n    path: 'docs/*.md'\n"
+    )
+    (tmp_path / "imported.yaml").write_text("targets:\n  imported: {}\n")
+    (tmp_path / "other.yaml").write_text("targets:\n  other: {}\n")
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "one.md").write_text("one")
+    cfg_path = str(tmp_path / "_markmeld.yaml")
+
+    cfg = load_config_cached(cfg_path)
+    assert sorted(cfg["targets"]) == ["imported", "one"]
+    assert load_config_cached(cfg_path) is not cfg  # loaded from disk
+    assert load_config_cached(cfg_path) == cfg
+
+    # New files matching a factory glob invalidate the cache
+    (tmp_path / "docs" / "two.md").write_text("two")
+    assert sorted(load_config_cached(cfg_path)["targets"]) == ["imported", "one", "two"]
+
+    # So do changes to imported files...
+    (tmp_path / "imported.yaml").write_text("targets:\n  renamed: {}\n")
+    assert "renamed" in load_config_cached(cfg_path)["targets"]
+
+    # ...and to environment variables the config refers to
+    monkeypatch.setenv("MM_TEST_IMPORT", "other.yaml")
+    assert "other" in load_config_cached(cfg_path)["targets"]
+
+
+# Time to import markmeld and list the targets, in the autocompleting process
+# (not counting the interpreter's own startup); it takes about 0.1s
+AUTOCOMPLETE_BUDGET_SECONDS = 0.3
+
+
+def test_autocomplete_startup(tmp_path):
+    import subprocess
+    import sys
+
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "sys.argv = ['mm', '--autocomplete']\n"
+        "from markmeld.cli import main\n"
+        "try:\n"
+        "    main()\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "elapsed = time.perf_counter() - start\n"
+        "heavy = ['jinja2', 'frontmatter', 'markmeld.melder', 'pkg_resources', 'requests']\n"
+        "loaded = [m for m in heavy if m in sys.modules]\n"
+        "print(json.dumps({'elapsed': elapsed, 'loaded': loaded}), file=sys.stderr)\n"
+    )
+    env = dict(os.environ, MM_CACHE_DIR=str(tmp_path))
+    env["PYTHONPATH"] = os.path.abspath(".")
+    for _ in range(2):  # cold, then with the config cache
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", script],
+            cwd="demo_factory",
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, result.stderr
+        assert "target1" in result.stdout
+        report = json.loads(result.stderr.strip().splitlines()[-1])
+        assert report["loaded"] == []
+        # -X importtime lists every module imported, even if later removed
+        imported = {
+            line.split("|")[-1].strip()
+            for line in result.stderr.splitlines()
+            if line.startswith("import time:")
+        }
+        assert not imported & {"jinja2", "frontmatter", "requests", "pkg_resources"}
+    assert report["elapsed"] < AUTOCOMPLETE_BUDGET_SECONDS
+
+
+WORKER_SCRIPT = """import json, os, sys
+for line in sys.stdin.buffer:
+    header = json.loads(line)
+    text = sys.stdin.buffer.read(header["size"])
+    with open(os.path.join(header["cwd"], header["output_file"]), "wb") as f:
+        f.write(text + b" pid=" + str(os.getpid()).encode())
+    print(json.dumps({"returncode": 0}), flush=True)
+"""
+
+
+def test_persistent_server(tmp_path, monkeypatch):
+    import sys
+    import time
+    from markmeld.servers import SERVER_SETTINGS, SERVERS
+
+    (tmp_path / "worker.py").write_text(WORKER_SCRIPT)
+    (tmp_path / "tpl.jinja").write_text("Hello {{ name }}")
+    (tmp_path / "_markmeld.yaml").write_text(f"""version: 1
+targets:
+  looped:
+    jinja_template: tpl.jinja
+    recursive_render: false
+    output_file: "out_{{name}}.txt"
+    command: cat > {{output_file}}
+    server:
+      command: {sys.executable} worker.py
+    loop:
+      loop_data: names
+      assign_to: name
+    data:
+      variables:
+        names: [a, b, c]
+  broken:
+    inherit_from: looped
+    output_file: "broken_{{name}}.txt"
+    server:
+      command: exit 0
+  stalled:
+    inherit_from: looped
+    output_file: "stalled_{{name}}.txt"
+    server:
+      command: sleep 60
+""")
+    cfg = markmeld.load_config_wrapper(str(tmp_path / "_markmeld.yaml"))
+    try:
+        res = markmeld.MarkdownMelder(cfg).build_target("looped")
+        assert [tgt.returncode for tgt in res.values()] == [0, 0, 0]
+        outputs = [(tmp_path / f"out_{n}.txt").read_text() for n in "abc"]
+        assert outputs[0].startswith("Hello a pid=")
+        # One worker process built every iteration
+        assert len({text.split("pid=")[1] for text in outputs}) == 1
+
+        # A server that dies falls back to running the command
+        res = markmeld.MarkdownMelder(cfg).build_target("broken")
+        assert [tgt.returncode for tgt in res.values()] == [0, 0, 0]
+        assert (tmp_path / "broken_b.txt").read_text() == "Hello b"
+
+        # So does a server that stops answering
+        monkeypatch.setitem(SERVER_SETTINGS, "build_timeout", 0.5)
+        start = time.time()
+        res = markmeld.MarkdownMelder(cfg).build_target("stalled")
+        assert [tgt.returncode for tgt in res.values()] == [0, 0, 0]
+        assert (tmp_path / "stalled_c.txt").read_text() == "Hello c"
+        assert time.time() - start < 10
+    finally:
+        SERVERS.close()
+
+
+def test_pandoc_request():
+    from markmeld.servers import pandoc_request
+
+    # The template file doesn't exist
+    assert pandoc_request("pandoc -s --template=t.html -o out.html", "/x") is None
+    params, output = pandoc_request("pandoc -s -V title=Doc -o out.docx", "/x")
+    assert output == "/x/out.docx"
+    assert params == {
+        "from": "markdown",
+        "to": "docx",
+        "standalone": True,
+        "variables": {"title": "Doc"},
+    }
+    assert pandoc_request("pandoc -o out.pdf", "/x") is None
+    assert pandoc_request("pandoc -o out.html | cat", "/x") is None
+    assert pandoc_request("pandoc --citeproc -o out.html", "/x") is None
+    assert pandoc_request("cat > out.html", "/x") is None
+
+
+def test_streaming_render(tmp_path):
+    import tracemalloc
+
+    (tmp_path / "big.jinja").write_text(
+        "{% for i in range(n) %}line {{ i }}\n{% endfor %}"
+    )
+    (tmp_path / "_markmeld.yaml").write_text("""version: 1
+targets:
+  big:
+    jinja_template: big.jinja
+    recursive_render: false
+    output_file: count.txt
+    command: wc -c > {output_file}
+    data:
+      variables:
+        n: 200000
+  early_exit:
+    inherit_from: big
+    command: head -c 10 > {output_file}
+""")
+    expected_size = sum(len(f"line {i}\n") for i in range(200000))
+    cfg = markmeld.load_config_wrapper(str(tmp_path / "_markmeld.yaml"))
+    mm = markmeld.MarkdownMelder(cfg)
+    tracemalloc.start()
+    res = mm.build_target("big")
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert res.returncode == 0
+    assert res.melded_output is None
+    assert int((tmp_path / "count.txt").read_text()) == expected_size
+    assert peak < expected_size / 2
+
+    # A command that stops reading early doesn't break the build
+    res = mm.build_target("early_exit")
+    assert res.returncode == 0
+    assert (tmp_path / "count.txt").read_text() == "line 0\nlin"
+
+
+def test_selective_render(tmp_path):
+    # Selective rendering gives the same output as double rendering...
+    for path in ["demo_book/book_var1", "demo_book/variable_variables"]:
+        cfg = markmeld.load_config_wrapper(f"{path}/_markmeld.yaml")
+        double = markmeld.MarkdownMelder(cfg).build_target("default", print_only=True)
+        cfg["targets"]["default"]["recursive_render"] = "selective"
+        mm = markmeld.MarkdownMelder(cfg)
+        selective = mm.build_target("default", print_only=True)
+        # (double rendering also strips one more trailing newline)
+        assert selective.melded_output.rstrip("\n") == double.melded_output
+
+    (tmp_path / "tpl.jinja").write_text("{{ greeting }} / {{ item.note }}")
+    (tmp_path / "_markmeld.yaml").write_text("""version: 1
+targets:
+  looped:
+    jinja_template: tpl.jinja
+    recursive_render: selective
+    loop:
+      loop_data: items
+      assign_to: item
+    data:
+      variables:
+        name: World
+        greeting: "Hello {{ name }}"
+        items:
+          - note: "{{ name | upper }}"
+          - note: "{{ broken"
+""")
+    cfg = markmeld.load_config_wrapper(str(tmp_path / "_markmeld.yaml"))
+    res = markmeld.MarkdownMelder(cfg).build_target("looped", print_only=True)
+    assert res[0].melded_output == "Hello World / WORLD"
+    assert res[1].melded_output == "Hello World / {{ broken"
+    # The shared data isn't modified
+    assert res[0].melded_input["greeting"] == "Hello {{ name }}"
+
+
+def test_lazy_data(tmp_path):
+    (tmp_path / "intro.md").write_text("Intro: {{ _yaml.note.content.text }}")
+    (tmp_path / "note.yaml").write_text("text: a note")
+    (tmp_path / "unused.yaml").write_text("text: [not loaded")  # invalid yaml
+    (tmp_path / "tpl.jinja").write_text("{{ intro }} / {{ _md['intro'].ext }}")
+    (tmp_path / "dynamic.jinja").write_text("{{ _md[name].ext }}")
+    (tmp_path / "_markmeld.yaml").write_text("""version: 1
+targets:
+  lazy:
+    jinja_template: tpl.jinja
+    command: cat > {output_file}
+    data:
+      md_files:
+        intro: intro.md
+      yaml_files:
+        note: note.yaml
+        unused: unused.yaml
+  dynamic:
+    jinja_template: dynamic.jinja
+    data:
+      variables:
+        name: intro
+      md_files:
+        intro: intro.md
+      yaml_files:
+        note: note.yaml
+""")
+    cfg = markmeld.load_config_wrapper(str(tmp_path / "_markmeld.yaml"))
+    mm = markmeld.MarkdownMelder(cfg)
+    tgt = markmeld.melder.Target(cfg, "lazy")
+    assert mm.get_data_keys(tgt) >= {"intro", "_md", "output_file"}
+    assert "note" not in mm.get_data_keys(tgt)
+
+    # The jinja in intro.md refers to note, which is loaded for the 2nd render
+    res = mm.build_target("lazy", print_only=True)
+    assert res.melded_output == "Intro: a note / .md"
+    assert "unused" not in res.melded_input
+    assert "note" in res.melded_input
+
+    # Dynamic lookups load everything
+    res = mm.build_target("dynamic", print_only=True)
+    assert mm.get_data_keys(res) is None
+    assert res.melded_output == ".md"
+    assert "note" in res.melded_input
+
+
+def test_batch_loop(tmp_path):
+    import sys
+
+    (tmp_path / "tpl.jinja").write_text("Dear {{ person }}")
+    (tmp_path / "batch.py").write_text("""import json, sys
+manifest = json.load(open(sys.argv[1]))
+open("runs.txt", "a").write("run")
+for item in manifest["items"]:
+    if item["person"] != "Nobody":
+        open(item["output_file"], "w").write(open(item["input"]).read())
+json.dump({"2": 5}, open(manifest["results"], "w"))
+""")
+    (tmp_path / "_markmeld.yaml").write_text(f"""version: 1
+targets:
+  letters:
+    jinja_template: tpl.jinja
+    output_file: "letter_{{person}}.txt"
+    command: {sys.executable} batch.py {{manifest}}
+    loop:
+      loop_data: people
+      assign_to: person
+      batch: true
+    data:
+      variables:
+        people: [Ann, Nobody, Bob]
+""")
+    cfg = markmeld.load_config_wrapper(str(tmp_path / "_markmeld.yaml"))
+    res = markmeld.MarkdownMelder(cfg).build_target("letters")
+    # One command run for all the iterations
+    assert (tmp_path / "runs.txt").read_text() == "run"
+    assert (tmp_path / "letter_Ann.txt").read_text() == "Dear Ann"
+    assert res[0].returncode == 0
+    assert res[0].meta["output_file"] == "letter_Ann.txt"
+    # Missing output
+    assert res[1].returncode == 1
+    assert "Nobody" in res[1].messages[0]["message"]
+    # Return code from the results file
+    assert res[2].returncode == 5
+    # The batch command has no single output file
+    cfg["targets"]["letters"]["command"] += " {output_file}"
+    with pytest.raises(markmeld.exceptions.TargetError, match="output_file"):
+        markmeld.MarkdownMelder(cfg).build_target("letters")
+
+
+def test_shards(tmp_path, capsys):
+    import json
+    from markmeld.cli import main
+    from markmeld.sharding import parse_shard, shard_of
+
+    # Shards are stable across runs and machines
+    assert [shard_of(n, 3) for n in [1, 2, 3, 4, 5, 6]] == [2, 2, 2, 2, 3, 1]
+    assert shard_of({"name": "Ann"}, 4) == 4
+    assert parse_shard("2/8") == (2, 8)
+    with pytest.raises(ValueError):
+        parse_shard("0/8")
+
+    built = []
+    for k in [1, 2, 3]:
+        manifest = tmp_path / f"shard-{k}-of-3.json"
+        main(
+            test_args={
+                "config": "tests/test_data/loop_test/_markmeld.yaml",
+                "target": "parallel_loop",
+                "shard": f"{k}/3",
+                "shard_manifest": str(manifest),
+            }
+        )
+        rows = json.loads(manifest.read_text())["results"]
+        built.extend(row["iteration"] for row in rows)
+    # Every iteration is built by exactly one shard
+    assert sorted(built) == [0, 1, 2, 3, 4, 5]
+
+    capsys.readouterr()
+    with pytest.raises(SystemExit) as e:
+        main(test_args={"merge_shards": [str(tmp_path)]})
+    # Number 3 fails the command
+    assert e.value.code == 1
+    summary = json.loads(capsys.readouterr().out)
+    assert summary["found"] == [1, 2, 3] and summary["missing"] == []
+    assert summary["succeeded"] == 5 and summary["failed"] == 1
+    assert [row["iteration"] for row in summary["results"]] == [0, 1, 2, 3, 4, 5]
+
+
+def test_daemon(tmp_path, capsys):
+    import signal
+    import stat
+    import subprocess
+    import sys
+    import time
+    from markmeld.daemon import client_environment, forward
+
+    socket_path = str(tmp_path / "mm.sock")
+    script = (
+        "import sys\n"
+        f"sys.argv = ['mm', '--daemon', '--socket', {socket_path!r}]\n"
+        "from markmeld.cli import main\n"
+        "main()\n"
+    )
+    daemon = subprocess.Popen([sys.executable, "-c", script])
+    try:
+        deadline = time.time() + 10
+        while not os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.05)
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) & 0o077 == 0
+        cfg = os.path.abspath("demo_factory/_markmeld.yaml")
+        for _ in range(2):
+            capsys.readouterr()
+            argv = ["-c", cfg, "target1", "--print"]
+            assert forward(argv, socket_path) == 0
+            assert "Target1" in capsys.readouterr().out
+        # The output of target commands is sent to the client, too
+        (tmp_path / "echo.jinja").write_text("x is {{ x }}\n")
+        (tmp_path / "_markmeld.yaml").write_text(
+            "targets:\n  echo:\n    jinja_template: echo.jinja\n"
+            "    data:\n      variables:\n        x: 1\n"
+            "    command: 'cat; echo to-stderr >&2'\n"
+        )
+        capsys.readouterr()
+        assert (
+            forward(["-c", str(tmp_path / "_markmeld.yaml"), "echo"], socket_path) == 0
+        )
+        out, err = capsys.readouterr()
+        assert "x is 1" in out and "to-stderr" in err
+        # The thin client forwards commands without importing what builds need
+        client = (
+            "import atexit, sys\n"
+            "heavy = ['yaml', 'jinja2', 'logmuse', 'markmeld.utilities']\n"
+            "atexit.register(lambda: print([m for m in heavy if m in sys.modules]))\n"
+            f"sys.argv = ['mm', '--client', '--socket', {socket_path!r}, '-c', {cfg!r}, 'target1', '-p']\n"
+            "from markmeld.cli import main\n"
+            "main()\n"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", client], capture_output=True, text=True
+        )
+        assert result.returncode == 0, result.stderr
+        assert "Target1" in result.stdout
+        assert result.stdout.strip().splitlines()[-1] == "[]"
+        # Errors come back as return codes
+        assert forward(["-c", cfg, "nonexistent"], socket_path) == 1
+        assert forward(["-c", cfg, "target1", "--watch"], socket_path) == 1
+    finally:
+        daemon.send_signal(signal.SIGTERM)
+        daemon.wait(timeout=10)
+    assert not os.path.exists(socket_path)
+    # Without a daemon, the client runs the command itself
+    assert forward(["target1"], socket_path) is None
+    # Only the variables a build needs are sent to the daemon
+    environ = {
+        "PATH": "/bin",
+        "LC_ALL": "C",
+        "API_TOKEN": "secret",
+        "PANDOC_DATA": "x",
+        "MM_DAEMON_ENV": "DATA_DIR, PANDOC_*",
+        "DATA_DIR": "/data",
+    }
+    assert set(client_environment(environ)) == {
+        "PATH",
+        "LC_ALL",
+        "PANDOC_DATA",
+        "MM_DAEMON_ENV",
+        "DATA_DIR",
+    }
+
+
+def test_format_command(monkeypatch):
+    from types import SimpleNamespace
+    from markmeld.exceptions import TargetError
+    from markmeld.utilities import format_command, format_output_file
+
+    monkeypatch.setenv("MM_TEST_BIN", "/opt/bin")
+    meta = {
+        "command": "$MM_TEST_BIN/pandoc -o {output_file} {opts} --columns={width:>4}",
+        "output_file": "{today}_{person[name]}.pdf",
+        "opts": "--toc --metadata title={title!r} {{literal}}",
+        "title": "{person[name]}'s letter",
+        "person": {"name": "Ann"},
+        "today": "2024-01-01",
+        "width": 80,
+    }
+    tgt = SimpleNamespace(meta=meta)
+    cmd = format_command(tgt)
+    assert cmd == (
+        "/opt/bin/pandoc -o 2024-01-01_Ann.pdf"
+        ' --toc --metadata title="Ann\'s letter" {literal} --columns=  80'
+    )
+    # The target isn't modified...
+    assert meta["output_file"] == "{today}_{person[name]}.pdf"
+    # ...unless the output file is formatted explicitly
+    assert format_output_file(tgt) == "2024-01-01_Ann.pdf"
+    assert meta["output_file"] == "2024-01-01_Ann.pdf"
+
+    # Circular references are errors, instead of looping forever
+    tgt = SimpleNamespace(meta={"command": "echo {a}", "a": "{b}", "b": "x{a}"})
+    with pytest.raises(TargetError, match="a -> b -> a"):
+        format_command(tgt)
+    with pytest.raises(KeyError):
+        format_command(SimpleNamespace(meta={"command": "echo {missing}"}))
+
+
+def test_profile(tmp_path, capsys):
+    import json
+    from markmeld.cli import main
+    from markmeld.profiling import PROFILER
+
+    trace_path = tmp_path / "profile.json"
+    main(
+        test_args={
+            "config": "tests/test_data/loop_test/_markmeld.yaml",
+            "target": "parallel_loop",
+            "profile": True,
+            "profile_file": str(trace_path),
+        }
+    )
+    assert not PROFILER.enabled
+    assert "loop_iteration" in capsys.readouterr().err
+    trace = json.loads(trace_path.read_text())
+    names = [event["name"] for event in trace["traceEvents"]]
+    for phase in ["load_config", "build_target", "meld_inputs", "loop_iteration"]:
+        assert phase in names
+    iterations = [e for e in trace["traceEvents"] if e["name"] == "loop_iteration"]
+    assert sorted(e["args"]["iteration"] for e in iterations) == list(range(6))
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in trace["traceEvents"])
+    summary = {row["phase"]: row for row in trace["markmeldSummary"]}
+    assert summary["run_cmd"]["count"] == 6
+
+
+def test_inheritance_resolver():
+    from copy import deepcopy
+    from markmeld.exceptions import TargetError
+    from markmeld.melder import InheritanceResolver, Target
+
+    cfg = {
+        "_cfg_file_path": "_markmeld.yaml",
+        "targets": {
+            "base": {"data": {"variables": {"a": 1}}, "tags": ["base"]},
+            "left": {"inherit_from": "base", "side": "left"},
+            "right": {"inherit_from": "base", "side": "right", "r": True},
+            "diamond": {"inherit_from": ["left", "right"]},
+            "cycle_a": {"inherit_from": "cycle_b"},
+            "cycle_b": {"inherit_from": "cycle_a"},
+        },
+    }
+    resolver = InheritanceResolver(cfg)
+    resolved = resolver.resolve("diamond")
+    assert resolved["side"] == "right"
+    assert resolved["r"] and resolved["data"]["variables"]["a"] == 1
+    # Shared bases are resolved once
+    assert resolver.resolve("diamond") is resolved
+    assert set(resolver.merged) == {"base", "left", "right", "diamond"}
+
+    # The remembered results can't be changed, by callers or by targets
+    with pytest.raises(TypeError):
+        resolved["side"] = "up"
+    tgt = Target(cfg, "diamond", inheritance=resolver)
+    tgt.meta["tags"].append("mine")
+    tgt.meta["data"]["variables"]["a"] = 2
+    other = Target(cfg, "left", inheritance=resolver)
+    assert other.meta["tags"] == ["base"]
+    assert other.meta["data"]["variables"]["a"] == 1
+    assert cfg["targets"]["base"]["tags"] == ["base"]
+    # Targets copy only what they use (copy-on-write)
+    fresh = Target(cfg, "left", inheritance=resolver)
+    assert fresh.meta.base is resolver.resolve("left")
+    assert "data" in fresh.meta and "data" not in fresh.meta.local
+    del fresh.meta["side"]
+    assert "side" not in fresh.meta and "side" not in dict(fresh.meta)
+    assert deepcopy(tgt.meta)["data"] == {"variables": {"a": 2}}
+
+    with pytest.raises(TargetError, match="cycle_a -> cycle_b -> cycle_a"):
+        Target(cfg, "cycle_a")
+
+
+def test_glob_index(tmp_path, monkeypatch):
+    import glob
+    from markmeld import glob_index
+    from markmeld.glob_index import GlobIndex
+
+    for path in ["a.md", ".hidden.md", "sub/b.md", "sub/deep/c.md", "sub/d.txt"]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(path)
+    folders = [tmp_path, tmp_path / "sub", tmp_path / "sub" / "deep"]
+    for folder in folders:
+        os.utime(folder, ns=(10**18, 10**18))  # long enough ago to trust
+
+    index = GlobIndex()
+    for pattern in ["*.md", "**/*.md", "sub/*", "*/*.md", ".*", "sub/deep/c.md"]:
+        pattern = str(tmp_path / pattern)
+        assert index.glob(pattern) == sorted(glob.glob(pattern, recursive=True))
+
+    # Further globs reuse the listings of unchanged folders
+    scanned = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(
+        glob_index.os, "scandir", lambda p: scanned.append(p) or real_scandir(p)
+    )
+    visited = {}
+    assert len(index.glob(str(tmp_path / "**" / "*.txt"), visited)) == 1
+    assert scanned == []
+    assert index.is_fresh(visited)
+
+    # A changed folder is listed again
+    (tmp_path / "sub" / "e.txt").write_text("e")
+    os.utime(tmp_path / "sub", ns=(15 * 10**17, 15 * 10**17))
+    assert not index.is_fresh(visited)
+    assert len(index.glob(str(tmp_path / "**" / "*.txt"))) == 2
+    assert scanned == [str(tmp_path / "sub")]